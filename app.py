@@ -1,21 +1,44 @@
 import os
-import sentry_sdk
+# before everything else, so that STARTUP_REPORT times the imports that follow
+from yurikamome.startup import startup
+import json
+import time
+import atexit
+import click
 import werkzeug.exceptions
 import logging
-from sentry_sdk import capture_exception
-from flask import Flask, g
+from flask import Flask, g, jsonify, request
 from dotenv import load_dotenv
 from yurikamome.mastodon_meta_blueprint import meta_blueprint
 from yurikamome.mastodon_timelines_blueprint import timelines_blueprint
 from yurikamome.pages_blueprint import pages_blueprint
-from yurikamome.helpers import get_db
+from yurikamome.media_blueprint import media_blueprint
+from yurikamome.mastodon_search_blueprint import search_blueprint
+from yurikamome.metrics_blueprint import metrics_blueprint
+from yurikamome.admin_blueprint import admin_blueprint
+from yurikamome.timeline_sync import timeline_sync, TIMELINE_SYNC
+from yurikamome.maintenance import maintenance, run_maintenance, enable_incremental_vacuum, MAINTENANCE_INTERVAL
+from yurikamome.background import background
+from yurikamome.helpers import get_db, release_db, maybe_flush_last_used, flush_last_used, db_writer, SQLITE_DB
+from yurikamome.migrations import migrate, migrate_if_needed, current_version, latest_version
+from yurikamome.upstream import UpstreamUnavailable
+from yurikamome.metrics import REQUEST_SECONDS, REQUESTS, SERVER_TIMING, start_request, server_timing, \
+    request_timings, request_upstream_calls
+from yurikamome.profiling import sampler, slow_requests, PROFILE_HZ
+from yurikamome.cache_backend import cache
 
 load_dotenv()
 
 if os.getenv('SENTRY_DSN'):
+    # only imported when it is used, it takes longer to import than the rest of the app
+    import sentry_sdk
+    from sentry_sdk import capture_exception
     sentry_sdk.init(
         dsn=os.getenv('SENTRY_DSN')
     )
+else:
+    def capture_exception(e):
+        pass
 
 
 class No404(logging.Filter):
@@ -24,10 +47,64 @@ class No404(logging.Filter):
 
 logging.getLogger("werkzeug").addFilter(No404())
 
-app = Flask(__name__, template_folder='templates', static_folder='static')
+if int(os.getenv('WEB_CONCURRENCY', '1')) > 1 and not cache.shared:
+    logging.getLogger(__name__).warning('Several workers with CACHE_BACKEND=memory do not share rate limit budgets, '
+                                        'and logouts are only seen by the worker that handled them')
+
+class YurikamomeFlask(Flask):
+    def async_to_sync(self, func):
+        # async views run on the process-wide loop instead of a fresh loop per request
+        return background.run_sync(func)
+
+
+app = YurikamomeFlask(__name__, template_folder='templates', static_folder='static')
 app.register_blueprint(pages_blueprint, url_prefix='/')
 app.register_blueprint(meta_blueprint, url_prefix='/')
 app.register_blueprint(timelines_blueprint, url_prefix='/')
+app.register_blueprint(media_blueprint, url_prefix='/')
+app.register_blueprint(search_blueprint, url_prefix='/')
+app.register_blueprint(metrics_blueprint, url_prefix='/')
+app.register_blueprint(admin_blueprint, url_prefix='/')
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started_at = time.perf_counter()
+    start_request()
+
+
+@app.after_request
+def record_request_metrics(resp):
+    elapsed = time.perf_counter() - g.get('request_started_at', time.perf_counter())
+    # the rule rather than the path, so that ids and scanners do not blow up the number of series
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_SECONDS.labels(route, request.method).observe(elapsed)
+    REQUESTS.labels(route, request.method, resp.status_code).inc()
+    if route != '/admin/profile':
+        slow_requests.record(request.method, request.path, route, resp.status_code, elapsed, request_timings(),
+                             request_upstream_calls())
+    if SERVER_TIMING:
+        resp.headers['Server-Timing'] = server_timing(elapsed)
+    return resp
+
+
+if TIMELINE_SYNC:
+    # started from the serving process rather than at import, so flask CLI commands do not sync
+    @app.before_request
+    def start_timeline_sync():
+        timeline_sync.start()
+
+
+if PROFILE_HZ:
+    @app.before_request
+    def start_profiler():
+        sampler.start()
+
+
+if MAINTENANCE_INTERVAL:
+    @app.before_request
+    def start_maintenance():
+        maintenance.start()
 
 
 @app.errorhandler(werkzeug.exceptions.BadRequest)
@@ -42,19 +119,54 @@ def handle_unsupported_media_type(e):
     return 'unsupported media type!', 415
 
 
+@app.errorhandler(UpstreamUnavailable)
+def handle_upstream_unavailable(e):
+    resp = jsonify({'error': str(e)})
+    resp.status_code = e.status
+    if e.retry_after:
+        resp.headers['Retry-After'] = str(int(e.retry_after) + 1)
+    return resp
+
+
 @app.teardown_appcontext
 def close_connection(_):
-    db = getattr(g, '_database', None)
+    maybe_flush_last_used()
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        release_db(db)
+
+
+@atexit.register
+def flush_last_used_on_exit():
+    if db_writer.started:
+        # queued behind every pending write, so waiting on it drains the writer
+        db_writer.submit(flush_last_used).result(timeout=10)
+    else:
+        # no thread can be started this late in shutdown, and without a writer there are no writes to wait for
+        flush_last_used()
 
 
 def init_db():
     with app.app_context():
-        db = get_db()
-        with app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
+        return migrate(get_db())
+
+
+def check_schema():
+    """Only compares versions, migrating is left to `flask sqlite init` and to the ASGI server when it starts."""
+    with app.app_context():
+        version = current_version(get_db())
+    latest = latest_version()
+    if version < latest:
+        logging.getLogger(__name__).warning('Database schema version %d is behind %d, run `flask sqlite init`',
+                                            version, latest)
+
+
+def migrate_on_start():
+    """Migrates a database that is behind, once across workers starting together."""
+    with app.app_context():
+        applied = migrate_if_needed(get_db(), f'{SQLITE_DB}.migrate-lock')
+    if applied:
+        logging.getLogger(__name__).warning('Applied migrations %s', ', '.join(map(str, applied)))
 
 
 @app.cli.group()
@@ -66,4 +178,32 @@ def sqlite():
 @sqlite.command()
 def init():
     """Update sqlite database."""
-    init_db()
+    applied = init_db()
+    if applied:
+        print(f"Applied migrations {', '.join(map(str, applied))}")
+    else:
+        print("Database is up to date")
+
+
+@sqlite.command()
+def version():
+    """Show sqlite schema version."""
+    with app.app_context():
+        print(f"Schema version {current_version(get_db())} (latest {latest_version()})")
+
+
+@sqlite.command()
+@click.option('--vacuum', is_flag=True, help='Rewrite the database first to turn on incremental vacuum. Blocks writers.')
+def maintain(vacuum):
+    """Delete expired rows, vacuum and optimize."""
+    if vacuum:
+        enable_incremental_vacuum()
+    print(json.dumps(run_maintenance(), indent=2))
+
+
+# a version comparison at import, CLI commands included, so that `flask sqlite init` still reports what it applies.
+# The ASGI entry point migrates in its lifespan, right after this import, so there is nothing to warn about
+with startup.phase('schema'):
+    if not startup.migrates:
+        check_schema()
+startup.ready()
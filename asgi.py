@@ -0,0 +1,39 @@
+import os
+# before everything else, so that STARTUP_REPORT times the imports that follow
+from yurikamome.startup import startup, warm_up
+# before the app is imported, which would otherwise warn that the database needs migrating
+startup.migrates = True
+import asyncio
+from a2wsgi import WSGIMiddleware
+from app import app, migrate_on_start
+from yurikamome.streaming import streaming_app, hub, STREAMING_PATH
+from yurikamome.background import background
+
+# threads only carry a request until its async view is handed to the event loop, so they are cheap
+WSGI_THREADS = int(os.getenv('WSGI_THREADS', '16'))
+
+flask_app = WSGIMiddleware(app, workers=WSGI_THREADS)
+
+
+async def application(scope, receive, send):
+    """
+    ASGI entry point. The server's event loop becomes the process-wide loop that async Flask views,
+    streaming and background work share. Streaming needs long-lived connections, which the loop holds
+    for next to nothing, so it is served natively here. Everything else is the Flask app.
+    """
+    background.adopt(asyncio.get_running_loop())
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # in place of a separate `flask sqlite init`, which imported the whole app a second time
+                migrate_on_start()
+                warm_up()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                hub.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] == 'websocket' or scope['path'].startswith(STREAMING_PATH):
+        return await streaming_app(scope, receive, send)
+    return await flask_app(scope, receive, send)
@@ -0,0 +1,65 @@
+"""
+Token -> session lookup latency as the apps table grows, before and after the apps indexes.
+
+    python benchmarks/bench_auth_lookup.py [rows ...]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SQLITE_DB', os.path.join(tempfile.mkdtemp(), 'bench.sqlite'))
+
+from yurikamome.helpers import connect, random_secret  # noqa: E402
+from yurikamome.migrations import migrate  # noqa: E402
+
+LOOKUPS = 2000
+LOOKUP_SQL = 'SELECT session_id FROM apps WHERE access_token = ?'
+SESSION_SQL = 'SELECT * FROM sessions WHERE session_id = ?'
+
+
+def populate(db, rows: int) -> list:
+    sessions = [(random_secret(), '{"ct0": "' + 'x' * 160 + '"}', f'user{i}') for i in range(max(rows // 100, 1))]
+    tokens = []
+    apps = []
+    for i in range(rows):
+        token = random_secret()
+        tokens.append(token)
+        apps.append((f'app{i}', 'client', None, 'urn:ietf:wg:oauth:2.0:oob', f'client{i}', 'secret', 'vapid',
+                     'read', sessions[i % len(sessions)][0], None, token))
+    with db:
+        db.executemany('INSERT INTO sessions (session_id, cookies, username) VALUES (?, ?, ?)', sessions)
+        db.executemany('INSERT INTO apps (id, name, website, redirect_uris, client_id, client_secret, vapid_key, '
+                       'scopes, session_id, authorization_code, access_token) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       apps)
+    return tokens
+
+
+def time_lookups(db, tokens: list, lookups: int = LOOKUPS) -> float:
+    sample = random.choices(tokens, k=lookups)
+    start = time.perf_counter()
+    for token in sample:
+        app_row = db.execute(LOOKUP_SQL, (token,)).fetchone()
+        db.execute(SESSION_SQL, (app_row['session_id'],)).fetchone()
+    return (time.perf_counter() - start) / lookups * 1e6
+
+
+def main(sizes: list):
+    print(f"{'rows':>8} {'no index (us)':>14} {'indexed (us)':>13} {'speedup':>8}")
+    for rows in sizes:
+        path = os.path.join(tempfile.mkdtemp(), f'apps-{rows}.sqlite')
+        db = connect(path)
+        migrate(db, target=1)
+        tokens = populate(db, rows)
+        # full scans get slow quickly, keep the unindexed pass short on big tables
+        before = time_lookups(db, tokens, LOOKUPS if rows <= 10000 else 100)
+        migrate(db)
+        after = time_lookups(db, tokens)
+        print(f'{rows:>8} {before:>14.1f} {after:>13.1f} {before / after:>7.0f}x')
+        db.close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000, 200000])
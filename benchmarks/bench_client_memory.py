@@ -0,0 +1,55 @@
+"""
+Memory a pooled twikit client takes: the RSS growth per client while --clients of them are pooled, each after a
+timeline call left its connection open, to check client_pool.CLIENT_MEMORY_KB against. Runs against
+benchmarks/fake_upstream.py, so the connections are plain HTTP; a TLS connection to Twitter takes ~40 KiB more.
+
+    python benchmarks/fake_upstream.py &
+    UPSTREAM_URL=http://localhost:8787 python benchmarks/bench_client_memory.py [--clients 128]
+"""
+import os
+import gc
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SQLITE_DB', os.path.join(tempfile.mkdtemp(), 'bench.sqlite'))
+
+from yurikamome.client_pool import ClientPool, CLIENT_MEMORY_KB  # noqa: E402
+
+
+def rss() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def cookies(number: int) -> str:
+    return json.dumps({'auth_token': f'token{number}', 'ct0': 'c' * 160, 'twid': f'u%3D{1000 + number}'})
+
+
+async def measure(count: int) -> float:
+    pool = ClientPool(maxsize=count + 1)
+    # the first client loads twikit and fills the shared SSL context, which every later one reuses
+    await pool.get('warm-up', cookies(0)).get_latest_timeline(count=20)
+    gc.collect()
+    before = rss()
+    for number in range(count):
+        await pool.get(f'session{number}', cookies(number)).get_latest_timeline(count=20)
+    gc.collect()
+    return (rss() - before) / count / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the memory of a pooled twikit client.')
+    parser.add_argument('--clients', type=int, default=128)
+    args = parser.parse_args()
+    if not os.getenv('UPSTREAM_URL'):
+        sys.exit('Set UPSTREAM_URL to a running benchmarks/fake_upstream.py')
+    per_client = asyncio.run(measure(args.clients))
+    print(f'{args.clients} pooled clients: {per_client:.0f} KiB each (CLIENT_MEMORY_KB is {CLIENT_MEMORY_KB})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Tweet -> encoded status conversion of a 100-tweet page: the original per-request conversion (and
+json.dumps) against the cached engine, both cold (empty caches, a page never seen before) and warm (the same page again,
+as when a client refreshes or another session shares the tweets). The cold path is held to COLD_TARGET and falls short
+of it: a page never seen before still has to build every status, account and attachment and encode them, which only
+the warm path gets to skip.
+
+    python benchmarks/bench_conversion.py
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SQLITE_DB', os.path.join(tempfile.mkdtemp(), 'bench.sqlite'))
+
+from benchmarks.fixtures import timeline_page  # noqa: E402
+from yurikamome import conversion, helpers  # noqa: E402
+from yurikamome.account_store import account_store  # noqa: E402
+from yurikamome.media import media_store  # noqa: E402
+
+# only the conversion is measured, media is processed by the media workers off the request path
+media_store.schedule = lambda media_id, path: None
+
+HOST_URL = 'https://yurikamome.example'
+ROUNDS = 200
+# speedup wanted on cold caches
+COLD_TARGET = 5
+
+
+def _reference_parse_twitter_timestamp(timestamp: str):
+    date_object = datetime.strptime(timestamp, '%a %b %d %H:%M:%S %z %Y')
+    # pytz.utc in the original, pytz is no longer a dependency
+    date_object = date_object.astimezone(timezone.utc)
+    return date_object.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _reference_media(media: dict) -> dict:
+    if media.get('type', '') == 'photo':
+        original_width = media.get('original_info', {}).get('height', 0)
+        original_height = media.get('original_info', {}).get('width', 0)
+        return {
+            'id': media.get('id_str', ''),
+            'type': 'image',
+            'url': media.get('media_url_https', ''),
+            'preview_url': media.get('media_url_https', ''),
+            'remote_url': media.get('media_url_https', ''),
+            'meta': {'original': {'width': original_width, 'height': original_height,
+                                  'size': f"{original_width}x{original_height}",
+                                  'aspect': original_width / original_height}},
+            'description': '',
+            'blurhash': '0'
+        }
+    return None
+
+
+def reference_tweet_to_status(tweet, host_url: str) -> dict:
+    """The conversion as it was before the engine, kept here as the baseline."""
+    user = tweet.user
+    screen_name = user.screen_name
+    avatar = user.profile_image_url
+    header = user.profile_banner_url if user.profile_banner_url else ''
+    return {
+        'id': tweet.id,
+        'uri': f'{host_url}/users/{screen_name}/statuses/{tweet.id}',
+        'created_at': _reference_parse_twitter_timestamp(tweet.created_at),
+        'account': {
+            'id': user.id, 'username': screen_name, 'acct': screen_name, 'url': f'{host_url}/@{screen_name}',
+            'display_name': user.name, 'note': '', 'avatar': avatar, 'avatar_static': avatar, 'header': header,
+            'header_static': header, 'locked': False, 'fields': [], 'emojis': [], 'bot': False, 'group': False,
+            'discoverable': False, 'created_at': _reference_parse_twitter_timestamp(user.created_at),
+            'last_status_at': '2023-02-01T00:00:00.000Z', 'status_count': 0, 'followers_count': 0,
+            'following_count': 0,
+        },
+        'content': tweet.full_text,
+        'visibility': 'public',
+        'sensitive': tweet.possibly_sensitive,
+        'spoiler_text': '',
+        'media_attachments': list(filter(lambda _: _, map(_reference_media, tweet.media if tweet.media else []))),
+        'mentions': [], 'tags': [], 'emojis': [],
+        'reblogs_count': tweet.retweet_count,
+        'favourites_count': tweet.favorite_count,
+        'replies_count': tweet.reply_count,
+        'url': f'{host_url}/@{screen_name}/statuses/{tweet.id}',
+        'in_reply_to_id': None, 'in_reply_to_account_id': None,
+        'reblog': reference_tweet_to_status(tweet.retweeted_tweet, host_url) if tweet.retweeted_tweet else None,
+        'poll': None, 'card': None,
+        'language': tweet.lang,
+        'text': tweet.full_text,
+        'edited_at': None
+    }
+
+
+def clear_caches():
+    conversion._status_cache.clear()
+    account_store._memory.clear()
+    helpers.parse_twitter_timestamp.cache_clear()
+
+
+def time_page(convert, page: list, before_round=None) -> float:
+    elapsed = 0.0
+    for _ in range(ROUNDS):
+        if before_round:
+            before_round()
+        start = time.perf_counter()
+        for tweet in page:
+            convert(tweet, HOST_URL)
+        elapsed += time.perf_counter() - start
+    return elapsed / ROUNDS * 1e3
+
+
+def main():
+    page = timeline_page(100)
+    reference = time_page(lambda tweet, host_url: json.dumps(reference_tweet_to_status(tweet, host_url)), page)
+    cold = time_page(conversion.tweet_to_status_json, page, before_round=clear_caches)
+    time_page(conversion.tweet_to_status_json, page)
+    warm = time_page(conversion.tweet_to_status_json, page)
+    print(f"{'100-tweet page':<22} {'ms/page':>8} {'speedup':>8}")
+    print(f"{'original':<22} {reference:>8.3f} {1:>7.1f}x")
+    print(f"{'engine, cold caches':<22} {cold:>8.3f} {reference / cold:>7.1f}x")
+    print(f"{'engine, warm caches':<22} {warm:>8.3f} {reference / warm:>7.1f}x")
+    if reference / cold < COLD_TARGET:
+        print(f'cold caches are short of the {COLD_TARGET}x target: a page never seen before is still converted and '
+              'encoded status by status, only the lookups around that work got cheaper')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Sending a 40-status timeline page built from encoded statuses: joined and compressed in one piece against
+streamed element by element. Reports the peak memory allocated while sending (tracemalloc) and the time
+until the first body chunk is ready.
+
+    python benchmarks/bench_responses.py
+"""
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SQLITE_DB', os.path.join(tempfile.mkdtemp(), 'bench.sqlite'))
+
+from flask import Flask  # noqa: E402
+from benchmarks.fixtures import timeline_page  # noqa: E402
+from yurikamome import conversion, responses  # noqa: E402
+from yurikamome.media import media_store  # noqa: E402
+
+media_store.schedule = lambda media_id, path: None
+
+HOST_URL = 'https://yurikamome.example'
+ROUNDS = 50
+
+
+def send(app: Flask, elements: list, streaming_min_size: int) -> tuple:
+    responses.STREAMING_MIN_SIZE = streaming_min_size
+    responses._compressed.clear()
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        tracemalloc.start()
+        start = time.perf_counter()
+        chunks = iter(responses.json_array_response(elements).response)
+        next(chunks)
+        first_chunk = time.perf_counter() - start
+        for _ in chunks:
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return first_chunk, peak
+
+
+def measure(app: Flask, elements: list, streaming_min_size: int) -> tuple:
+    results = [send(app, elements, streaming_min_size) for _ in range(ROUNDS)]
+    return (sum(first_chunk for first_chunk, _ in results) / ROUNDS * 1e3,
+            max(peak for _, peak in results) / 1024)
+
+
+def main():
+    app = Flask(__name__)
+    elements = [conversion.tweet_to_status_json(tweet, HOST_URL) for tweet in timeline_page(40)]
+    size = sum(map(len, elements)) / 1024
+    buffered = measure(app, elements, 2 ** 62)
+    streamed = measure(app, elements, 0)
+    print(f"{f'40 statuses, {size:.0f} KiB':<22} {'first chunk ms':>15} {'peak KiB':>9}")
+    print(f"{'buffered':<22} {buffered[0]:>15.3f} {buffered[1]:>9.0f}")
+    print(f"{'streamed':<22} {streamed[0]:>15.3f} {streamed[1]:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Cold start: the time a fresh interpreter takes to import the app, as a worker does before its first request,
+on a database that is already migrated. Exits with 1 when the median is over --target seconds.
+
+    python benchmarks/bench_startup.py [--runs 10] [--target 2]
+
+For where the time goes, run the app once with STARTUP_REPORT=1.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start(env: dict) -> float:
+    started_at = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import asgi'], cwd=ROOT, env=env, check=True)
+    return time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures how long the app takes to start.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--target', type=float, default=float(os.getenv('STARTUP_TARGET', '2')),
+                        help='seconds the median start may take')
+    args = parser.parse_args()
+
+    env = {**os.environ, 'HOST': 'localhost:5000', 'SCHEME': 'http', 'STARTUP_TARGET': '0',
+           'SQLITE_DB': os.path.join(tempfile.mkdtemp(), 'bench.sqlite')}
+    # as the server would when it starts on a new database
+    subprocess.run([sys.executable, '-c', 'from yurikamome.startup import startup; startup.migrates = True; '
+                    'import app; app.migrate_on_start()'], cwd=ROOT, env=env, check=True)
+    times = sorted(start(env) for _ in range(args.runs))
+    median = statistics.median(times)
+    print(f'{args.runs} starts: min {times[0] * 1e3:.0f} ms, median {median * 1e3:.0f} ms, '
+          f'max {times[-1] * 1e3:.0f} ms (target {args.target * 1e3:.0f} ms)')
+    if median > args.target:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
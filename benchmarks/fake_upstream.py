@@ -0,0 +1,269 @@
+"""
+A stand-in for Twitter to load test against, so that no real account gets locked. Run the app with
+UPSTREAM_URL (and MEDIA_UPSTREAM for images) pointing at it:
+
+    python benchmarks/fake_upstream.py [--port 8787] [--latency 150] [--error-rate 0.01] [--rate-limit 500]
+    UPSTREAM_URL=http://localhost:8787 MEDIA_UPSTREAM=http://localhost:8787 flask run
+
+It replays the responses recorded in --recordings (one directory per operation, e.g. HomeLatestTimeline/, cycled
+through in order) and makes up the rest: timelines of fixture tweets with a new tweet every --tweet-interval seconds,
+the logged in user, and a small image for every media path. Latency, 5xx errors and 429s are injected on top.
+
+To record, run it with --record while the app talks to it with a real session. Requests are forwarded to the host
+named in X-Upstream-Host and the JSON responses saved, without their cookies. Recordings hold other people's
+tweets, keep them out of git (benchmarks/recordings/ is ignored).
+
+Logging in is never recorded or replayed, benchmarks/loadgen.py creates its sessions straight in the database instead.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import httpx
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import tweet_payload, user_payload  # noqa: E402
+
+RECORDINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings')
+TWITTER_EPOCH = 1288834974657
+RATE_LIMIT_WINDOW = 900
+# response headers worth keeping in a recording, cookies are never among them
+RECORDED_HEADERS = ('content-type', 'x-rate-limit-limit', 'x-rate-limit-remaining', 'x-rate-limit-reset')
+TIMELINES = ('HomeLatestTimeline', 'HomeTimeline', 'SearchTimeline')
+# the user every session is logged in as, timeline tweets are by the next 50 ids
+USER_ID = 1000
+
+
+def snowflake(seconds: float) -> int:
+    return int(seconds * 1000 - TWITTER_EPOCH) << 22
+
+
+def _placeholder_image() -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (1536, 2048), (90, 140, 200)).save(buffer, 'JPEG', quality=60)
+    return buffer.getvalue()
+
+
+class Upstream:
+    """What the fake answers, kept apart from the HTTP handler."""
+
+    def __init__(self, args):
+        self.args = args
+        self._recordings = {}  # type: dict[str, list[dict]]
+        self._replayed = defaultdict(int)  # type: dict[str, int]
+        # (cookies, operation) -> (window start, requests)
+        self._windows = {}  # type: dict[tuple[str, str], tuple[float, int]]
+        self._lock = threading.Lock()
+        self._image = _placeholder_image()
+        if not args.record and os.path.isdir(args.recordings):
+            for operation in os.listdir(args.recordings):
+                directory = os.path.join(args.recordings, operation)
+                names = sorted(os.listdir(directory), key=lambda name: int(name.split('.')[0]))
+                self._recordings[operation] = [json.load(open(os.path.join(directory, name))) for name in names]
+            print(f'replaying {sum(map(len, self._recordings.values()))} responses of '
+                  f'{len(self._recordings)} operations', flush=True)
+
+    def rate_limit(self, token: str, operation: str) -> tuple:
+        """(limit, remaining, reset) of the caller's bucket for `operation` after this request, -1 remaining once over."""
+        now = time.time()
+        with self._lock:
+            started_at, used = self._windows.get((token, operation), (now, 0))
+            if now - started_at >= RATE_LIMIT_WINDOW:
+                started_at, used = now, 0
+            used += 1
+            self._windows[(token, operation)] = (started_at, used)
+        return self.args.rate_limit, max(self.args.rate_limit - used, -1), int(started_at + RATE_LIMIT_WINDOW)
+
+    def replay(self, operation: str):
+        recordings = self._recordings.get(operation)
+        if not recordings:
+            return None
+        with self._lock:
+            recording = recordings[self._replayed[operation] % len(recordings)]
+            self._replayed[operation] += 1
+        return recording
+
+    def record(self, operation: str, status: int, headers: httpx.Headers, content: bytes):
+        try:
+            body = json.loads(content)
+        except ValueError:
+            return
+        directory = os.path.join(self.args.recordings, operation)
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            number = len(os.listdir(directory))
+            with open(os.path.join(directory, f'{number}.json'), 'w') as f:
+                json.dump({'status': status, 'body': body,
+                           'headers': {name: headers[name] for name in RECORDED_HEADERS if name in headers}}, f)
+
+    def timeline(self, operation: str, variables: dict) -> dict:
+        """A page of fixture tweets below the cursor, or the newest page. The newest tweet changes every --tweet-interval."""
+        count = min(int(variables.get('count', 20)), 100)
+        interval = self.args.tweet_interval
+        cursor = variables.get('cursor')
+        if cursor and cursor.startswith('bottom:'):
+            top = int(cursor[len('bottom:'):]) - 1
+        else:
+            top = int(time.time() / interval)
+        entries = []
+        for tick in range(top, top - count, -1):
+            tweet_id = snowflake(tick * interval)
+            user_id = USER_ID + tick % 50
+            if tick % 5 == 0:
+                payload = tweet_payload(tweet_id, user_id,
+                                        retweet_of=tweet_payload(tweet_id - 500000, USER_ID + 100 + tick % 50,
+                                                                 photos=1 + tick % 4))
+            elif tick % 3 == 0:
+                payload = tweet_payload(tweet_id, user_id, photos=1 + tick % 4)
+            else:
+                payload = tweet_payload(tweet_id, user_id)
+            payload['__typename'] = 'Tweet'
+            entries.append({
+                'entryId': f'tweet-{tweet_id}',
+                'sortIndex': str(tweet_id),
+                'content': {'entryType': 'TimelineTimelineItem',
+                            'itemContent': {'itemType': 'TimelineTweet', 'tweet_results': {'result': payload}}},
+            })
+        entries.append({'entryId': f'cursor-top-{top}',
+                        'content': {'entryType': 'TimelineTimelineCursor', 'value': f'top:{top}', 'cursorType': 'Top'}})
+        entries.append({'entryId': f'cursor-bottom-{top - count + 1}',
+                        'content': {'entryType': 'TimelineTimelineCursor', 'value': f'bottom:{top - count + 1}',
+                                    'cursorType': 'Bottom'}})
+        instructions = [{'type': 'TimelineAddEntries', 'entries': entries}]
+        if operation == 'SearchTimeline':
+            return {'data': {'search_by_raw_query': {'search_timeline': {'timeline': {'instructions': instructions}}}}}
+        return {'data': {'home': {'home_timeline_urt': {'instructions': instructions}}}}
+
+    def made_up(self, operation: str, variables: dict):
+        """The answer to an operation nothing was recorded for, or None when it is not known."""
+        if operation in TIMELINES:
+            return self.timeline(operation, variables)
+        if operation == 'settings.json':
+            return {'screen_name': f'user{USER_ID}', 'language': 'en'}
+        if operation in ('UserByScreenName', 'UserByRestId'):
+            user = user_payload(USER_ID, f'user{USER_ID}')
+            user['__typename'] = 'User'
+            return {'data': {'user': {'result': user}}}
+        if operation == 'user_state.json':
+            return {'userState': 'normal'}
+        return None
+
+
+def _variables(method: str, query: str, body: bytes) -> dict:
+    # GraphQL GETs carry the variables JSON encoded in the query string, POSTs in a JSON body
+    if method == 'GET':
+        return json.loads(parse_qs(query).get('variables', ['{}'])[0])
+    try:
+        return json.loads(body).get('variables') or {}
+    except ValueError:
+        return {}
+
+
+def handler(upstream: Upstream):
+    args = upstream.args
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.answer()
+
+        def do_POST(self):
+            self.answer()
+
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                super().log_message(format, *log_args)
+
+        def send(self, status: int, body: bytes, content_type: str = 'application/json', headers: dict = None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def answer(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            url = urlsplit(self.path)
+            host = self.headers.get('X-Upstream-Host')
+            if host is None:
+                # MEDIA_UPSTREAM requests for pbs.twimg.com paths
+                time.sleep(args.latency / 1000)
+                return self.send(200, upstream._image, 'image/jpeg')
+
+            operation = url.path.rsplit('/', 1)[-1]
+            if args.record:
+                return self.forward(host, operation, body)
+
+            time.sleep(max(random.gauss(args.latency, args.jitter), 0) / 1000)
+            if random.random() < args.error_rate:
+                return self.send(503, b'{"errors":[{"code":130,"message":"Over capacity"}]}')
+            token = self.headers.get('Cookie', '')
+            limit, remaining, reset = upstream.rate_limit(token, operation)
+            rate_headers = {'x-rate-limit-limit': str(limit), 'x-rate-limit-remaining': str(max(remaining, 0)),
+                            'x-rate-limit-reset': str(reset)}
+            if remaining < 0 or random.random() < args.rate_limited_rate:
+                return self.send(429, b'Rate limit exceeded', 'text/plain',
+                             {**rate_headers, 'x-rate-limit-remaining': '0'})
+
+            recording = upstream.replay(operation)
+            if recording is not None:
+                return self.send(recording['status'], json.dumps(recording['body']).encode(),
+                                 recording['headers'].get('content-type', 'application/json'),
+                                 {**rate_headers, **recording['headers']})
+            made_up = upstream.made_up(operation, _variables(self.command, url.query, body))
+            if made_up is None:
+                return self.send(404, b'{"errors":[{"code":34,"message":"Sorry, that page does not exist."}]}')
+            self.send(200, json.dumps(made_up).encode(), headers=rate_headers)
+
+        def forward(self, host: str, operation: str, body: bytes):
+            headers = {name: value for name, value in self.headers.items()
+                       if name.lower() not in ('host', 'x-upstream-host', 'content-length', 'accept-encoding',
+                                               'connection')}
+            resp = httpx.request(self.command, f'https://{host}{self.path}', headers=headers, content=body,
+                                 timeout=30)
+            upstream.record(operation, resp.status_code, resp.headers, resp.content)
+            forwarded = {name: value for name, value in resp.headers.items()
+                         if name.lower() not in ('content-length', 'content-encoding', 'transfer-encoding',
+                                                 'connection', 'content-type')}
+            self.send(resp.status_code, resp.content, resp.headers.get('content-type', 'application/json'), forwarded)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stands in for Twitter in load tests.')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--recordings', default=RECORDINGS, help='directory of recorded responses')
+    parser.add_argument('--record', action='store_true', help='forward to Twitter and record the responses')
+    parser.add_argument('--latency', type=float, default=150, help='mean added latency in milliseconds')
+    parser.add_argument('--jitter', type=float, default=50, help='standard deviation of the latency')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with a 503')
+    parser.add_argument('--rate-limit', type=int, default=500,
+                        help=f'requests per session and operation every {RATE_LIMIT_WINDOW} seconds before 429s')
+    parser.add_argument('--rate-limited-rate', type=float, default=0,
+                        help='fraction of requests answered with a 429 regardless of the budget')
+    parser.add_argument('--tweet-interval', type=float, default=10, help='seconds between made up tweets')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), handler(Upstream(args)))
+    server.daemon_threads = True
+    print(f'fake upstream on http://127.0.0.1:{args.port}', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
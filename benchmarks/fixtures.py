@@ -0,0 +1,148 @@
+"""
+Builds twikit Tweet objects from GraphQL-shaped payloads without any network access.
+"""
+import copy
+from twikit import Tweet, User
+
+
+def user_payload(user_id: int, screen_name: str) -> dict:
+    return {
+        'rest_id': str(user_id),
+        'is_blue_verified': False,
+        'legacy': {
+            'created_at': 'Tue Mar 21 20:50:14 +0000 2006',
+            'name': screen_name.title(),
+            'screen_name': screen_name,
+            'description': 'Bio of ' + screen_name,
+            'location': '',
+            'url': '',
+            'entities': {'description': {'urls': []}},
+            'profile_image_url_https': f'https://pbs.twimg.com/profile_images/{user_id}/avatar_normal.jpg',
+            'profile_banner_url': f'https://pbs.twimg.com/profile_banners/{user_id}/1700000000',
+            'pinned_tweet_ids_str': [],
+            'verified': False,
+            'possibly_sensitive': False,
+            'can_dm': False,
+            'can_media_tag': True,
+            'want_retweets': True,
+            'default_profile': True,
+            'default_profile_image': False,
+            'has_custom_timelines': False,
+            'followers_count': 1234 + user_id % 1000,
+            'fast_followers_count': 0,
+            'normal_followers_count': 1234,
+            'friends_count': 321,
+            'favourites_count': 4567,
+            'listed_count': 12,
+            'media_count': 89,
+            'statuses_count': 9876,
+            'is_translator': False,
+            'translator_type': 'none',
+            'withheld_in_countries': [],
+            'protected': False,
+        },
+    }
+
+
+def photo_payload(media_id: int) -> dict:
+    return {
+        'id_str': str(media_id),
+        'type': 'photo',
+        'media_url_https': f'https://pbs.twimg.com/media/F{media_id}.jpg',
+        'original_info': {'width': 1536, 'height': 2048},
+    }
+
+
+def video_payload(media_id: int) -> dict:
+    return {
+        'id_str': str(media_id),
+        'type': 'video',
+        'media_url_https': f'https://pbs.twimg.com/ext_tw_video_thumb/{media_id}/pu/img/poster.jpg',
+        'original_info': {'width': 1280, 'height': 720},
+        'video_info': {
+            'aspect_ratio': [16, 9],
+            'duration_millis': 30033,
+            'variants': [
+                {'content_type': 'application/x-mpegURL',
+                 'url': f'https://video.twimg.com/ext_tw_video/{media_id}/pu/pl/playlist.m3u8'},
+                {'bitrate': 256000, 'content_type': 'video/mp4',
+                 'url': f'https://video.twimg.com/ext_tw_video/{media_id}/pu/vid/480x270/a.mp4'},
+                {'bitrate': 832000, 'content_type': 'video/mp4',
+                 'url': f'https://video.twimg.com/ext_tw_video/{media_id}/pu/vid/640x360/b.mp4'},
+                {'bitrate': 2176000, 'content_type': 'video/mp4',
+                 'url': f'https://video.twimg.com/ext_tw_video/{media_id}/pu/vid/1280x720/c.mp4'},
+            ],
+        },
+    }
+
+
+def tweet_payload(tweet_id: int, user_id: int, photos: int = 0, retweet_of: dict = None, videos: int = 0) -> dict:
+    seconds = tweet_id % 60
+    legacy = {
+        'created_at': f'Sat Mar 16 23:{tweet_id // 60 % 60:02d}:{seconds:02d} +0000 2024',
+        'full_text': f'Tweet number {tweet_id} with a little bit of text to make it look real https://t.co/abc',
+        'lang': 'en',
+        'is_quote_status': False,
+        'quote_count': tweet_id % 7,
+        'reply_count': tweet_id % 11,
+        'favorite_count': tweet_id % 97,
+        'favorited': False,
+        'retweet_count': tweet_id % 13,
+        'possibly_sensitive': False,
+        'entities': {'urls': [], 'hashtags': [{'text': 'bench'}]},
+    }
+    if photos:
+        legacy['entities']['media'] = [photo_payload(tweet_id * 10 + i) for i in range(photos)]
+    if videos:
+        # videos and every photo past the first are only in extended_entities
+        legacy['extended_entities'] = {'media': legacy['entities'].get('media', []) +
+                                                [video_payload(tweet_id * 10 + photos + i) for i in range(videos)]}
+    if retweet_of:
+        legacy['retweeted_status_result'] = {'result': retweet_of}
+    return {
+        'rest_id': str(tweet_id),
+        'legacy': legacy,
+        'edit_control': {'editable_until_msecs': '1710630007000', 'is_edit_eligible': False, 'edits_remaining': '5'},
+        'views': {'count': '100', 'state': 'EnabledWithCount'},
+        'core': {'user_results': {'result': user_payload(user_id, f'user{user_id}')}},
+    }
+
+
+def tweet_from_payload(payload: dict) -> Tweet:
+    # Tweet pops nested results out of the payload it is given
+    payload = copy.deepcopy(payload)
+    return Tweet(None, payload, User(None, payload['core']['user_results']['result']))
+
+
+def timeline_page(size: int = 100, first_id: int = 1769000000000000000, users: int = 25) -> list:
+    """A mix like a real Following timeline: mostly plain tweets, some with photos, some retweets."""
+    tweets = []
+    for i in range(size):
+        tweet_id = first_id - i
+        user_id = 1000 + i % users
+        if i % 5 == 0:
+            original = tweet_payload(tweet_id - 500000, 5000 + i % users, photos=1 + i % 4)
+            payload = tweet_payload(tweet_id, user_id, retweet_of=original)
+        elif i % 3 == 0:
+            payload = tweet_payload(tweet_id, user_id, photos=1 + i % 4)
+        else:
+            payload = tweet_payload(tweet_id, user_id)
+        tweets.append(tweet_from_payload(payload))
+    return tweets
+
+
+def plain_page(size: int = 20, first_id: int = 1768000000000000000, users: int = 25) -> list:
+    return [tweet_from_payload(tweet_payload(first_id - i, 1000 + i % users)) for i in range(size)]
+
+
+def retweet_page(size: int = 20, first_id: int = 1767000000000000000, users: int = 25) -> list:
+    return [tweet_from_payload(tweet_payload(first_id - i, 1000 + i % users,
+                                             retweet_of=tweet_payload(first_id - i - 500000, 5000 + i % users)))
+            for i in range(size)]
+
+
+def media_page(size: int = 20, first_id: int = 1766000000000000000, users: int = 25) -> list:
+    """Four photos or a photo and a video on every tweet."""
+    return [tweet_from_payload(tweet_payload(first_id - i, 1000 + i % users, photos=4 if i % 2 else 1,
+                                             videos=0 if i % 2 else 1))
+            for i in range(size)]
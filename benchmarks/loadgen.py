@@ -0,0 +1,190 @@
+"""
+Simulates Mastodon clients against a running app: each one registers an app, goes through the authorization code
+grant, checks its credentials and then polls the home timeline, now and then scrolling down a page. Reports
+throughput, latency percentiles per step and the server's memory, to size workers and the fly.toml VM.
+
+Point the app at benchmarks/fake_upstream.py so that no real account is involved, and run this next to it with the
+same SQLITE_DB: logging in to Twitter is skipped by creating the sessions straight in the database.
+
+    python benchmarks/fake_upstream.py &
+    UPSTREAM_URL=http://localhost:8787 MEDIA_UPSTREAM=http://localhost:8787 flask run &
+    python benchmarks/loadgen.py --url http://localhost:5000 --clients 50 --duration 120 --pid $!
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+from urllib.parse import urlsplit, parse_qs
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# like the custom scheme callbacks of mobile clients
+REDIRECT_URI = 'loadgen://oauth'
+SCOPES = 'read write'
+# how often RSS is sampled while the test runs
+RSS_INTERVAL = 1
+
+
+class Stats:
+    """Latencies and failures per step, e.g. 'token' or 'home'."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)  # type: dict[str, list[float]]
+        self.failures = defaultdict(int)  # type: dict[str, int]
+        self.statuses = defaultdict(int)  # type: dict[int, int]
+
+    async def request(self, step: str, http: httpx.AsyncClient, method: str, url: str, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            resp = await http.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.failures[step] += 1
+            self.statuses[0] += 1
+            return None
+        self.latencies[step].append(time.perf_counter() - started_at)
+        self.statuses[resp.status_code] += 1
+        if resp.status_code >= 400:
+            self.failures[step] += 1
+            return None
+        return resp
+
+
+def create_sessions(count: int) -> list:
+    """Sessions with made up cookies, which only the fake upstream accepts."""
+    from yurikamome.helpers import create_session, random_secret
+    sessions = []
+    for i in range(count):
+        session_id = random_secret()
+        cookies = {'auth_token': random_secret(), 'ct0': random_secret() * 8, 'twid': f'u%3D{1000 + i}'}
+        create_session(session_id, json.dumps(cookies), f'loadgen{i}')
+        sessions.append(session_id)
+    return sessions
+
+
+async def authorize(http: httpx.AsyncClient, stats: Stats, session_id: str, number: int):
+    """Registers an app and goes through the code grant as a client would. Returns the access token."""
+    resp = await stats.request('apps', http, 'POST', '/api/v1/apps', data={
+        'client_name': f'loadgen {number}', 'redirect_uris': REDIRECT_URI, 'scopes': SCOPES})
+    if resp is None:
+        return None
+    app = resp.json()
+    params = {'response_type': 'code', 'client_id': app['client_id'], 'redirect_uri': REDIRECT_URI, 'scope': SCOPES}
+    session_cookie = {'Cookie': f'session_id={session_id}'}
+    if await stats.request('authorize', http, 'GET', '/oauth/authorize', params=params, headers=session_cookie) is None:
+        return None
+    resp = await stats.request('authorize', http, 'POST', '/oauth/authorize', headers=session_cookie, data={
+        'client_id': app['client_id'], 'redirect_uri': REDIRECT_URI, 'scope': SCOPES})
+    if resp is None or 'location' not in resp.headers:
+        return None
+    code = parse_qs(urlsplit(resp.headers['location']).query)['code'][0]
+    resp = await stats.request('token', http, 'POST', '/oauth/token', data={
+        'grant_type': 'authorization_code', 'code': code, 'client_id': app['client_id'],
+        'client_secret': app['client_secret'], 'redirect_uri': REDIRECT_URI, 'scope': SCOPES})
+    return resp.json()['access_token'] if resp is not None else None
+
+
+async def simulate(http: httpx.AsyncClient, stats: Stats, session_id: str, number: int, args, stop_at: float):
+    # clients do not all start at the same moment
+    await asyncio.sleep(random.uniform(0, args.ramp_up))
+    access_token = await authorize(http, stats, session_id, number)
+    if access_token is None:
+        return
+    headers = {'Authorization': f'Bearer {access_token}'}
+    await stats.request('verify_credentials', http, 'GET', '/api/v1/accounts/verify_credentials', headers=headers)
+    newest_id = None
+    while time.monotonic() < stop_at:
+        params = {'limit': args.limit}
+        if newest_id is not None:
+            params['since_id'] = newest_id
+        resp = await stats.request('home', http, 'GET', '/api/v1/timelines/home', params=params, headers=headers)
+        statuses = resp.json() if resp is not None else []
+        if statuses:
+            newest_id = statuses[0]['id']
+            if random.random() < args.scroll:
+                await stats.request('home:older', http, 'GET', '/api/v1/timelines/home', headers=headers,
+                                    params={'limit': args.limit, 'max_id': statuses[-1]['id']})
+        await asyncio.sleep(random.uniform(0.5, 1.5) * args.interval)
+
+
+def rss(pid: int) -> int:
+    """Resident memory of a process and its children (e.g. gunicorn workers) in bytes."""
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                total += next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+            with open(f'/proc/{pid}/task/{pid}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except (OSError, StopIteration):
+            pass
+    return total
+
+
+async def sample_rss(pid: int, samples: list, stop_at: float):
+    while time.monotonic() < stop_at:
+        samples.append(rss(pid))
+        await asyncio.sleep(RSS_INTERVAL)
+
+
+def percentile(values: list, fraction: float) -> float:
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(stats: Stats, elapsed: float, rss_samples: list):
+    total = sum(map(len, stats.latencies.values())) + sum(stats.failures.values())
+    print(f'{total} requests in {elapsed:.1f}s, {total / elapsed:.1f} requests/s')
+    print(f"{'step':<20} {'requests':>9} {'failed':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for step, latencies in sorted(stats.latencies.items()):
+        latencies = sorted(latencies)
+        print(f'{step:<20} {len(latencies):>9} {stats.failures[step]:>7} '
+              f'{percentile(latencies, .5) * 1e3:>8.1f} {percentile(latencies, .9) * 1e3:>8.1f} '
+              f'{percentile(latencies, .99) * 1e3:>8.1f} {latencies[-1] * 1e3:>8.1f}')
+    print('statuses:', ', '.join(f'{status or "error"}: {count}' for status, count in sorted(stats.statuses.items())))
+    if rss_samples:
+        print(f'server RSS: start {rss_samples[0] / 2 ** 20:.0f} MiB, peak {max(rss_samples) / 2 ** 20:.0f} MiB, '
+              f'end {rss_samples[-1] / 2 ** 20:.0f} MiB')
+
+
+async def run(args):
+    sessions = create_sessions(args.users or args.clients)
+    stats = Stats()
+    rss_samples = []
+    started_at = time.monotonic()
+    stop_at = started_at + args.duration
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as http:
+        tasks = [simulate(http, stats, sessions[i % len(sessions)], i, args, stop_at) for i in range(args.clients)]
+        if args.pid:
+            tasks.append(sample_rss(args.pid, rss_samples, stop_at))
+        await asyncio.gather(*tasks)
+    report(stats, time.monotonic() - started_at, rss_samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates Mastodon clients against a running app.')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--users', type=int, help='sessions the clients are spread over, one per client by default')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of polling')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds over which the clients start')
+    parser.add_argument('--interval', type=float, default=10, help='mean seconds between timeline polls')
+    parser.add_argument('--limit', type=int, default=20, help='statuses per timeline page')
+    parser.add_argument('--scroll', type=float, default=0.2, help='chance of loading the next page after a poll')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--pid', type=int, help='server process to report the memory of')
+    args = parser.parse_args()
+    if not os.getenv('SQLITE_DB'):
+        parser.error('SQLITE_DB must be the database of the app under test')
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""
+The hot paths of a request, measured on fixture tweets without any network access: tweet conversion, timestamp
+parsing, media attachments, the token -> session lookup as the apps table grows, and whole timeline pages rendered
+into a response body. Reports throughput and the memory each call allocates (the tracemalloc peak of one call).
+
+    python benchmarks/suite.py [-k FILTER] [--save NAME] [--compare NAME] [--threshold PERCENT]
+
+--save writes the results to benchmarks/baselines/NAME.json, --compare shows every case against a saved baseline
+and exits with 1 when one of them got slower by more than --threshold percent (default 10). Baselines only mean
+something on the machine they were taken on, so they are not committed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SQLITE_DB', os.path.join(tempfile.mkdtemp(), 'bench.sqlite'))
+
+from flask import Flask  # noqa: E402
+from benchmarks.fixtures import plain_page, retweet_page, media_page, timeline_page, photo_payload, \
+    video_payload  # noqa: E402
+from benchmarks.bench_auth_lookup import populate  # noqa: E402
+from yurikamome import conversion, helpers  # noqa: E402
+from yurikamome.account_store import account_store  # noqa: E402
+from yurikamome.media import media_store, video_store  # noqa: E402
+from yurikamome.migrations import migrate  # noqa: E402
+from yurikamome.cache_backend import cache  # noqa: E402
+from yurikamome.mastodon_timelines_blueprint import _statuses_response  # noqa: E402
+
+# only the conversion is measured, media is processed by the media workers off the request path
+media_store.schedule = lambda media_id, path: None
+
+HOST_URL = 'https://yurikamome.example'
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+# every case runs for at least this many seconds per round, and the best of ROUNDS rounds counts
+MIN_ROUND_TIME = 0.2
+ROUNDS = 5
+
+# case name -> function that sets the case up and returns (run, operations per run)
+CASES = {}
+
+
+def case(name: str):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def clear_caches():
+    conversion._status_cache.clear()
+    account_store._memory.clear()
+    video_store._memory.clear()
+    video_store._selected.clear()
+    helpers.parse_twitter_timestamp.cache_clear()
+
+
+def _conversion(page: list, cold: bool):
+    def run():
+        if cold:
+            clear_caches()
+        for tweet in page:
+            conversion.tweet_to_status_json(tweet, HOST_URL)
+    return run, len(page)
+
+
+for _kind, _page in (('plain', plain_page), ('retweet', retweet_page), ('media', media_page)):
+    # a page never seen before, and the same page again as when a client refreshes
+    case(f'conversion/{_kind}/cold')(lambda page=_page: _conversion(page(), cold=True))
+    case(f'conversion/{_kind}/warm')(lambda page=_page: _conversion(page(), cold=False))
+
+
+@case('timestamp/utc')
+def _timestamp_utc():
+    timestamps = [f'Sat Mar 16 23:{i // 60:02d}:{i % 60:02d} +0000 2024' for i in range(1000)]
+    parse = helpers.parse_twitter_timestamp.__wrapped__
+
+    def run():
+        for timestamp in timestamps:
+            parse(timestamp)
+    return run, len(timestamps)
+
+
+@case('timestamp/offset')
+def _timestamp_offset():
+    # never sent by Twitter as far as we know, but the fallback has to work
+    timestamps = [f'Sat Mar 16 23:{i // 60:02d}:{i % 60:02d} +0900 2024' for i in range(1000)]
+    parse = helpers.parse_twitter_timestamp.__wrapped__
+
+    def run():
+        for timestamp in timestamps:
+            parse(timestamp)
+    return run, len(timestamps)
+
+
+@case('timestamp/cached')
+def _timestamp_cached():
+    timestamps = [f'Sat Mar 16 23:{i // 60:02d}:{i % 60:02d} +0000 2024' for i in range(1000)]
+
+    def run():
+        for timestamp in timestamps:
+            helpers.parse_twitter_timestamp(timestamp)
+    return run, len(timestamps)
+
+
+@case('media/photo')
+def _media_photo():
+    photos = [photo_payload(1769000000000000000 + i) for i in range(100)]
+
+    def run():
+        for photo in photos:
+            conversion.twitter_media_to_media_attachment(photo, HOST_URL)
+    return run, len(photos)
+
+
+@case('media/video')
+def _media_video():
+    videos = [video_payload(1769000000000000000 + i) for i in range(100)]
+
+    def run():
+        for video in videos:
+            conversion.twitter_media_to_media_attachment(video, HOST_URL)
+    return run, len(videos)
+
+
+def _auth_lookup(rows: int, cached: bool):
+    db = helpers.connect(os.path.join(tempfile.mkdtemp(), f'apps-{rows}.sqlite'))
+    migrate(db)
+    tokens = random.choices(populate(db, rows), k=1000)
+    # outside of a request, query_db reads through the thread's own connection
+    helpers._thread_db.db = db
+
+    def run():
+        for token in tokens:
+            if not cached:
+                cache.clear()
+            helpers.query_session_by_access_token(token)
+    return run, len(tokens)
+
+
+for _rows in (1000, 10000, 100000):
+    case(f'auth/sqlite/{_rows}')(lambda rows=_rows: _auth_lookup(rows, cached=False))
+case('auth/cached')(lambda: _auth_lookup(1000, cached=True))
+
+
+def _page(size: int, encoding: str):
+    """A page converted from tweets never seen before and sent as the home timeline would send it."""
+    app = Flask(__name__)
+    tweets = timeline_page(size)
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+
+    def run():
+        clear_caches()
+        statuses = [(int(tweet.id), conversion.tweet_to_status_json(tweet, HOST_URL)) for tweet in tweets]
+        with app.test_request_context(headers=headers):
+            for _ in _statuses_response(statuses, f'{HOST_URL}/api/v1/timelines/home').response:
+                pass
+    return run, 1
+
+
+for _size in (20, 40, 100):
+    case(f'page/{_size}')(lambda size=_size: _page(size, ''))
+    case(f'page/{_size}/gzip')(lambda size=_size: _page(size, 'gzip'))
+
+
+def measure(run, ops: int) -> dict:
+    run()
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        if time.perf_counter() - start >= MIN_ROUND_TIME / 4:
+            break
+        calls *= 2
+    best = float('inf')
+    for _ in range(ROUNDS):
+        elapsed = 0.0
+        rounds = 0
+        while elapsed < MIN_ROUND_TIME:
+            start = time.perf_counter()
+            for _ in range(calls):
+                run()
+            elapsed += time.perf_counter() - start
+            rounds += calls
+        best = min(best, elapsed / rounds)
+
+    tracemalloc.start()
+    run()
+    allocated = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'ops_per_second': ops / best, 'us_per_op': best / ops * 1e6, 'allocated_bytes_per_op': allocated / ops}
+
+
+def load_baseline(name: str) -> dict:
+    with open(os.path.join(BASELINES, f'{name}.json')) as f:
+        return json.load(f)['results']
+
+
+def save_baseline(name: str, results: dict):
+    os.makedirs(BASELINES, exist_ok=True)
+    with open(os.path.join(BASELINES, f'{name}.json'), 'w') as f:
+        json.dump({
+            'taken_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'machine': platform.platform(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the hot paths of a request.')
+    parser.add_argument('-k', dest='filter', default='', help='only run the cases whose name contains this')
+    parser.add_argument('--save', metavar='NAME', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='NAME', help='compare the results against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=10, help='slowdown in percent counted as a regression')
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.compare) if args.compare else {}
+    migrate(helpers.connect())
+    results = {}
+    regressions = []
+    print(f"{'case':<26} {'ops/s':>12} {'us/op':>10} {'B/op':>9}" + (f" {'vs ' + args.compare:>12}" if baseline else ''))
+    for name, setup in CASES.items():
+        if args.filter not in name:
+            continue
+        result = results[name] = measure(*setup())
+        line = (f"{name:<26} {result['ops_per_second']:>12,.0f} {result['us_per_op']:>10.2f} "
+                f"{result['allocated_bytes_per_op']:>9,.0f}")
+        if name in baseline:
+            change = (baseline[name]['us_per_op'] / result['us_per_op'] - 1) * 100
+            line += f' {change:>+11.1f}%'
+            if change < -args.threshold:
+                regressions.append(name)
+                line += '  slower'
+        print(line, flush=True)
+
+    if args.save:
+        save_baseline(args.save, results)
+    if regressions:
+        print(f"{len(regressions)} case(s) slower than {args.compare} by more than {args.threshold:g}%: "
+              f"{', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
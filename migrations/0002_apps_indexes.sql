@@ -0,0 +1,3 @@
+CREATE UNIQUE INDEX IF NOT EXISTS `apps_client_id` ON `apps` (`client_id`);
+CREATE UNIQUE INDEX IF NOT EXISTS `apps_access_token` ON `apps` (`access_token`);
+CREATE INDEX IF NOT EXISTS `apps_session_id` ON `apps` (`session_id`);
@@ -0,0 +1,23 @@
+-- converted statuses per session, keyed so that Mastodon max_id/since_id/min_id windows are range scans
+CREATE TABLE IF NOT EXISTS `timeline_statuses` (
+    `session_id` TEXT NOT NULL,
+    `timeline` TEXT NOT NULL,
+    `status_id` INTEGER NOT NULL,
+    `status` TEXT NOT NULL,
+    `created_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`session_id`, `timeline`, `status_id`)
+) WITHOUT ROWID;
+-- statuses older than `status_id` have not been fetched yet, upstream continues at `cursor`
+CREATE TABLE IF NOT EXISTS `timeline_gaps` (
+    `session_id` TEXT NOT NULL,
+    `timeline` TEXT NOT NULL,
+    `status_id` INTEGER NOT NULL,
+    `cursor` TEXT NOT NULL,
+    PRIMARY KEY (`session_id`, `timeline`, `status_id`)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS `timelines` (
+    `session_id` TEXT NOT NULL,
+    `timeline` TEXT NOT NULL,
+    `refreshed_at` REAL NOT NULL,
+    PRIMARY KEY (`session_id`, `timeline`)
+);
@@ -0,0 +1,7 @@
+-- Mastodon account JSON per Twitter user, filled from every user twikit hands us
+CREATE TABLE IF NOT EXISTS `accounts` (
+    `user_id` TEXT PRIMARY KEY NOT NULL,
+    `account` TEXT NOT NULL,
+    `fetched_at` REAL NOT NULL
+);
+ALTER TABLE `sessions` ADD COLUMN `user_id` TEXT;
@@ -0,0 +1,10 @@
+-- dimensions and blurhash of media served through the /media proxy, worked out once per media id
+CREATE TABLE IF NOT EXISTS `media` (
+    `media_id` TEXT PRIMARY KEY NOT NULL,
+    `width` INTEGER NOT NULL,
+    `height` INTEGER NOT NULL,
+    `small_width` INTEGER NOT NULL,
+    `small_height` INTEGER NOT NULL,
+    `blurhash` TEXT,
+    `processed_at` REAL NOT NULL
+);
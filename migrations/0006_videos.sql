@@ -0,0 +1,5 @@
+-- MP4 variants of videos and GIFs, so /media/video can pick one long after the tweet was converted
+CREATE TABLE IF NOT EXISTS `videos` (
+    `media_id` TEXT PRIMARY KEY NOT NULL,
+    `variants` TEXT NOT NULL
+);
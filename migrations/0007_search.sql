@@ -0,0 +1,9 @@
+-- full-text index over the statuses seen in timelines and searches, for /api/v2/search.
+-- the rowid is the status id, and the encoded status is kept so that results are sent without converting again.
+-- the trigram tokenizer matches substrings, which also works for languages written without spaces
+CREATE VIRTUAL TABLE IF NOT EXISTS `search_index` USING fts5(
+    `text`,
+    `screen_name`,
+    `status` UNINDEXED,
+    tokenize = 'trigram'
+);
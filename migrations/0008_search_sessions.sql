@@ -0,0 +1,10 @@
+-- the sessions each indexed status was seen by, as searches must only find what the searching session could see
+-- (e.g. tweets of protected accounts that only it follows)
+CREATE TABLE IF NOT EXISTS `search_sessions` (
+    `session_id` TEXT NOT NULL,
+    `status_id` INTEGER NOT NULL,
+    PRIMARY KEY (`session_id`, `status_id`)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS `search_sessions_status_id` ON `search_sessions` (`status_id`);
+-- what was indexed before is not tied to a session and could only be searched by everyone
+DELETE FROM `search_index`;
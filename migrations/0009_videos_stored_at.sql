@@ -0,0 +1,3 @@
+-- when the variants were stored, so that maintenance can expire them like media
+ALTER TABLE `videos` ADD COLUMN `stored_at` REAL NOT NULL DEFAULT 0;
+UPDATE `videos` SET `stored_at` = CAST(strftime('%s', 'now') AS REAL);
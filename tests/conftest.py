@@ -0,0 +1,18 @@
+"""The tests share one migrated database in a temporary directory and the in-memory cache backend."""
+import os
+import tempfile
+
+os.environ.setdefault('HOST', 'localhost:5000')
+os.environ.setdefault('SCHEME', 'http')
+os.environ.setdefault('SQLITE_DB', os.path.join(tempfile.mkdtemp(), 'test.sqlite'))
+
+import pytest  # noqa: E402
+from yurikamome.helpers import connect  # noqa: E402
+from yurikamome.migrations import migrate  # noqa: E402
+
+
+@pytest.fixture(scope='session', autouse=True)
+def database():
+    db = connect()
+    migrate(db)
+    db.close()
@@ -0,0 +1,57 @@
+"""
+Bearer tokens are looked up in the cache backend before the database. A revoked token has to stop working at once,
+in every worker, including when a lookup that read it before the revocation finishes afterwards.
+"""
+import json
+
+from yurikamome.cache_backend import cache
+from yurikamome.helpers import AUTH_CACHE_TTL, create_app, create_session, update_app_session_id, \
+    update_app_access_token, query_session_by_access_token, cached_session_by_access_token, delete_session, \
+    transaction
+
+
+def signed_in(name: str) -> str:
+    """Creates a session and an app with an access token for it, returns the token."""
+    create_session(name, json.dumps({'ct0': 'x'}), name)
+    create_app((name, name, None, 'urn:ietf:wg:oauth:2.0:oob', f'client-{name}', 'secret', 'vapid', 'read'))
+    update_app_session_id(f'client-{name}', name)
+    update_app_access_token(f'client-{name}', f'token-{name}')
+    return f'token-{name}'
+
+
+def test_lookups_are_cached():
+    access_token = signed_in('cached')
+    assert query_session_by_access_token(access_token)['session_id'] == 'cached'
+    with transaction() as db:
+        db.execute("UPDATE sessions SET username = 'renamed' WHERE session_id = 'cached'")
+    # answered from the cache, the database is not read again
+    assert query_session_by_access_token(access_token)['username'] == 'cached'
+
+
+def test_unknown_tokens_are_not_cached():
+    assert query_session_by_access_token('nobody') is None
+    assert cached_session_by_access_token('nobody') is None
+
+
+def test_reissued_token_revokes_the_old_one():
+    access_token = signed_in('reissued')
+    assert query_session_by_access_token(access_token) is not None
+    update_app_access_token('client-reissued', 'token-reissued-2')
+    assert query_session_by_access_token(access_token) is None
+    assert query_session_by_access_token('token-reissued-2')['session_id'] == 'reissued'
+
+
+def test_deleted_session_revokes_its_tokens():
+    access_token = signed_in('deleted')
+    assert query_session_by_access_token(access_token) is not None
+    delete_session('deleted')
+    assert query_session_by_access_token(access_token) is None
+
+
+def test_lookup_finishing_after_a_revocation_cannot_put_the_token_back():
+    access_token = signed_in('raced')
+    session_row = query_session_by_access_token(access_token)
+    update_app_access_token('client-raced', 'token-raced-2')
+    # what a lookup that read the old token before the revocation does last
+    assert not cache.add(f'auth:{access_token}', session_row, AUTH_CACHE_TTL)
+    assert cached_session_by_access_token(access_token) is None
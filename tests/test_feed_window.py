@@ -0,0 +1,134 @@
+"""
+For You is not in chronological order: scrolling it has to follow upstream's order and cursors to the end,
+which the id ordered timeline store did not.
+
+    python -m pytest tests
+"""
+import random
+import asyncio
+
+from yurikamome.cache_backend import cache
+from yurikamome.timeline_store import FEED_TTL, get_feed_window, next_feed_page, fill_feed
+from yurikamome.upstream import UpstreamUnavailable
+
+FEED_SIZE = 200
+PAGE_SIZE = 20
+
+
+def shuffled_feed(seed: int = 1) -> list:
+    ids = list(range(1000, 1000 + FEED_SIZE))
+    random.Random(seed).shuffle(ids)
+    return [(status_id, f'{{"id":"{status_id}"}}') for status_id in ids]
+
+
+def fetcher(feed: list, fail: bool = False):
+    """Pages of `feed` in its order, the cursor being the offset of the next page."""
+    async def fetch_page(cursor):
+        if fail:
+            raise UpstreamUnavailable('HomeTimeline', 'down')
+        start = int(cursor or 0)
+        page = feed[start:start + PAGE_SIZE]
+        return page, str(start + PAGE_SIZE) if start + PAGE_SIZE < len(feed) else None
+    return fetch_page
+
+
+def expire(key: str):
+    """Makes a kept feed due for a refresh, on a copy: what the cache backend returns is not ours to change."""
+    cache.set(key, {**cache.get(key), 'refreshed_at': 0}, FEED_TTL)
+
+
+async def scroll(session_id: str, fetch_page, limit: int) -> list:
+    seen = []
+    statuses, _ = await get_feed_window(session_id, 'foryou', fetch_page, limit=limit)
+    while statuses:
+        seen += statuses
+        statuses, _ = await get_feed_window(session_id, 'foryou', fetch_page, max_id=statuses[-1][0], limit=limit)
+    return seen
+
+
+def test_scrolls_a_shuffled_feed_to_the_end():
+    cache.clear()
+    feed = shuffled_feed()
+    assert asyncio.run(scroll('scroll', fetcher(feed), limit=40)) == feed
+
+
+def test_pages_smaller_than_upstream_pages():
+    cache.clear()
+    feed = shuffled_feed(2)
+    assert asyncio.run(scroll('small', fetcher(feed), limit=7)) == feed
+
+
+def test_repeated_statuses_end_the_feed():
+    cache.clear()
+    feed = shuffled_feed(3)[:PAGE_SIZE]
+
+    async def repeating(cursor):
+        # upstream keeps answering with the same page and a new cursor
+        return feed, f'again{cursor}'
+    assert asyncio.run(scroll('repeat', repeating, limit=PAGE_SIZE)) == feed
+
+
+def test_newer_statuses_are_put_on_top():
+    cache.clear()
+    feed = shuffled_feed(4)
+
+    async def run():
+        first, _ = await get_feed_window('top', 'foryou', fetcher(feed[PAGE_SIZE:]), limit=PAGE_SIZE)
+        expire('feed:top:foryou')
+        polled, _ = await get_feed_window('top', 'foryou', fetcher(feed), since_id=first[0][0], limit=PAGE_SIZE)
+        below, _ = await get_feed_window('top', 'foryou', fetcher(feed), max_id=polled[-1][0], limit=PAGE_SIZE)
+        return first, polled, below
+    first, polled, below = asyncio.run(run())
+    assert polled == feed[:PAGE_SIZE]
+    assert below == first
+
+
+def test_serves_the_kept_feed_when_upstream_is_down():
+    cache.clear()
+    feed = shuffled_feed(5)
+
+    async def run():
+        await get_feed_window('down', 'foryou', fetcher(feed), limit=PAGE_SIZE)
+        expire('feed:down:foryou')
+        return await get_feed_window('down', 'foryou', fetcher(feed, fail=True), limit=PAGE_SIZE)
+    statuses, stale = asyncio.run(run())
+    assert statuses == feed[:PAGE_SIZE]
+    assert stale
+
+
+def test_concurrent_scrolls_fetch_a_page_once():
+    cache.clear()
+    feed = shuffled_feed(6)
+    calls = []
+
+    async def slow(cursor):
+        calls.append(cursor)
+        await asyncio.sleep(0.01)
+        return await fetcher(feed)(cursor)
+
+    async def run():
+        first, _ = await get_feed_window('both', 'foryou', slow, limit=PAGE_SIZE)
+        return await asyncio.gather(*(get_feed_window('both', 'foryou', slow, max_id=first[-1][0], limit=PAGE_SIZE)
+                                      for _ in range(2)))
+    (one, _), (other, _) = asyncio.run(run())
+    assert one == other == feed[PAGE_SIZE:2 * PAGE_SIZE]
+    assert calls == [None, str(PAGE_SIZE)]
+    ids = [status_id for status_id, _ in cache.get('feed:both:foryou')['statuses']]
+    assert len(ids) == len(set(ids)) == 2 * PAGE_SIZE
+
+
+def test_prefetch_fills_the_next_page():
+    cache.clear()
+    feed = shuffled_feed(7)
+
+    async def run():
+        first, _ = await get_feed_window('ahead', 'foryou', fetcher(feed), limit=PAGE_SIZE)
+        needed = await next_feed_page('ahead', 'foryou', first[-1][0], PAGE_SIZE)
+        await fill_feed('ahead', 'foryou', fetcher(feed), first[-1][0], PAGE_SIZE)
+        # served from the kept feed, upstream is not asked again
+        below, _ = await get_feed_window('ahead', 'foryou', fetcher(feed, fail=True), max_id=first[-1][0],
+                                         limit=PAGE_SIZE)
+        return needed, below
+    needed, below = asyncio.run(run())
+    assert needed
+    assert below == feed[PAGE_SIZE:2 * PAGE_SIZE]
@@ -0,0 +1,49 @@
+"""Retention policies of run_maintenance: what is past its retention goes, what is in use stays."""
+import time
+
+from yurikamome.helpers import transaction, query_db, create_app, create_session, update_app_session_id, \
+    update_app_access_token, flush_last_used
+from yurikamome.maintenance import run_maintenance, ACCOUNT_RETENTION, MEDIA_RETENTION, PENDING_APP_RETENTION, \
+    ORPHANED_SESSION_RETENTION
+
+DAY = 86400
+
+
+def exists(table: str, column: str, value: str) -> bool:
+    return query_db(f'SELECT 1 FROM {table} WHERE {column} = ?', (value,), one=True) is not None
+
+
+def test_deletes_expired_accounts_media_and_videos():
+    now = time.time()
+    with transaction() as db:
+        db.executemany('INSERT INTO accounts (user_id, account, fetched_at) VALUES (?, ?, ?)',
+                       [('old-account', '{}', now - ACCOUNT_RETENTION - DAY), ('new-account', '{}', now)])
+        db.executemany('INSERT INTO media (media_id, width, height, small_width, small_height, processed_at) '
+                       'VALUES (?, 1, 1, 1, 1, ?)', [('old-media', now - MEDIA_RETENTION - DAY), ('new-media', now)])
+        db.executemany("INSERT INTO videos (media_id, variants, stored_at) VALUES (?, '[]', ?)",
+                       [('old-video', now - MEDIA_RETENTION - DAY), ('new-video', now)])
+    report = run_maintenance()
+    assert report['deleted']['accounts'] >= 1 and report['deleted']['media'] >= 1 and report['deleted']['videos'] >= 1
+    assert not exists('accounts', 'user_id', 'old-account') and exists('accounts', 'user_id', 'new-account')
+    assert not exists('media', 'media_id', 'old-media') and exists('media', 'media_id', 'new-media')
+    assert not exists('videos', 'media_id', 'old-video') and exists('videos', 'media_id', 'new-video')
+
+
+def test_deletes_abandoned_sign_ins_and_their_orphaned_sessions():
+    create_session('abandoned', '{}', 'abandoned')
+    create_app(('abandoned', 'abandoned', None, 'urn:x', 'client-abandoned', 'secret', 'vapid', 'read'))
+    update_app_session_id('client-abandoned', 'abandoned')
+    create_session('signed-in', '{}', 'signed-in')
+    create_app(('signed-in', 'signed-in', None, 'urn:x', 'client-signed-in', 'secret', 'vapid', 'read'))
+    update_app_session_id('client-signed-in', 'signed-in')
+    update_app_access_token('client-signed-in', 'token-signed-in')
+    # the sign-ins happened long ago: their use is on disk, and backdated
+    flush_last_used()
+    with transaction() as db:
+        db.execute("UPDATE apps SET last_used_at = datetime(?, 'unixepoch') WHERE client_id = 'client-abandoned'",
+                   (time.time() - PENDING_APP_RETENTION - DAY,))
+        db.execute("UPDATE sessions SET created_at = datetime(?, 'unixepoch')",
+                   (time.time() - ORPHANED_SESSION_RETENTION - DAY,))
+    run_maintenance()
+    assert not exists('apps', 'client_id', 'client-abandoned') and not exists('sessions', 'session_id', 'abandoned')
+    assert exists('apps', 'client_id', 'client-signed-in') and exists('sessions', 'session_id', 'signed-in')
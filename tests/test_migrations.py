@@ -0,0 +1,53 @@
+"""Schema migrations by PRAGMA user_version, and the migration workers starting together do at startup."""
+import threading
+
+from yurikamome.helpers import connect
+from yurikamome.migrations import migrate, migrate_if_needed, current_version, latest_version, list_migrations
+
+# sessions as the schema.sql from before migrations created them
+LEGACY_SESSIONS = """
+CREATE TABLE `sessions` (
+    `session_id` TEXT PRIMARY KEY NOT NULL,
+    `cookies` TEXT NOT NULL,
+    `username` TEXT NOT NULL,
+    `created_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO sessions (session_id, cookies, username) VALUES ('kept', '{}', 'alice');
+"""
+
+
+def test_migrates_a_new_database(tmp_path):
+    db = connect(str(tmp_path / 'new.sqlite'))
+    assert migrate(db) == [version for version, _ in list_migrations()]
+    assert current_version(db) == latest_version()
+    assert migrate(db) == []
+
+
+def test_migrates_up_to_a_target(tmp_path):
+    db = connect(str(tmp_path / 'target.sqlite'))
+    assert migrate(db, target=2) == [1, 2]
+    assert current_version(db) == 2
+    assert migrate(db)[0] == 3
+
+
+def test_keeps_a_legacy_database(tmp_path):
+    db = connect(str(tmp_path / 'legacy.sqlite'))
+    db.executescript(LEGACY_SESSIONS)
+    migrate(db)
+    assert db.execute('SELECT username FROM sessions WHERE session_id = ?', ('kept',)).fetchone()[0] == 'alice'
+
+
+def test_workers_starting_together_migrate_once(tmp_path):
+    path = str(tmp_path / 'workers.sqlite')
+    applied = []
+
+    def start():
+        db = connect(path)
+        applied.append(migrate_if_needed(db, f'{path}.migrate-lock'))
+        db.close()
+    workers = [threading.Thread(target=start) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert sorted(applied, key=len) == [[], [], [], [version for version, _ in list_migrations()]]
@@ -0,0 +1,31 @@
+"""The search index is shared, but a session only finds the statuses it saw itself."""
+import json
+
+from yurikamome.helpers import create_session, delete_session, query_db, db_writer
+from yurikamome.search_index import index_statuses, search_statuses
+
+
+def row(status_id: int, text: str) -> tuple:
+    return status_id, text, 'someone', json.dumps({'id': str(status_id), 'content': text})
+
+
+def index(session_id: str, rows: list):
+    db_writer.submit(index_statuses, session_id, rows).result()
+
+
+def test_sessions_only_find_what_they_saw():
+    index('alice', [row(101, 'protected tweet about herons'), row(102, 'public tweet about herons')])
+    index('bob', [row(102, 'public tweet about herons')])
+    assert [status_id for status_id, _ in search_statuses('alice', 'herons', 10)] == [102, 101]
+    assert [status_id for status_id, _ in search_statuses('bob', 'herons', 10)] == [102]
+    assert search_statuses('carol', 'herons', 10) == []
+
+
+def test_deleted_session_takes_what_only_it_saw():
+    create_session('dave', '{}', 'dave')
+    index('dave', [row(201, 'only dave saw these egrets'), row(202, 'everyone saw these egrets')])
+    index('erin', [row(202, 'everyone saw these egrets')])
+    db_writer.submit(delete_session, 'dave').result()
+    assert [r['rowid'] for r in query_db('SELECT rowid FROM search_index WHERE rowid IN (201, 202)')] == [202]
+    assert query_db("SELECT 1 FROM search_sessions WHERE session_id = 'dave'") == []
+    assert [status_id for status_id, _ in search_statuses('erin', 'egrets', 10)] == [202]
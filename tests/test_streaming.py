@@ -0,0 +1,62 @@
+"""Server-Sent Events: the response is only ended while the client is still there to read the end of it."""
+import json
+import time
+import asyncio
+
+from yurikamome.helpers import create_app, create_session, update_app_session_id, update_app_access_token, \
+    transaction
+from yurikamome.streaming import streaming_app, hub, STREAMING_QUEUE_SIZE
+
+
+def signed_in(name: str) -> str:
+    create_session(name, json.dumps({'ct0': 'x'}), name)
+    create_app((name, name, None, 'urn:ietf:wg:oauth:2.0:oob', f'client-{name}', 'secret', 'vapid', 'read'))
+    update_app_session_id(f'client-{name}', name)
+    update_app_access_token(f'client-{name}', f'token-{name}')
+    # a home timeline refreshed just now, so that the poller does not go upstream
+    with transaction() as db:
+        db.execute('INSERT OR REPLACE INTO timelines (session_id, timeline, refreshed_at) VALUES (?, ?, ?)',
+                   (name, 'home', time.time()))
+    return f'token-{name}'
+
+
+def scope(access_token: str) -> dict:
+    return {'type': 'http', 'path': '/api/v1/streaming/user', 'query_string': b'',
+            'headers': [(b'authorization', f'Bearer {access_token}'.encode())]}
+
+
+def body_messages(sent: list) -> list:
+    return [message for message in sent if message['type'] == 'http.response.body']
+
+
+def test_no_end_of_body_once_the_client_left():
+    access_token = signed_in('left')
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(0.05)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+    asyncio.run(streaming_app(scope(access_token), receive, send))
+    hub.close()
+    assert body_messages(sent) and all(message['more_body'] for message in body_messages(sent))
+
+
+def test_lagging_client_gets_the_end_of_body():
+    access_token = signed_in('lagging')
+    sent = []
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+        if len(sent) == 2:
+            # more events than the buffer holds arrive before the client reads any of them
+            for number in range(2 * STREAMING_QUEUE_SIZE + 2):
+                hub.pollers['lagging'].publish('update', f'{{"id":"{number}"}}')
+    asyncio.run(streaming_app(scope(access_token), receive, send))
+    hub.close()
+    assert body_messages(sent)[-1] == {'type': 'http.response.body', 'body': b''}
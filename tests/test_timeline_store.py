@@ -0,0 +1,95 @@
+"""
+The id ordered timeline store: pages fetched from upstream are merged by status id, and the holes between pages
+that did not connect are filled through their cursors as the client scrolls into them.
+"""
+import asyncio
+
+import pytest
+
+from yurikamome.helpers import transaction, db_writer
+from yurikamome.timeline_store import get_window
+from yurikamome.upstream import UpstreamUnavailable
+
+PAGE_SIZE = 20
+
+
+class Upstream:
+    """A chronological timeline of status ids 1 to `newest`, newest first, the cursor being the id to go on below."""
+
+    def __init__(self, newest: int):
+        self.newest = newest
+        self.down = False
+        self.cursors = []
+
+    async def fetch_page(self, cursor):
+        self.cursors.append(cursor)
+        if self.down:
+            raise UpstreamUnavailable('HomeLatestTimeline', 'down')
+        top = int(cursor) if cursor is not None else self.newest
+        ids = range(top, max(top - PAGE_SIZE, 0), -1)
+        next_cursor = str(top - PAGE_SIZE) if top > PAGE_SIZE else None
+        return [(status_id, f'{{"id":"{status_id}"}}') for status_id in ids], next_cursor
+
+
+def expire(session_id: str):
+    def run():
+        with transaction() as db:
+            db.execute('UPDATE timelines SET refreshed_at = 0 WHERE session_id = ?', (session_id,))
+    db_writer.submit(run).result()
+
+
+async def scroll(session_id: str, upstream: Upstream) -> list:
+    statuses, _ = await get_window(session_id, 'home', upstream.fetch_page, limit=PAGE_SIZE)
+    seen = []
+    while statuses:
+        seen += [status_id for status_id, _ in statuses]
+        statuses, _ = await get_window(session_id, 'home', upstream.fetch_page, max_id=statuses[-1][0],
+                                       limit=PAGE_SIZE)
+    return seen
+
+
+def test_scrolls_to_the_end():
+    assert asyncio.run(scroll('end', Upstream(100))) == list(range(100, 0, -1))
+
+
+def test_fills_the_gap_below_a_refresh():
+    upstream = Upstream(100)
+
+    async def run():
+        await get_window('gap', 'home', upstream.fetch_page, limit=PAGE_SIZE)
+        # more than a page arrived since, the newest page does not connect to the stored one
+        upstream.newest = 150
+        expire('gap')
+        return await scroll('gap', upstream)
+    assert asyncio.run(run()) == list(range(150, 0, -1))
+    # the hole below 131 was filled through its cursor, the page stored before was not fetched again
+    assert '130' in upstream.cursors and upstream.cursors.count('80') == 1
+
+
+def test_min_id_fills_from_the_oldest_end():
+    async def run():
+        await get_window('min', 'home', Upstream(100).fetch_page, limit=PAGE_SIZE)
+        return await get_window('min', 'home', Upstream(100).fetch_page, min_id=85, limit=3)
+    statuses, stale = asyncio.run(run())
+    assert [status_id for status_id, _ in statuses] == [88, 87, 86]
+    assert not stale
+
+
+def test_serves_the_store_when_upstream_is_down():
+    upstream = Upstream(100)
+
+    async def run():
+        await get_window('down', 'home', upstream.fetch_page, limit=PAGE_SIZE)
+        upstream.down = True
+        expire('down')
+        return await get_window('down', 'home', upstream.fetch_page, limit=PAGE_SIZE)
+    statuses, stale = asyncio.run(run())
+    assert [status_id for status_id, _ in statuses] == list(range(100, 80, -1))
+    assert stale
+
+
+def test_nothing_to_serve_when_upstream_is_down():
+    upstream = Upstream(100)
+    upstream.down = True
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(get_window('empty', 'home', upstream.fetch_page, limit=PAGE_SIZE))
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import threading
+from .helpers import query_db, transaction, db_writer, LRUCache, parse_twitter_timestamp
+
+# accounts younger than this are served as they are
+ACCOUNT_TTL = int(os.getenv('ACCOUNT_TTL', '600'))
+# older accounts are still served while being refreshed in the background, up to this age
+ACCOUNT_MAX_STALE = int(os.getenv('ACCOUNT_MAX_STALE', '86400'))
+ACCOUNT_STORE_SIZE = int(os.getenv('ACCOUNT_STORE_SIZE', '2048'))
+
+
+def account_from_user(user) -> dict:
+    """Builds a Mastodon account from a twikit User or the raw user dict found in tweet payloads."""
+    if isinstance(user, dict):
+        user_id = user.get('rest_id', '0')
+        legacy = user.get('legacy', {})
+        screen_name = legacy.get('screen_name', '')
+        display_name = legacy.get('name', '')
+        note = legacy.get('description', '')
+        avatar = legacy.get('profile_image_url_https', '')
+        header = legacy.get('profile_banner_url', '')
+        locked = legacy.get('protected', False)
+        created_at = legacy.get('created_at', '')
+        statuses_count = legacy.get('statuses_count', 0)
+        followers_count = legacy.get('followers_count', 0)
+        following_count = legacy.get('friends_count', 0)
+    else:
+        user_id = user.id
+        screen_name = user.screen_name
+        display_name = user.name
+        note = user.description
+        avatar = user.profile_image_url
+        header = user.profile_banner_url
+        locked = user.protected
+        created_at = user.created_at
+        statuses_count = user.statuses_count
+        followers_count = user.followers_count
+        following_count = user.following_count
+    return {
+        'id': user_id,
+        'username': screen_name,
+        'acct': screen_name,
+        'url': f'https://twitter.com/{screen_name}',
+        'display_name': display_name,
+        'note': note or '',
+        'avatar': avatar,
+        'avatar_static': avatar,
+        'header': header or '',
+        'header_static': header or '',
+        'locked': bool(locked),
+        'fields': [],
+        'emojis': [],
+        'bot': False,
+        'group': False,
+        'discoverable': False,
+        'created_at': parse_twitter_timestamp(created_at) if created_at else None,
+        'last_status_at': None,  # TODO
+        'statuses_count': statuses_count,
+        'followers_count': followers_count,
+        'following_count': following_count,
+    }
+
+
+class AccountStore:
+    """
+    Accounts by Twitter user id, in memory with SQLite behind it. Accounts learnt from timelines are
+    written to SQLite in batches by `flush`. `get` may read SQLite, async code calls it through `read`.
+    """
+
+    def __init__(self):
+        self._memory = LRUCache(ACCOUNT_STORE_SIZE, name='accounts')
+        self._dirty = {}  # type: dict[str, tuple]
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, memory_only: bool = False):
+        """Returns (account, age in seconds), or (None, None) when the user was never seen."""
+        entry = self._memory.get(user_id)
+        if entry is None and memory_only:
+            return None, None
+        if entry is None:
+            row = query_db('SELECT account, fetched_at FROM accounts WHERE user_id = ?', (user_id,), one=True)
+            if not row:
+                return None, None
+            entry = (json.loads(row['account']), row['fetched_at'])
+            self._memory.put(user_id, entry)
+        account, fetched_at = entry
+        return account, time.time() - fetched_at
+
+    def get_fresh(self, user_id: str, memory_only: bool = False):
+        account, age = self.get(user_id, memory_only)
+        return account if account is not None and age < ACCOUNT_TTL else None
+
+    def put(self, account: dict) -> dict:
+        entry = (account, time.time())
+        self._memory.put(account['id'], entry)
+        with self._lock:
+            self._dirty[account['id']] = entry
+        return account
+
+    def put_user(self, user) -> dict:
+        return self.put(account_from_user(user))
+
+    def flush(self):
+        """Queues the accounts put since the last flush on the database writer, without waiting for them."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if dirty:
+            db_writer.submit(_write_accounts, dirty)
+
+
+def _write_accounts(dirty: dict):
+    with transaction() as db:
+        db.executemany('INSERT OR REPLACE INTO accounts (user_id, account, fetched_at) VALUES (?, ?, ?)',
+                       [(user_id, json.dumps(account), fetched_at)
+                        for user_id, (account, fetched_at) in dirty.items()])
+
+
+account_store = AccountStore()
@@ -0,0 +1,49 @@
+import os
+import hmac
+import time
+import asyncio
+from functools import wraps
+from flask import Blueprint, Response, request, jsonify
+from .profiling import sampler, slow_requests
+
+# the /admin endpoints only exist when this is set, and want "Authorization: Bearer <ADMIN_TOKEN>"
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+MAX_PROFILE_SECONDS = 300
+MAX_PROFILE_HZ = 1000
+
+admin_blueprint = Blueprint('admin', __name__)
+
+
+def admin_authenticated(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'Record not found'}), 404
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {ADMIN_TOKEN}'.encode()):
+            return jsonify({'error': 'The access token is invalid'}), 401
+        return await f(*args, **kwargs)
+    return decorated_function
+
+
+@admin_blueprint.route('/admin/profile')
+@admin_authenticated
+async def profile():
+    """
+    Samples stacks at `hz` for the next `seconds` and returns them as collapsed stacks, e.g. for flamegraph.pl.
+    With `seconds` and no `hz`, returns what the always-on sampler (PROFILE_HZ) took in the last `seconds` instead.
+    """
+    seconds = min(request.args.get('seconds', 30, type=float), MAX_PROFILE_SECONDS)
+    hz = request.args.get('hz', type=float)
+    since = time.time() - seconds
+    if hz:
+        since = time.time()
+        sampler.boost(min(hz, MAX_PROFILE_HZ), seconds)
+        await asyncio.sleep(seconds)
+    return Response(sampler.collapsed(since), mimetype='text/plain')
+
+
+@admin_blueprint.route('/admin/slow_requests')
+@admin_authenticated
+async def slow():
+    """The SLOW_REQUEST_BUFFER slowest requests over SLOW_REQUEST_THRESHOLD since the worker started, slowest first."""
+    return jsonify(slow_requests.slowest())
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import threading
+import contextvars
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundLoop:
+    """
+    The one long-lived event loop of the process. Async views, streaming and background work all run
+    on it, so upstream clients and their connection pools are shared across requests, and one worker
+    can wait on many upstream calls at once.
+
+    Under the ASGI entry point this is the server's own loop, adopted at startup. Under plain WSGI
+    it is started on a daemon thread the first time it is needed.
+    """
+
+    def __init__(self):
+        self.loop = None  # type: asyncio.AbstractEventLoop
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def adopt(self, loop: asyncio.AbstractEventLoop):
+        with self._lock:
+            if self.loop is None:
+                self.loop = loop
+            elif self.loop is not loop:
+                logger.warning('Background loop already started, not adopting the server loop')
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='background-loop', daemon=True).start()
+            return self.loop
+
+    def run_sync(self, func):
+        """Wraps a coroutine function so that sync code, e.g. a WSGI thread, can call it and wait on it."""
+        def wrapper(*args, **kwargs):
+            loop = self._ensure_started()
+            try:
+                running_loop = asyncio.get_running_loop()
+            except RuntimeError:
+                running_loop = None
+            if running_loop is loop:
+                raise RuntimeError('Cannot block on the background loop from the background loop')
+            # the view needs the caller's Flask request and app contexts
+            context = contextvars.copy_context()
+            result = concurrent.futures.Future()
+
+            def start():
+                task = loop.create_task(func(*args, **kwargs), context=context)
+                task.add_done_callback(lambda t: _copy_result(t, result))
+
+            loop.call_soon_threadsafe(start)
+            return result.result()
+        return wrapper
+
+    def spawn(self, coro) -> concurrent.futures.Future:
+        """Runs `coro` on the loop without waiting for it, outside of the request it was started from."""
+        loop = self._ensure_started()
+        result = concurrent.futures.Future()
+
+        def start():
+            task = loop.create_task(coro)
+            task.add_done_callback(lambda t: _copy_result(t, result))
+
+        # a fresh context, so that background work neither holds on to the request context nor adds to its timings
+        loop.call_soon_threadsafe(start, context=contextvars.Context())
+        return result
+
+    def submit(self, key: str, func, *args):
+        """Schedules `func(*args)`, a coroutine function, unless work under the same key is already in flight."""
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        future = self.spawn(func(*args))
+        future.add_done_callback(lambda f: self._done(key, f))
+
+    def _done(self, key: str, future):
+        with self._lock:
+            self._pending.discard(key)
+        if not future.cancelled() and future.exception():
+            logger.error('Background task %s failed', key, exc_info=future.exception())
+
+
+def _copy_result(task: asyncio.Task, result: concurrent.futures.Future):
+    if task.cancelled():
+        result.cancel()
+    elif task.exception() is not None:
+        result.set_exception(task.exception())
+    else:
+        result.set_result(task.result())
+
+
+background = BackgroundLoop()
@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from functools import partial
+
+# where state that every worker has to agree on lives (the auth cache, rate limit budgets, leases of background
+# jobs): "memory" for a single worker, "sqlite" for several workers on one host, "redis" for several machines
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+CACHE_MEMORY_SIZE = int(os.getenv('CACHE_MEMORY_SIZE', '4096'))
+# by default next to the database, i.e. in the /data volume
+CACHE_SQLITE_PATH = os.getenv('CACHE_SQLITE_PATH', os.path.join(
+    os.path.dirname(os.path.abspath(os.getenv('SQLITE_DB', 'yurikamome.sqlite'))), 'cache.sqlite'))
+# any server that speaks the Redis protocol, e.g. a local redis-server or valkey while developing
+CACHE_URL = os.getenv('CACHE_URL', 'redis://localhost:6379/0')
+CACHE_PREFIX = os.getenv('CACHE_PREFIX', 'yurikamome:')
+# threads that call a shared backend for the event loop, which must not wait on a round trip or a lock
+CACHE_THREADS = int(os.getenv('CACHE_THREADS', '4'))
+# expired rows of the sqlite backend are deleted every this many writes
+_SQLITE_PURGE_EVERY = 1000
+
+
+class MemoryBackend:
+    """
+    Keeps everything in this process, the least recently used entries dropped past CACHE_MEMORY_SIZE.
+    Values are stored as they are, so callers must not change what they get back.
+    """
+
+    # only this process sees it, so reads are cheap enough for the event loop
+    shared = False
+
+    def __init__(self, maxsize: int = CACHE_MEMORY_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # type: OrderedDict[str, tuple[object, float]]
+        self._lock = threading.Lock()
+
+    def _live(self, key: str, now: float):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def _put(self, key: str, value, ttl: float, now: float):
+        self._entries[key] = (value, now + ttl if ttl else None)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._live(key, time.monotonic())
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value, ttl: float = None):
+        with self._lock:
+            self._put(key, value, ttl, time.monotonic())
+
+    def add(self, key: str, value, ttl: float = None) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if self._live(key, now) is not None:
+                return False
+            self._put(key, value, ttl, now)
+            return True
+
+    def incr(self, key: str, ttl: float) -> int:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                self._put(key, 1, ttl, now)
+                return 1
+            self._entries[key] = (entry[0] + 1, entry[1])
+            return entry[0] + 1
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteBackend:
+    """
+    A table in its own sqlite file, shared by the worker processes of one host. Kept apart from the database so
+    that cache traffic never waits on the writer's batches, and with synchronous off since it can be lost.
+    """
+
+    shared = True
+
+    def __init__(self, path: str = CACHE_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._db().execute('CREATE TABLE IF NOT EXISTS cache '
+                           '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL) WITHOUT ROWID')
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # autocommit, each statement is its own transaction
+            db = self._local.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute('PRAGMA busy_timeout = 5000')
+        return db
+
+    @staticmethod
+    def _expires_at(ttl: float):
+        return time.time() + ttl if ttl else None
+
+    def _wrote(self, db: sqlite3.Connection):
+        self._writes += 1
+        if self._writes % _SQLITE_PURGE_EVERY == 0:
+            db.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+
+    def get(self, key: str):
+        row = self._db().execute('SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                                 (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value, ttl: float = None):
+        db = self._db()
+        db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (key, json.dumps(value), self._expires_at(ttl)))
+        self._wrote(db)
+
+    def add(self, key: str, value, ttl: float = None) -> bool:
+        db = self._db()
+        cursor = db.execute('INSERT INTO cache VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE '
+                            'SET value = excluded.value, expires_at = excluded.expires_at '
+                            'WHERE cache.expires_at <= ?',
+                            (key, json.dumps(value), self._expires_at(ttl), time.time()))
+        self._wrote(db)
+        return cursor.rowcount == 1
+
+    def incr(self, key: str, ttl: float) -> int:
+        db = self._db()
+        now = time.time()
+        # no RETURNING, the sqlite of Debian bullseye is too old for it
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('INSERT INTO cache VALUES (?, 1, ?) ON CONFLICT (key) DO UPDATE '
+                       'SET value = CASE WHEN cache.expires_at <= ? THEN 1 ELSE CAST(cache.value AS INTEGER) + 1 END, '
+                       'expires_at = CASE WHEN cache.expires_at <= ? THEN excluded.expires_at ELSE cache.expires_at END',
+                       (key, now + ttl, now, now))
+            count = db.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()[0]
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        self._wrote(db)
+        return int(count)
+
+    def delete(self, *keys: str):
+        if keys:
+            self._db().execute(f'DELETE FROM cache WHERE key IN ({",".join("?" * len(keys))})', keys)
+
+    def clear(self):
+        self._db().execute('DELETE FROM cache')
+
+
+class RedisBackend:
+    """Keys under CACHE_PREFIX on a Redis server, shared by every machine. Needs the redis package."""
+
+    shared = True
+
+    def __init__(self, url: str = CACHE_URL, prefix: str = CACHE_PREFIX):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('CACHE_BACKEND=redis needs the redis package, `pip install redis`') from None
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key: str):
+        value = self._redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value, ttl: float = None):
+        self._redis.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def add(self, key: str, value, ttl: float = None) -> bool:
+        return bool(self._redis.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000) if ttl else None,
+                                    nx=True))
+
+    def incr(self, key: str, ttl: float) -> int:
+        count = self._redis.incr(self.prefix + key)
+        if count == 1:
+            self._redis.pexpire(self.prefix + key, int(ttl * 1000))
+        return count
+
+    def delete(self, *keys: str):
+        if keys:
+            self._redis.delete(*(self.prefix + key for key in keys))
+
+    def clear(self):
+        for key in self._redis.scan_iter(match=self.prefix + '*'):
+            self._redis.delete(key)
+
+
+BACKENDS = {'memory': MemoryBackend, 'sqlite': SqliteBackend, 'redis': RedisBackend}
+if CACHE_BACKEND not in BACKENDS:
+    raise ValueError(f'CACHE_BACKEND must be one of {", ".join(BACKENDS)}, not {CACHE_BACKEND!r}')
+
+# get/set/add/incr/delete of JSON values by string key, with optional expiry in seconds.
+# add only sets a key that is missing or expired and says whether it did, e.g. to take a lease;
+# incr counts in a window of `ttl` seconds that starts with the first increment.
+cache = BACKENDS[CACHE_BACKEND]()
+_cache_pool = concurrent.futures.ThreadPoolExecutor(CACHE_THREADS, thread_name_prefix='cache')
+
+
+async def off_loop(method, *args):
+    """
+    Awaits a `cache` method from the event loop. The memory backend is called right away, a shared one
+    (sqlite may wait on its lock, redis is a round trip away) is called on a cache thread.
+    """
+    if not cache.shared:
+        return method(*args)
+    return await asyncio.get_running_loop().run_in_executor(_cache_pool, partial(method, *args))
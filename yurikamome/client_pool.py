@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TYPE_CHECKING
+import httpx
+from .upstream import upstream
+
+if TYPE_CHECKING:
+    from twikit import Client
+
+# memory the pooled clients of a worker may take, out of the 256 MB of the fly.toml VM
+CLIENT_POOL_MEMORY_MB = float(os.getenv('CLIENT_POOL_MEMORY_MB', '4'))
+# what a pooled client takes, measured with benchmarks/bench_client_memory.py: ~20 KiB for twikit's Client with its
+# httpx client and cookies, ~40 KiB for each open TLS connection, with room for connections to a second host
+CLIENT_MEMORY_KB = 100
+# as many clients as fit in CLIENT_POOL_MEMORY_MB unless set, 40 by default
+CLIENT_POOL_SIZE = int(os.getenv('CLIENT_POOL_SIZE', str(int(CLIENT_POOL_MEMORY_MB * 1024 // CLIENT_MEMORY_KB))))
+CLIENT_POOL_TTL = int(os.getenv('CLIENT_POOL_TTL', '1800'))
+# sends every twikit request to this server instead of Twitter, e.g. benchmarks/fake_upstream.py for load tests
+UPSTREAM_URL = os.getenv('UPSTREAM_URL')
+
+
+@lru_cache(maxsize=None)
+def ssl_context():
+    """
+    Shared by every HTTP client, which would otherwise load the CA bundle into a fresh SSLContext (~1 MB, ~30 ms
+    each). Made on first use rather than at import, the app starts serving without it.
+    """
+    return httpx.create_ssl_context()
+
+
+class _Redirect(httpx.AsyncBaseTransport):
+    """
+    Sends requests for any host to UPSTREAM_URL, with the original host in X-Upstream-Host. The request the
+    client sees keeps its URL, so cookies and rate limit buckets still belong to Twitter's hosts.
+    """
+
+    def __init__(self, url: str):
+        self._url = httpx.URL(url)
+        self._transport = httpx.AsyncHTTPTransport(verify=ssl_context())
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        redirected = httpx.Request(
+            request.method,
+            request.url.copy_with(scheme=self._url.scheme, host=self._url.host, port=self._url.port),
+            headers=[*request.headers.raw, (b'X-Upstream-Host', request.url.raw_host)],
+            stream=request.stream,
+            extensions=request.extensions,
+        )
+        return await self._transport.handle_async_request(redirected)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def _http_options(key: str, cookies: dict) -> dict:
+    """The httpx.AsyncClient arguments of a pooled client, also passed through twikit's Client constructor."""
+    return {'verify': ssl_context(), 'cookies': cookies, 'event_hooks': {'response': [upstream.response_hook(key)]},
+            'transport': _Redirect(UPSTREAM_URL) if UPSTREAM_URL else None}
+
+
+@lru_cache(maxsize=None)
+def _client_class():
+    """
+    twikit's Client, imported on first use rather than at startup. Its constructor mounts a proxy transport for
+    every URL, which loads the CA bundle again and takes over from the transport passed in; the pool uses no proxy.
+    """
+    from twikit import Client
+
+    class PooledClient(Client):
+        proxy = property(Client.proxy.fget, lambda self, url: None)
+    return PooledClient
+
+
+def _close(http: httpx.AsyncClient, loop):
+    """Closes a client's connections on the loop that owns them, which may be running on another thread."""
+    if loop is None or loop.is_closed():
+        return
+    if loop is _current_loop():
+        loop.create_task(http.aclose())
+    else:
+        loop.call_soon_threadsafe(lambda: loop.create_task(http.aclose()))
+
+
+def login_client() -> 'Client':
+    """A twikit Client for logging in, before there is a session to pool it under."""
+    return _client_class()('en-US', verify=ssl_context(), transport=_Redirect(UPSTREAM_URL) if UPSTREAM_URL else None)
+
+
+def _current_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class _PooledClient:
+    __slots__ = ('client', 'loop', 'last_used_at')
+
+    def __init__(self, client: 'Client', loop):
+        self.client = client
+        self.loop = loop
+        self.last_used_at = time.monotonic()
+
+
+class ClientPool:
+    """
+    Keeps ready twikit Clients keyed by session id so that their parsed cookies,
+    HTTP connection pool and TLS sessions survive across requests.
+
+    httpx connections belong to the event loop that opened them. When a client is
+    checked out on a different loop than the one it was last used on, only its
+    underlying httpx.AsyncClient is rebuilt (carrying over the current cookies).
+    """
+
+    def __init__(self, maxsize: int = CLIENT_POOL_SIZE, ttl: int = CLIENT_POOL_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # type: OrderedDict[str, _PooledClient]
+        self._lock = threading.Lock()
+
+    def get(self, key: str, cookies: str) -> 'Client':
+        loop = _current_loop()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry.last_used_at > self.ttl:
+                self._discard(key)
+                entry = None
+            if entry is None:
+                # built with the pooled http client right away, twikit's own would load the CA bundle again
+                client = _client_class()(**_http_options(key, json.loads(cookies)))
+                entry = self._entries[key] = _PooledClient(client, loop)
+                while len(self._entries) > self.maxsize:
+                    self._discard(next(iter(self._entries)))
+            else:
+                self._entries.move_to_end(key)
+                if entry.loop is not loop:
+                    _close(entry.client.http, entry.loop)
+                    entry.client.http = httpx.AsyncClient(**_http_options(key, entry.client.get_cookies()))
+                    entry.loop = loop
+            entry.last_used_at = now
+            return entry.client
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._discard(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _close(entry.client.http, entry.loop)
+
+
+client_pool = ClientPool()
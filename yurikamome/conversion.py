@@ -0,0 +1,155 @@
+import os
+from typing import TYPE_CHECKING
+from .helpers import LRUCache, parse_twitter_timestamp
+from .responses import dumps
+from .account_store import account_store
+from .media import media_store, video_store, media_path, mp4_variants, VIDEO_TARGET_SIZE
+
+if TYPE_CHECKING:
+    from twikit import Tweet
+
+# encoded statuses kept per (tweet, engagement counts), shared across requests and sessions
+STATUS_CACHE_SIZE = int(os.getenv('STATUS_CACHE_SIZE', '4096'))
+
+def _image_meta(width: int, height: int) -> dict:
+    return {
+        'width': width,
+        'height': height,
+        'size': f"{width}x{height}",
+        'aspect': width / height if height else 0
+    }
+
+
+def twitter_media_to_media_attachment(media: dict, host_url: str, known_media: dict = None) -> dict:
+    media_type = media.get('type', '')
+    if media_type not in ('photo', 'video', 'animated_gif'):
+        return None
+    media_id = media.get('id_str', '')
+    remote_url = media.get('media_url_https', '')
+    path = media_path(remote_url)
+    # dimensions and blurhash are worked out by the media workers, until then Twitter's dimensions have to do
+    known = media_store.get(media_id) if known_media is None else known_media.get(media_id)
+    if known is None and path:
+        media_store.schedule(media_id, path)
+    if known:
+        meta = {
+            'original': _image_meta(known['width'], known['height']),
+            'small': _image_meta(known['small_width'], known['small_height']),
+        }
+    else:
+        original_info = media.get('original_info', {})
+        meta = {'original': _image_meta(original_info.get('width', 0), original_info.get('height', 0))}
+    attachment = {
+        'id': media_id,
+        'type': 'image',
+        'url': f'{host_url}/media/original/{path}' if path else remote_url,
+        'preview_url': f'{host_url}/media/small/{path}' if path else remote_url,
+        'remote_url': remote_url,
+        'meta': meta,
+        'description': '', # TODO
+        'blurhash': known['blurhash'] if known else None
+    }
+    if media_type == 'photo':
+        return attachment
+
+    # for videos and GIFs, the image above is the poster frame
+    video_info = media.get('video_info', {})
+    variants = mp4_variants(video_info)
+    if not variants:
+        return None
+    video_store.put(media_id, variants)
+    bitrate, _, _, variant_url = video_store.select(media_id, variants, VIDEO_TARGET_SIZE)
+    attachment['type'] = 'gifv' if media_type == 'animated_gif' else 'video'
+    # redirects to a variant chosen per request, so clients can ask for a lighter one
+    attachment['url'] = f'{host_url}/media/video/{media_id}.mp4'
+    attachment['remote_url'] = variant_url
+    if 'duration_millis' in video_info:
+        meta['original']['duration'] = video_info['duration_millis'] / 1000
+    meta['original']['bitrate'] = bitrate
+    return attachment
+
+
+def _tweet_media(tweet: 'Tweet') -> list:
+    # extended_entities has every photo and the video variants, entities only has the first photo
+    return tweet._data['legacy'].get('extended_entities', {}).get('media') or tweet.media or []
+
+
+def _known_media(tweet: 'Tweet') -> dict:
+    """Media id -> what the media workers found out, for the media of the tweet they are done with."""
+    known = {}
+    for media in _tweet_media(tweet):
+        media_id = media.get('id_str', '')
+        meta = media_store.get(media_id)
+        if meta is not None:
+            known[media_id] = meta
+    return known
+
+
+_status_cache = LRUCache(STATUS_CACHE_SIZE, name='statuses')
+
+
+def _account(user) -> dict:
+    # the user in hand is current, but rebuilding an account for every tweet is wasted work
+    user_id = user.get('rest_id', '0') if isinstance(user, dict) else user.id
+    account = account_store.get_fresh(user_id, memory_only=True)
+    if account is None:
+        account = account_store.put_user(user)
+    return account
+
+
+def tweet_to_status_json(tweet: 'Tweet', host_url: str) -> str:
+    """
+    Converts a tweet into a Mastodon status, encoded as JSON. Results are cached and shared between callers,
+    as encoded JSON rather than dicts, and a retweet's encoding is spliced into the retweeting status as it is.
+    """
+    return _status_json(tweet, host_url, _known_media(tweet))
+
+
+def _status_json(tweet: 'Tweet', host_url: str, known: dict) -> str:
+    retweeted = tweet.retweeted_tweet
+    known_retweeted = _known_media(retweeted) if retweeted else {}
+    # engagement counts are part of the key so that a cached status never shows stale numbers
+    # and so is how much of the media has been processed, so that blurhashes show up once they are ready
+    key = (tweet.id, tweet.retweet_count, tweet.favorite_count, tweet.reply_count, host_url, len(known),
+           len(known_retweeted))
+    encoded = _status_cache.get(key)
+    if encoded is not None:
+        return encoded
+    reblog = _status_json(retweeted, host_url, known_retweeted) if retweeted else 'null'
+    # "reblog" is left out of the dict and appended as the last member
+    encoded = f'{dumps(_status(tweet, host_url, known))[:-1]},"reblog":{reblog}}}'
+    _status_cache.put(key, encoded)
+    return encoded
+
+
+def _status(tweet: 'Tweet', host_url: str, known: dict) -> dict:
+    account = _account(tweet.user)
+    screen_name = account['username']
+    return {
+        'id': tweet.id,
+        'uri': f'{host_url}/users/{screen_name}/statuses/{tweet.id}', # TODO
+        'created_at': parse_twitter_timestamp(tweet.created_at),
+        # the stored account links to Twitter, as verify_credentials sends it, the ones in statuses link here
+        'account': {**account, 'url': f'{host_url}/@{screen_name}'}, # TODO
+        'content': tweet.full_text,
+        'visibility': 'public', # TODO
+        'sensitive': tweet.possibly_sensitive,
+        'spoiler_text': '',
+        'media_attachments': [attachment for attachment in
+                              (twitter_media_to_media_attachment(media, host_url, known) for media in _tweet_media(tweet))
+                              if attachment],
+        'mentions': [], # TODO
+        'tags': [], # TODO
+        'emojis': [], # TODO
+        'reblogs_count': tweet.retweet_count,
+        'favourites_count': tweet.favorite_count,
+        'replies_count': tweet.reply_count,
+        'url': f'{host_url}/@{screen_name}/statuses/{tweet.id}',
+        'in_reply_to_id': None, # TODO
+        'in_reply_to_account_id': None, # TODO
+        'poll': None,
+        'card': None,
+        'language': tweet.lang,
+        'text': tweet.full_text,
+        'edited_at': None
+    }
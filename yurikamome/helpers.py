@@ -1,12 +1,24 @@
 import os
 import sys
+import queue
+import asyncio
 import secrets
 import sqlite3
-import json
-from functools import wraps
-from flask import g, render_template, request, jsonify
-from twikit import Client
-
+import time
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache, partial, wraps
+from flask import g, render_template, request, jsonify, has_app_context
+from .client_pool import client_pool
+from .cache_backend import cache
+from .upstream import upstream
+from .metrics import SQLITE_SECONDS, SQLITE_WRITE_BATCH, CacheStats, phase
+
+logger = logging.getLogger(__name__)
 
 def env_or_bust(env: str):
     if env not in os.environ:
@@ -15,6 +27,16 @@ def env_or_bust(env: str):
     return os.environ[env]
 
 SQLITE_DB = env_or_bust('SQLITE_DB')
+# bearer token -> session row entries are kept this long, revoked tokens are marked for AUTH_REVOKED_TTL
+AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', '86400'))
+AUTH_REVOKED_TTL = 600
+LAST_USED_FLUSH_INTERVAL = int(os.getenv('LAST_USED_FLUSH_INTERVAL', '60'))
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '4'))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '4096'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(64 * 1024 * 1024)))
+SQLITE_READ_THREADS = int(os.getenv('SQLITE_READ_THREADS', '4'))
+# writes queued while a batch commits go into the next transaction, up to this many
+SQLITE_WRITE_BATCH_SIZE = int(os.getenv('SQLITE_WRITE_BATCH_SIZE', '128'))
 
 
 def get_host_url_or_bust():
@@ -27,21 +49,187 @@ def random_secret():
     return secrets.token_hex(10)
 
 
+_MONTHS = {
+    'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+    'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12',
+}
+
+
+# timestamp looks like "Sat Mar 16 23:00:07 +0000 2024"
+@lru_cache(maxsize=8192)
+def parse_twitter_timestamp(timestamp: str) -> str:
+    # Twitter always sends UTC in a fixed layout, so the common case is a reshuffle of slices
+    if len(timestamp) == 30 and timestamp[20:25] == '+0000' and timestamp[4:7] in _MONTHS:
+        return f'{timestamp[26:30]}-{_MONTHS[timestamp[4:7]]}-{timestamp[8:10]}T{timestamp[11:19]}.000Z'
+    date_object = datetime.strptime(timestamp, '%a %b %d %H:%M:%S %z %Y')
+    return date_object.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def connect(path: str = SQLITE_DB) -> sqlite3.Connection:
+    db = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+    db.row_factory = sqlite3.Row
+    # only takes effect when the database is created, older ones need `flask sqlite maintain --vacuum`
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute('PRAGMA busy_timeout = 5000')
+    db.execute('PRAGMA temp_store = MEMORY')
+    db.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+    db.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+    return db
+
+
+# Connections outlive requests so their page cache and prepared statements are reused.
+# Async views of concurrent requests all run on the shared event loop thread, so request connections
+# are pooled rather than thread-local; code running outside an app context keeps one per thread.
+_idle_dbs = []  # type: list[sqlite3.Connection]
+_idle_dbs_lock = threading.Lock()
+_thread_db = threading.local()
+
+
+def _checkout_db() -> sqlite3.Connection:
+    with _idle_dbs_lock:
+        if _idle_dbs:
+            return _idle_dbs.pop()
+    return connect()
+
+
+def release_db(db: sqlite3.Connection):
+    if db.in_transaction:
+        db.rollback()
+    with _idle_dbs_lock:
+        if len(_idle_dbs) < SQLITE_POOL_SIZE:
+            _idle_dbs.append(db)
+            return
+    db.close()
+
+
 def get_db():
+    if not has_app_context():
+        db = getattr(_thread_db, 'db', None)
+        if db is None:
+            db = _thread_db.db = connect()
+        return db
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(SQLITE_DB, check_same_thread=False)
+        db = g._database = _checkout_db()
     return db
 
 
 def query_db(query, args=(), one=False):
     db = get_db()
-    db.row_factory = sqlite3.Row
     cur = db.execute(query, args)
     rv = cur.fetchall()
     cur.close()
     return (rv[0] if rv else None) if one else rv
 
+
+@contextmanager
+def transaction():
+    """Commits the statements run inside, except on the writer thread, which commits whole batches itself."""
+    db = get_db()
+    if getattr(_thread_db, 'batching', False):
+        yield db
+        return
+    with db:
+        yield db
+
+
+# Async code must not block the event loop on sqlite, so it reads on a small thread pool
+# (each thread keeps its own connection) and hands writes to the single writer thread.
+_read_pool = concurrent.futures.ThreadPoolExecutor(SQLITE_READ_THREADS, thread_name_prefix='sqlite-read')
+
+
+async def read(func, *args):
+    """Runs a blocking query function, e.g. `query_session`, on the read pool."""
+    with phase('db'):
+        return await asyncio.get_running_loop().run_in_executor(_read_pool, partial(_timed, 'read', func, *args))
+
+
+def _timed(operation: str, func, *args):
+    with SQLITE_SECONDS.labels(operation, func.__name__).time():
+        return func(*args)
+
+
+class DatabaseWriter:
+    """
+    Runs the writes of the whole process on one thread and connection. Writes that queue up while a
+    transaction commits are committed together in the next one, so a slow fsync is paid once per
+    batch and writers never fight each other over the database lock.
+
+    A write is a function such as `create_session` that goes through `transaction()`. Each one runs
+    in its own savepoint, so a failing write is rolled back without taking the rest of its batch along.
+    """
+
+    def __init__(self, batch_size: int = SQLITE_WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def started(self) -> bool:
+        return self._thread is not None
+
+    def submit(self, func, *args) -> concurrent.futures.Future:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sqlite-write', daemon=True)
+                self._thread.start()
+        future = concurrent.futures.Future()
+        self._queue.put((future, func, args))
+        return future
+
+    async def write(self, func, *args):
+        with phase('db'):
+            return await asyncio.wrap_future(self.submit(func, *args))
+
+    def _run(self):
+        _thread_db.db = connect()
+        _thread_db.batching = True
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(_thread_db.db, [item for item in batch if item[0].set_running_or_notify_cancel()])
+
+    def _commit(self, db: sqlite3.Connection, batch: list):
+        if not batch:
+            return
+        outcomes = []
+        try:
+            # take the write lock up front, a deferred transaction could fail to upgrade its lock later
+            db.execute('BEGIN IMMEDIATE')
+            for future, func, args in batch:
+                db.execute('SAVEPOINT write')
+                try:
+                    outcomes.append((future, _timed('write', func, *args), None))
+                except Exception as e:
+                    db.execute('ROLLBACK TO write')
+                    outcomes.append((future, None, e))
+                db.execute('RELEASE write')
+            with SQLITE_SECONDS.labels('commit', 'batch').time():
+                db.commit()
+            SQLITE_WRITE_BATCH.observe(len(batch))
+        except Exception as e:
+            logger.exception('Failed to commit a batch of %d writes', len(batch))
+            if db.in_transaction:
+                db.rollback()
+            for future, _, _ in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+db_writer = DatabaseWriter()
+
 CREATE_APP_SQL = """
 INSERT INTO apps (id, name, website, redirect_uris, client_id, client_secret, vapid_key, scopes)
 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
@@ -49,9 +237,8 @@ VALUES (?, ?, ?, ?, ?, ?, ?, ?)
 
 
 def create_app(app_info):
-    db = get_db()
-    db.execute(CREATE_APP_SQL, app_info)
-    db.commit()
+    with transaction() as db:
+        db.execute(CREATE_APP_SQL, app_info)
 
 
 def query_app_by_client_id(client_id: str):
@@ -59,30 +246,41 @@ def query_app_by_client_id(client_id: str):
 
 
 def update_app_session_id(client_id: str, session_id: str):
-    db = get_db()
-    db.execute("UPDATE apps SET session_id = ? WHERE client_id = ?", (session_id, client_id))
-    db.execute("UPDATE apps SET last_used_at = datetime('now') WHERE client_id = ?", (client_id,))
-    db.commit()
+    _forget_app_access_token(client_id)
+    with transaction() as db:
+        db.execute("UPDATE apps SET session_id = ? WHERE client_id = ?", (session_id, client_id))
+    _touch_app(client_id)
 
 
 def update_app_authorization_code(client_id: str, authorization_code: str):
-    db = get_db()
-    db.execute("UPDATE apps SET authorization_code = ? WHERE client_id = ?", (authorization_code, client_id))
-    db.execute("UPDATE apps SET last_used_at = datetime('now') WHERE client_id = ?", (client_id,))
-    db.commit()
+    with transaction() as db:
+        db.execute("UPDATE apps SET authorization_code = ? WHERE client_id = ?", (authorization_code, client_id))
+    _touch_app(client_id)
 
 
 def update_app_access_token(client_id: str, access_token: str):
-    db = get_db()
-    db.execute("UPDATE apps SET access_token = ? WHERE client_id = ?", (access_token, client_id))
-    db.execute("UPDATE apps SET last_used_at = datetime('now') WHERE client_id = ?", (client_id,))
-    db.commit()
+    app_row = _forget_app_access_token(client_id)
+    if app_row and app_row['session_id']:
+        # a reissued token must not keep riding on the previous token's client
+        client_pool.invalidate(app_row['session_id'])
+    with transaction() as db:
+        db.execute("UPDATE apps SET access_token = ? WHERE client_id = ?", (access_token, client_id))
+    _touch_app(client_id)
 
 
 def create_session(session_id: str, cookies: str, username: str):
-    db = get_db()
-    db.execute("INSERT INTO sessions (session_id, cookies, username) VALUES (?, ?, ?)", (session_id, cookies, username))
-    db.commit()
+    with transaction() as db:
+        db.execute("INSERT INTO sessions (session_id, cookies, username) VALUES (?, ?, ?)", (session_id, cookies, username))
+
+
+def query_session_user_id(session_id: str):
+    row = query_db('SELECT user_id FROM sessions WHERE session_id = ?', (session_id,), one=True)
+    return row['user_id'] if row else None
+
+
+def update_session_user_id(session_id: str, user_id: str):
+    with transaction() as db:
+        db.execute('UPDATE sessions SET user_id = ? WHERE session_id = ?', (user_id, session_id))
 
 
 def query_session(session_id: str):
@@ -90,12 +288,39 @@ def query_session(session_id: str):
 
 
 def delete_session(session_id: str):
-    db = get_db()
-    db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
-    db.commit()
-
-
-def query_cookies_by_access_token(access_token: str):
+    access_tokens = [row['access_token'] for row in query_db(
+        'SELECT access_token FROM apps WHERE session_id = ? AND access_token IS NOT NULL', (session_id,))]
+    with transaction() as db:
+        db.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+        db.execute('DELETE FROM timeline_statuses WHERE session_id = ?', (session_id,))
+        db.execute('DELETE FROM timeline_gaps WHERE session_id = ?', (session_id,))
+        db.execute('DELETE FROM timelines WHERE session_id = ?', (session_id,))
+        # indexed statuses that no other session saw go along
+        db.execute('DELETE FROM search_index WHERE rowid IN (SELECT status_id FROM search_sessions AS mine '
+                   'WHERE session_id = ? AND NOT EXISTS (SELECT 1 FROM search_sessions AS other '
+                   'WHERE other.status_id = mine.status_id AND other.session_id != mine.session_id))', (session_id,))
+        db.execute('DELETE FROM search_sessions WHERE session_id = ?', (session_id,))
+    forget_access_tokens(access_tokens)
+    with _touched_lock:
+        _touched_sessions.pop(session_id, None)
+    client_pool.invalidate(session_id)
+    upstream.forget(session_id)
+
+
+def cached_session_by_access_token(access_token: str):
+    """Like query_session_by_access_token, but only looks at the cache and never touches the database."""
+    session_row = cache.get(f'auth:{access_token}') or None
+    if session_row is not None:
+        with _touched_lock:
+            _touched_sessions[session_row['session_id']] = time.time()
+    _auth_cache_stats.record(session_row is not None)
+    return session_row
+
+
+def query_session_by_access_token(access_token: str):
+    session_row = cached_session_by_access_token(access_token)
+    if session_row is not None:
+        return session_row
     app_row = query_db('SELECT session_id FROM apps WHERE access_token = ?', (access_token,), one=True)
     if not app_row:
         return None
@@ -103,10 +328,113 @@ def query_cookies_by_access_token(access_token: str):
     session_row = query_db('SELECT * FROM sessions WHERE session_id = ?', (session_id,), one=True)
     if not session_row:
         return None
-    db = get_db()
-    db.execute('UPDATE apps SET last_used_at = datetime("now") WHERE session_id = ?', (session_id,))
-    db.commit()
-    return session_row['cookies']
+    session_row = dict(session_row)
+    # add rather than set, a token revoked since the query above is marked and must stay so
+    cache.add(f'auth:{access_token}', session_row, AUTH_CACHE_TTL)
+    with _touched_lock:
+        _touched_sessions[session_id] = time.time()
+    return session_row
+
+
+_auth_cache_stats = CacheStats('auth')
+
+# last_used_at is only informational, so bumps are kept in memory and written in batches
+_touched_sessions = {}  # type: dict[str, float]
+_touched_apps = {}  # type: dict[str, float]
+_touched_lock = threading.Lock()
+_last_used_flushed_at = time.monotonic()
+
+
+def _forget_app_access_token(client_id: str):
+    app_row = query_app_by_client_id(client_id)
+    if app_row and app_row['access_token']:
+        forget_access_tokens([app_row['access_token']])
+    return app_row
+
+
+def forget_access_tokens(access_tokens):
+    """Drops revoked tokens from the auth cache of every worker."""
+    for access_token in access_tokens:
+        # marked rather than deleted, so that a lookup that read the token before it was revoked cannot put it back
+        cache.set(f'auth:{access_token}', False, AUTH_REVOKED_TTL)
+
+
+def _touch_app(client_id: str):
+    with _touched_lock:
+        _touched_apps[client_id] = time.time()
+
+
+def flush_last_used():
+    global _touched_sessions, _touched_apps, _last_used_flushed_at
+    with _touched_lock:
+        touched_sessions, _touched_sessions = _touched_sessions, {}
+        touched_apps, _touched_apps = _touched_apps, {}
+        _last_used_flushed_at = time.monotonic()
+    if not touched_sessions and not touched_apps:
+        return
+    with transaction() as db:
+        db.executemany(
+            "UPDATE apps SET last_used_at = datetime(?, 'unixepoch') WHERE session_id = ?",
+            [(ts, session_id) for session_id, ts in touched_sessions.items()])
+        db.executemany(
+            "UPDATE apps SET last_used_at = datetime(?, 'unixepoch') WHERE client_id = ?",
+            [(ts, client_id) for client_id, ts in touched_apps.items()])
+
+
+def maybe_flush_last_used():
+    global _last_used_flushed_at
+    if time.monotonic() - _last_used_flushed_at < LAST_USED_FLUSH_INTERVAL:
+        return
+    with _touched_lock:
+        if time.monotonic() - _last_used_flushed_at < LAST_USED_FLUSH_INTERVAL:
+            return
+        # counted from the submit, so that the teardowns until the flush runs do not queue more of them
+        _last_used_flushed_at = time.monotonic()
+    db_writer.submit(flush_last_used)
+
+
+class LRUCache:
+    """
+    A thread-safe LRU map, with optional expiry of entries `ttl` seconds after they were put.
+    Named caches count their hits and misses in /metrics.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = None, name: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = CacheStats(name) if name else None
+
+    def get(self, key):
+        value = self._get(key)
+        if self._stats:
+            self._stats.record(value is not None)
+        return value
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
 
 
 # TODO: does not work
@@ -141,14 +469,21 @@ def async_token_authenticated(f):
     @wraps(f)
     async def decorated_function(*args, **kwargs):
         g.client = None
+        g.session_row = None
+        g.session_id = None
         auth_header = request.headers.get('Authorization')
         had_auth = False
         if auth_header and auth_header.startswith('Bearer '):
             access_token = auth_header[len('Bearer '):]
-            cookies = query_cookies_by_access_token(access_token)
-            if cookies:
-                g.client = Client()
-                g.client.set_cookies(json.loads(cookies))
+            with phase('auth'):
+                # a shared cache is a round trip away, so it is only looked at from the read pool
+                session_row = (None if cache.shared else cached_session_by_access_token(access_token)) \
+                    or await read(query_session_by_access_token, access_token)
+            if session_row:
+                g.session_row = session_row
+                g.session_id = session_row['session_id']
+                with phase('client'):
+                    g.client = client_pool.get(session_row['session_id'], session_row['cookies'])
                 had_auth = True
         if not had_auth:
             return jsonify({
@@ -0,0 +1,178 @@
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from .helpers import query_db, transaction, connect, db_writer, delete_session, forget_access_tokens, \
+    flush_last_used
+from .background import background
+from .cache_backend import cache, off_loop
+
+logger = logging.getLogger(__name__)
+
+# seconds between maintenance runs of the serving process, 0 to only run it with `flask sqlite maintain`
+MAINTENANCE_INTERVAL = int(os.getenv('MAINTENANCE_INTERVAL', str(24 * 3600)))
+# apps that never got an access token (abandoned sign-ins, scanners) are deleted after this many seconds unused
+PENDING_APP_RETENTION = int(os.getenv('PENDING_APP_RETENTION', str(24 * 3600)))
+# apps unused for this many seconds are deleted, which logs their client out
+IDLE_APP_RETENTION = int(os.getenv('IDLE_APP_RETENTION', str(180 * 86400)))
+# sessions that no app points at are deleted once they are this many seconds old
+ORPHANED_SESSION_RETENTION = int(os.getenv('ORPHANED_SESSION_RETENTION', str(24 * 3600)))
+# cached accounts, media metadata and video variants are deleted this many seconds after they were fetched,
+# they are fetched again if needed
+ACCOUNT_RETENTION = int(os.getenv('ACCOUNT_RETENTION', str(30 * 86400)))
+MEDIA_RETENTION = int(os.getenv('MEDIA_RETENTION', str(90 * 86400)))
+# rows deleted per write, so that the write lock is only ever held briefly
+MAINTENANCE_BATCH_SIZE = int(os.getenv('MAINTENANCE_BATCH_SIZE', '500'))
+# a session takes its timelines along, so fewer of them go at once
+SESSION_BATCH_SIZE = 10
+VACUUM_BATCH_PAGES = 1000
+# the first run waits for startup to settle
+FIRST_RUN_DELAY = 600
+
+TABLES = ('apps', 'sessions', 'timelines', 'timeline_statuses', 'timeline_gaps', 'accounts', 'media', 'videos',
+          'search_index', 'search_sessions')
+
+
+def _delete_apps(cutoff_pending: float, cutoff_idle: float) -> int:
+    with transaction() as db:
+        rows = query_db("SELECT rowid, access_token FROM apps "
+                        "WHERE (access_token IS NULL AND last_used_at < datetime(?, 'unixepoch')) "
+                        "OR last_used_at < datetime(?, 'unixepoch') LIMIT ?",
+                        (cutoff_pending, cutoff_idle, MAINTENANCE_BATCH_SIZE))
+        db.executemany('DELETE FROM apps WHERE rowid = ?', [(row['rowid'],) for row in rows])
+    forget_access_tokens([row['access_token'] for row in rows if row['access_token']])
+    return len(rows)
+
+
+def _delete_orphaned_sessions(cutoff: float) -> int:
+    rows = query_db("SELECT session_id FROM sessions WHERE created_at < datetime(?, 'unixepoch') "
+                    "AND session_id NOT IN (SELECT session_id FROM apps WHERE session_id IS NOT NULL) LIMIT ?",
+                    (cutoff, SESSION_BATCH_SIZE))
+    for row in rows:
+        delete_session(row['session_id'])
+    return len(rows)
+
+
+def _delete_expired(table: str, column: str, cutoff: float) -> int:
+    with transaction() as db:
+        return db.execute(f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {column} < ? LIMIT ?)',
+                          (cutoff, MAINTENANCE_BATCH_SIZE)).rowcount
+
+
+def _incremental_vacuum() -> int:
+    """Gives up to VACUUM_BATCH_PAGES free pages back to the file system. Returns how many are left."""
+    with transaction() as db:
+        db.execute(f'PRAGMA incremental_vacuum({VACUUM_BATCH_PAGES})').fetchall()
+        return db.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def _optimize():
+    with transaction() as db:
+        # ANALYZE only needs rough statistics, this bounds its work on big tables
+        db.execute('PRAGMA analysis_limit = 400')
+        db.execute('PRAGMA optimize')
+
+
+def _write(func, *args):
+    return db_writer.submit(func, *args).result()
+
+
+def _in_batches(batch_size: int, func, *args) -> int:
+    total = 0
+    while True:
+        deleted = _write(func, *args)
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def database_stats() -> dict:
+    """Rows per table, pages per table and index (when SQLite has the dbstat table), and the file's page counts."""
+    stats = {
+        'page_size': query_db('PRAGMA page_size', one=True)[0],
+        'page_count': query_db('PRAGMA page_count', one=True)[0],
+        'freelist_count': query_db('PRAGMA freelist_count', one=True)[0],
+        'auto_vacuum': ('none', 'full', 'incremental')[query_db('PRAGMA auto_vacuum', one=True)[0]],
+        'rows': {table: query_db(f'SELECT COUNT(*) FROM {table}', one=True)[0] for table in TABLES},
+    }
+    try:
+        stats['pages'] = {row['name']: row['pages'] for row in
+                          query_db('SELECT name, COUNT(*) AS pages FROM dbstat GROUP BY name ORDER BY pages DESC')}
+    except sqlite3.OperationalError:
+        pass
+    return stats
+
+
+def run_maintenance() -> dict:
+    """
+    Applies the retention policies, gives free pages back and refreshes the query planner's statistics.
+    Every batch is a separate write through the database writer, so requests keep writing in between.
+    Blocks, and returns the rows deleted per table together with database_stats.
+    """
+    started_at = time.monotonic()
+    # recent use has to be on disk before it is judged
+    _write(flush_last_used)
+    now = time.time()
+    deleted = {
+        'apps': _in_batches(MAINTENANCE_BATCH_SIZE, _delete_apps, now - PENDING_APP_RETENTION,
+                            now - IDLE_APP_RETENTION),
+        'sessions': _in_batches(SESSION_BATCH_SIZE, _delete_orphaned_sessions, now - ORPHANED_SESSION_RETENTION),
+        'accounts': _in_batches(MAINTENANCE_BATCH_SIZE, _delete_expired, 'accounts', 'fetched_at',
+                                now - ACCOUNT_RETENTION),
+        'media': _in_batches(MAINTENANCE_BATCH_SIZE, _delete_expired, 'media', 'processed_at',
+                             now - MEDIA_RETENTION),
+        'videos': _in_batches(MAINTENANCE_BATCH_SIZE, _delete_expired, 'videos', 'stored_at',
+                              now - MEDIA_RETENTION),
+    }
+    if query_db('PRAGMA auto_vacuum', one=True)[0] == 2:
+        while _write(_incremental_vacuum):
+            pass
+    _write(_optimize)
+    # the WAL file only shrinks when nobody is reading it, a busy checkpoint is retried next time
+    query_db('PRAGMA wal_checkpoint(TRUNCATE)')
+    return {'deleted': deleted, 'seconds': round(time.monotonic() - started_at, 3), **database_stats()}
+
+
+def enable_incremental_vacuum():
+    """
+    Switches a database created before auto_vacuum was set to incremental vacuum. That takes a full VACUUM,
+    which rewrites the whole file and blocks every writer until it is done.
+    """
+    db = connect()
+    try:
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('VACUUM')
+    finally:
+        db.close()
+
+
+class Maintenance:
+    """Runs run_maintenance every MAINTENANCE_INTERVAL seconds from the serving process."""
+
+    def __init__(self):
+        self._started = False
+        self._started_lock = threading.Lock()
+
+    def start(self):
+        with self._started_lock:
+            if self._started:
+                return
+            self._started = True
+        background.spawn(self._run())
+
+    async def _run(self):
+        await asyncio.sleep(FIRST_RUN_DELAY)
+        while True:
+            try:
+                # every worker runs this loop, one run per interval is enough
+                if await off_loop(cache.add, 'maintenance', True, MAINTENANCE_INTERVAL / 2):
+                    report = await asyncio.get_running_loop().run_in_executor(None, run_maintenance)
+                    logger.info('Database maintenance: %s', report)
+            except Exception:
+                logger.exception('Database maintenance failed')
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+
+maintenance = Maintenance()
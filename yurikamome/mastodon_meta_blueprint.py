@@ -1,49 +1,68 @@
 import time
 import uuid
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
 from urllib.parse import unquote, quote
-from twikit import User
 from flask import jsonify, request, render_template, Blueprint, g, redirect, make_response
 from .helpers import env_or_bust, get_host_url_or_bust, update_app_session_id, \
     create_app, query_app_by_client_id, session_authenticated, update_app_authorization_code, random_secret, \
-    update_app_access_token, async_token_authenticated, json_or_form
+    update_app_access_token, async_token_authenticated, json_or_form, query_session_user_id, update_session_user_id, \
+    read, db_writer
+from .account_store import account_store, ACCOUNT_TTL, ACCOUNT_MAX_STALE
+from .background import background
+from .client_pool import client_pool
+from .upstream import upstream, revalidate, UpstreamUnavailable, STALE_WARNING
+from .responses import json_response, precompress, dumps
+
+if TYPE_CHECKING:
+    from twikit import User
 
 HOST = env_or_bust('HOST')
 HOST_URL = get_host_url_or_bust()
+STREAMING_API_URL = f"{'wss' if env_or_bust('SCHEME') == 'https' else 'ws'}://{HOST}"
 SQLITE_DB = env_or_bust('SQLITE_DB')
 
 meta_blueprint = Blueprint('mastodon_meta', __name__)
 
 
+# nothing in here changes while the process runs, so it is serialized and compressed once
+INSTANCE_JSON = precompress(dumps({
+    'uri': HOST_URL,
+    'title': 'Yurikamome',
+    'short_description': 'Use Twitter with Mastodon clients',
+    'description': 'Use Twitter with Mastodon clients',
+    'email': f'admin@{HOST}',
+    # TODO: should stick or update with Mastodon version?
+    'version': '4.2.7',
+    'urls': {
+        'streaming_api': STREAMING_API_URL,
+    },
+    'stats': {
+        # TODO: change if multitenant
+        'user_count': 1,
+        'status_count': 0,
+        'domain_count': 0,
+    },
+    'thumbnail': None,
+    'languages': [],
+    'registrations': False,
+    'approval_required': False,
+    'invites_enabled': False,
+    'configuration': {
+        "statuses": {
+            "max_characters": 280,
+            "max_media_attachments": 4,
+        },
+    },
+    'contact_account': None,
+    'rules': []
+}))
+STARTED_AT = datetime.now(timezone.utc)
+
+
 @meta_blueprint.route('/api/v1/instance')
 def instance():
-    return jsonify({
-        'uri': HOST_URL,
-        'title': 'Yurikamome',
-        'short_description': 'Use Twitter with Mastodon clients',
-        'description': 'Use Twitter with Mastodon clients',
-        'email': f'admin@{HOST}',
-        # TODO: should stick or update with Mastodon version?
-        'version': '4.2.7',
-        'stats': {
-            # TODO: change if multitenant
-            'user_count': 1,
-            'status_count': 0,
-            'domain_count': 0,
-        },
-        'thumbnail': None,
-        'languages': [],
-        'registrations': False,
-        'approval_required': False,
-        'invites_enabled': False,
-        'configuration': {
-            "statuses": {
-                "max_characters": 280,
-                "max_media_attachments": 4,
-            },
-        },
-        'contact_account': None,
-        'rules': []
-    })
+    return json_response(INSTANCE_JSON, last_modified=STARTED_AT, cache_control='public, no-cache')
 
 
 @meta_blueprint.route('/api/v1/apps', methods=['POST'])
@@ -254,27 +273,40 @@ def oauth_get_token():
 @meta_blueprint.route('/api/v1/accounts/verify_credentials')
 @async_token_authenticated
 async def verify_credentials():
-    user = await g.client.user()  # type: User
-    return jsonify({ 
-        'id': user.id,
-        'username': user.screen_name,
-        'acct': user.screen_name,
-        'url': f'https://twitter.com/{user.screen_name}',
-        'display_name': user.name,
-        'note': user.description,
-        'avatar': user.profile_image_url,
-        'avatar_static': user.profile_image_url,
-        'header': user.profile_banner_url,
-        'header_static': user.profile_banner_url,
-        'locked': user.protected,
-        'fields': [],
-        'emojis': [],
-        'bot': False,
-        'group': False,
-        'discoverable': False,
-        'created_at': user.created_at_datetime.isoformat(),
-        'last_status_at': None,  # TODO
-        'statuses_count': user.statuses_count,
-        'followers_count': user.followers_count,
-        'following_count': user.following_count
-    })
+    user_id = await read(query_session_user_id, g.session_id)
+    account = None
+    if user_id:
+        account, age = await read(account_store.get, user_id)
+        if account is not None and age < ACCOUNT_TTL:
+            return _account_response(account, age)
+        if account is not None and age < ACCOUNT_MAX_STALE:
+            background.submit(f'account:{user_id}', revalidate, _refresh_account,
+                              g.session_id, g.session_row['cookies'], user_id)
+            return _account_response(account, age)
+    try:
+        user = await upstream.call(g.session_id, 'UserByRestId', g.client.user)  # type: User
+    except UpstreamUnavailable:
+        if account is None:
+            raise
+        # however old, the last known account beats an error
+        background.submit(f'account:{user_id}', revalidate, _refresh_account,
+                          g.session_id, g.session_row['cookies'], user_id)
+        resp = _account_response(account, age)
+        resp.headers['Warning'] = STALE_WARNING
+        return resp
+    account = account_store.put_user(user)
+    account_store.flush()
+    if user.id != user_id:
+        db_writer.submit(update_session_user_id, g.session_id, user.id)
+    return _account_response(account, 0)
+
+
+def _account_response(account: dict, age: float):
+    fetched_at = datetime.fromtimestamp(time.time() - age, timezone.utc)
+    return json_response(dumps(account), etag_prefix=account['id'], last_modified=fetched_at)
+
+
+async def _refresh_account(session_id: str, cookies: str, user_id: str):
+    client = client_pool.get(session_id, cookies)
+    account_store.put_user(await upstream.call(session_id, 'UserByRestId', client.get_user_by_id, user_id, background=True))
+    account_store.flush()
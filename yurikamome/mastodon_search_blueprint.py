@@ -0,0 +1,59 @@
+import os
+import logging
+from flask import Blueprint, g, request
+from .helpers import get_host_url_or_bust, async_token_authenticated, read, db_writer
+from .account_store import account_store
+from .search_index import search_statuses, search_rows, index_statuses, MIN_TERM_LENGTH
+from .upstream import upstream, UpstreamUnavailable
+from .responses import json_response
+from .cache_backend import cache, off_loop
+
+logger = logging.getLogger(__name__)
+
+search_blueprint = Blueprint('mastodon_search', __name__)
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 40
+# Twitter is searched as well when the local index has fewer results than this
+SEARCH_MIN_LOCAL_RESULTS = int(os.getenv('SEARCH_MIN_LOCAL_RESULTS', '5'))
+# a query sent to Twitter is not sent again for this long, its results are in the local index by then
+SEARCH_UPSTREAM_TTL = int(os.getenv('SEARCH_UPSTREAM_TTL', '600'))
+
+
+@search_blueprint.route('/api/v2/search')
+@async_token_authenticated
+async def search():
+    """Searches statuses in the local index first, and on Twitter only when there are too few local results."""
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+    offset = request.args.get('offset', 0, type=int)
+    max_id = request.args.get('max_id', type=int)
+    min_id = request.args.get('min_id', type=int)
+    statuses = []
+    # TODO: accounts and hashtags
+    if query and request.args.get('type') in (None, 'statuses'):
+        statuses = await read(search_statuses, g.session_id, query, limit, offset, max_id, min_id)
+        first_page = not offset and max_id is None and min_id is None
+        if first_page and len(statuses) < min(SEARCH_MIN_LOCAL_RESULTS, limit):
+            found = dict(statuses)
+            found.update(await _search_upstream(query))
+            statuses = sorted(found.items(), reverse=True)[:limit]
+    body = f'{{"accounts":[],"statuses":[{",".join(status for _, status in statuses)}],"hashtags":[]}}'
+    return json_response(body)
+
+
+async def _search_upstream(query: str) -> list:
+    # clients search as the user types, so short and repeated queries are kept away from the rate limit
+    # in the cache backend, so that a query is sent once whichever worker gets it
+    if len(query) < MIN_TERM_LENGTH or not await off_loop(cache.add, f'searched:{g.session_id}:{query.lower()}',
+                                                               True, SEARCH_UPSTREAM_TTL):
+        return []
+    try:
+        tweets = await upstream.call(g.session_id, 'SearchTimeline', g.client.search_tweet, query, 'Latest')
+    except UpstreamUnavailable as e:
+        logger.warning('Searching Twitter failed, answering from the local index: %s', e)
+        return []
+    rows = search_rows(tweets, get_host_url_or_bust())
+    account_store.flush()
+    db_writer.submit(index_statuses, g.session_id, rows)
+    return [(status_id, status) for status_id, _, _, status in rows]
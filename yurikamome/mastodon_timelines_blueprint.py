@@ -1,117 +1,164 @@
-import pytz
-from datetime import datetime
-from flask import jsonify, Blueprint, g
-from twikit import Tweet, User
-from .helpers import get_host_url_or_bust, async_token_authenticated
+import os
+import logging
+from typing import TYPE_CHECKING
+from flask import Blueprint, g, request, Response, jsonify
+from .helpers import get_host_url_or_bust, async_token_authenticated, db_writer, read
+from .conversion import tweet_to_status_json
+from .account_store import account_store
+from .timeline_store import (get_window, get_feed_window, refresh_head, refresh_feed, next_gap, fill_gap,
+                             next_feed_page, fill_feed)
+from .search_index import search_rows, index_statuses
+from .upstream import upstream, revalidate, UpstreamUnavailable, STALE_WARNING
+from .background import background
+from .responses import json_array_response, snowflake_time
+from .metrics import phase
+from .cache_backend import cache, off_loop
+
+if TYPE_CHECKING:
+    from twikit import Client
+
+logger = logging.getLogger(__name__)
 
 timelines_blueprint = Blueprint('mastodon_timelines', __name__)
 
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 40
+# speculative fetches of the next page allowed per session in PREFETCH_BUDGET_WINDOW seconds
+PREFETCH_BUDGET = int(os.getenv('PREFETCH_BUDGET', '10'))
+PREFETCH_BUDGET_WINDOW = int(os.getenv('PREFETCH_BUDGET_WINDOW', '900'))
+
+# timeline store key -> (upstream endpoint, twikit Client method)
+TIMELINES = {
+    'home': ('HomeLatestTimeline', 'get_latest_timeline'),
+    'foryou': ('HomeTimeline', 'get_timeline'),
+}
+# timelines that are not in chronological order, kept in upstream order rather than in the timeline store
+FEEDS = {'foryou'}
+# Twitter's For You timeline is offered to Mastodon clients as a list
+FOR_YOU_LIST = {'id': 'foryou', 'title': 'For You', 'replies_policy': 'none', 'exclusive': False}
+
 
 @timelines_blueprint.route('/api/v1/timelines/home')
 @async_token_authenticated
 async def home_timeline():
-    tweets = await g.client.get_latest_timeline()
-    statues = []
-    for t in tweets:
-        statues.append(_tweet_to_status(t, get_host_url_or_bust()))
-    return jsonify(statues)
-
-
-# timestamp looks like "Sat Mar 16 23:00:07 +0000 2024"
-def _parse_twitter_timestamp(timestamp: str):
-    date_object = datetime.strptime(timestamp, '%a %b %d %H:%M:%S %z %Y')
-    date_object = date_object.astimezone(pytz.utc)
-    return date_object.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-
-
-def _twitter_media_to_media_attachment(media: dict) -> dict:
-    if media.get('type', '') == 'photo':
-        original_width = media.get('original_info', {}).get('height', 0)
-        original_height = media.get('original_info', {}).get('width', 0)
-        return {
-            'id': media.get('id_str', ''),
-            'type': 'image',
-            'url': media.get('media_url_https', ''),
-            'preview_url': media.get('media_url_https', ''), # TODO
-            'remote_url': media.get('media_url_https', ''),
-            'meta': {
-                'original': {
-                    'width': original_width,
-                    'height': original_height,
-                    'size': f"{original_width}x{original_height}",
-                    'aspect': original_width / original_height
-                },
-                # TODO: "small": {}
-            },
-            'description': '', # TODO
-            'blurhash': '0'
-        }
-    # TODO: handle video
-    return None
-
-
-def _tweet_to_status(tweet: Tweet, host_url: str) -> dict:
-    if isinstance(tweet.user, dict):
-        user_dict = tweet.user
-        user_id = user_dict.get('rest_id', '0')
-        created_at = user_dict.get('legacy', {}).get('created_at', '')
-        screen_name = user_dict.get('legacy', {}).get('screen_name', '')
-        display_name = user_dict.get('legacy', {}).get('name', '')
-        avatar = user_dict.get('legacy', {}).get('profile_image_url_https', '')
-        header = user_dict.get('legacy', {}).get('profile_banner_url', '')
-    else:
-        user = tweet.user  # type: User
-        user_id = user.id
-        created_at = user.created_at
-        screen_name = user.screen_name
-        display_name = user.name
-        avatar = user.profile_image_url
-        header = user.profile_banner_url if user.profile_banner_url else ''
-    return {
-        'id': tweet.id,
-        'uri': f'{host_url}/users/{screen_name}/statuses/{tweet.id}', # TODO
-        'created_at': _parse_twitter_timestamp(tweet.created_at),
-        'account': {
-            'id': user_id, # TODO
-            'username': screen_name,
-            'acct': screen_name,
-            'url': f'{host_url}/@{screen_name}', # TODO
-            'display_name': display_name,
-            'note': '',
-            'avatar': avatar,
-            'avatar_static': avatar,
-            'header': header,
-            'header_static': header,
-            'locked': False, # TODO
-            'fields': [],
-            'emojis': [],
-            'bot': False,
-            'group': False,
-            'discoverable': False,
-            'created_at': _parse_twitter_timestamp(created_at),
-            'last_status_at': '2023-02-01T00:00:00.000Z', # TODO
-            'status_count': 0, # TODO
-            'followers_count': 0, # TODO
-            'following_count': 0, # TODO
-        },
-        'content': tweet.full_text,
-        'visibility': 'public', # TODO
-        'sensitive': tweet.possibly_sensitive,
-        'spoiler_text': '',
-        'media_attachments': list(filter(lambda _: _, map(_twitter_media_to_media_attachment, tweet.media if tweet.media else []))),
-        'mentions': [], # TODO
-        'tags': [], # TODO
-        'emojis': [], # TODO
-        'reblogs_count': tweet.retweet_count,
-        'favourites_count': tweet.favorite_count,
-        'replies_count': tweet.reply_count,
-        'url': f'{host_url}/@{screen_name}/statuses/{tweet.id}',
-        'in_reply_to_id': None, # TODO
-        'in_reply_to_account_id': None, # TODO
-        'reblog': _tweet_to_status(tweet.retweeted_tweet, host_url) if tweet.retweeted_tweet else None,
-        'poll': None,
-        'card': None,
-        'language': tweet.lang,
-        'text': tweet.full_text,
-        'edited_at': None
-    }
+    return await _timeline('home', f'{get_host_url_or_bust()}/api/v1/timelines/home')
+
+
+@timelines_blueprint.route('/api/v1/timelines/list/<list_id>')
+@async_token_authenticated
+async def list_timeline(list_id: str):
+    if list_id != FOR_YOU_LIST['id']:
+        return jsonify({'error': 'Record not found'}), 404
+    return await _timeline('foryou', f'{get_host_url_or_bust()}/api/v1/timelines/list/{list_id}')
+
+
+@timelines_blueprint.route('/api/v1/lists')
+@async_token_authenticated
+async def lists():
+    return jsonify([FOR_YOU_LIST])
+
+
+@timelines_blueprint.route('/api/v1/lists/<list_id>')
+@async_token_authenticated
+async def get_list(list_id: str):
+    if list_id != FOR_YOU_LIST['id']:
+        return jsonify({'error': 'Record not found'}), 404
+    return jsonify(FOR_YOU_LIST)
+
+
+async def _timeline(timeline: str, url: str):
+    limit = min(max(request.args.get('limit', DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+    host_url = get_host_url_or_bust()
+    count = max(limit, DEFAULT_LIMIT)
+    statuses, stale = await (get_feed_window if timeline in FEEDS else get_window)(
+        g.session_id,
+        timeline,
+        timeline_fetcher(g.client, g.session_id, host_url, timeline, count),
+        max_id=request.args.get('max_id', type=int),
+        since_id=request.args.get('since_id', type=int),
+        min_id=request.args.get('min_id', type=int),
+        limit=limit,
+    )
+    resp = _statuses_response(statuses, url)
+    if stale:
+        # a timed out upstream call keeps running, the refresh joins it instead of calling again
+        background.submit(f'timeline:{g.session_id}:{timeline}', revalidate,
+                          refresh_feed if timeline in FEEDS else refresh_head, g.session_id, timeline,
+                          timeline_fetcher(g.client, g.session_id, host_url, timeline, count, background=True))
+        resp.headers['Warning'] = STALE_WARNING
+    elif statuses and request.args.get('min_id') is None:
+        # a client that just got this page is likely to scroll on to the next one
+        background.submit(f'prefetch:{g.session_id}:{timeline}', _prefetch_feed if timeline in FEEDS else _prefetch,
+                          g.session_id, timeline,
+                          timeline_fetcher(g.client, g.session_id, host_url, timeline, count, background=True),
+                          statuses[-1][0], limit)
+    return resp
+
+
+class PrefetchBudget:
+    """
+    Counts the speculative fetches of each session, at most PREFETCH_BUDGET every PREFETCH_BUDGET_WINDOW seconds.
+    The counts are in the cache backend, so that workers share one budget per session.
+    """
+
+    async def take(self, session_id: str) -> bool:
+        return await off_loop(cache.incr, f'prefetch:{session_id}', PREFETCH_BUDGET_WINDOW) <= PREFETCH_BUDGET
+
+
+prefetch_budget = PrefetchBudget()
+
+
+async def _prefetch(session_id: str, timeline: str, fetch_page, below: int, limit: int):
+    """
+    Fills the hole the next page down would run into, so that it is served from the store when the client asks.
+    Only one page ahead of what was served, so it stops when the user stops scrolling.
+    """
+    gap = await read(next_gap, session_id, timeline, below, limit)
+    if gap and await prefetch_budget.take(session_id):
+        try:
+            await fill_gap(session_id, timeline, fetch_page, gap)
+        except UpstreamUnavailable as e:
+            # e.g. shed to leave the rate limit to requests the user is waiting on
+            logger.info('Did not prefetch %s of session %s: %s', timeline, session_id, e)
+
+
+async def _prefetch_feed(session_id: str, timeline: str, fetch_page, below: int, limit: int):
+    """_prefetch for FEEDS: fetches the page at the feed's cursor once fewer than `limit` statuses are left below."""
+    if await next_feed_page(session_id, timeline, below, limit) and await prefetch_budget.take(session_id):
+        try:
+            await fill_feed(session_id, timeline, fetch_page, below, limit)
+        except UpstreamUnavailable as e:
+            logger.info('Did not prefetch %s of session %s: %s', timeline, session_id, e)
+
+
+def timeline_fetcher(client: 'Client', session_id: str, host_url: str, timeline: str = 'home',
+                     count: int = DEFAULT_LIMIT, background: bool = False):
+    """Returns a timeline_store fetch_page function over one of TIMELINES."""
+    endpoint, method = TIMELINES[timeline]
+
+    async def fetch_page(cursor):
+        tweets = await upstream.call(session_id, endpoint, getattr(client, method),
+                                     count=count, cursor=cursor, background=background)
+        with phase('convert'):
+            # converted and encoded one at a time, only the encoded statuses are kept
+            statuses = [(int(tweet.id), tweet_to_status_json(tweet, host_url)) for tweet in tweets]
+            account_store.flush()
+            db_writer.submit(index_statuses, session_id, search_rows(tweets, host_url))
+        return statuses, tweets.next_cursor
+    return fetch_page
+
+
+def _statuses_response(statuses: list, url: str) -> Response:
+    """
+    Sends (status id, encoded status) pairs as a JSON array and adds Mastodon's pagination Link header.
+    Clients polling an unchanged timeline get a 304.
+    """
+    encoded = [status for _, status in statuses]
+    if not statuses:
+        return json_array_response(encoded)
+    first_id, last_id = statuses[0][0], statuses[-1][0]
+    # a feed's first status is not always its newest
+    newest_id = max(status_id for status_id, _ in statuses)
+    resp = json_array_response(encoded, etag_prefix=str(newest_id), last_modified=snowflake_time(newest_id))
+    resp.headers['Link'] = f'<{url}?max_id={last_id}>; rel="next", <{url}?min_id={first_id}>; rel="prev"'
+    return resp
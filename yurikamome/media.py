@@ -0,0 +1,305 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional
+import httpx
+from .helpers import SQLITE_DB, LRUCache, query_db, transaction, db_writer
+from .client_pool import ssl_context
+
+logger = logging.getLogger(__name__)
+
+# where Twitter serves images from, overridable to test against a local stand-in
+MEDIA_UPSTREAM = os.getenv('MEDIA_UPSTREAM', 'https://pbs.twimg.com')
+# by default next to the database, i.e. in the /data volume
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(SQLITE_DB)), 'media'))
+MEDIA_CACHE_SIZE_MB = int(os.getenv('MEDIA_CACHE_SIZE_MB', '1024'))
+# previews fit in a square of this many pixels
+MEDIA_PREVIEW_SIZE = int(os.getenv('MEDIA_PREVIEW_SIZE', '400'))
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', '2'))
+MEDIA_STORE_SIZE = int(os.getenv('MEDIA_STORE_SIZE', '4096'))
+MEDIA_FETCH_TIMEOUT = 20
+# media that could not be processed is not retried for this long
+MEDIA_FAILURE_TTL = 600
+# videos play the cheapest MP4 whose shorter side has at least this many pixels
+VIDEO_TARGET_SIZE = int(os.getenv('VIDEO_TARGET_SIZE', '720'))
+# for clients that ask to save data (Save-Data, or a slow ECT client hint)
+VIDEO_SAVE_DATA_SIZE = int(os.getenv('VIDEO_SAVE_DATA_SIZE', '360'))
+
+VARIANTS = ('original', 'small')
+_MEDIA_PATH = re.compile(r'^[A-Za-z0-9_-]+(/[A-Za-z0-9_-]+)*\.(jpg|jpeg|png|webp)$')
+_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP'}
+# video.twimg.com URLs carry the resolution, e.g. .../vid/avc1/1280x720/abc.mp4
+_VARIANT_RESOLUTION = re.compile(r'/(\d+)x(\d+)/')
+
+media_pool = concurrent.futures.ThreadPoolExecutor(MEDIA_WORKERS, thread_name_prefix='media')
+
+
+@lru_cache(maxsize=None)
+def _http() -> httpx.Client:
+    return httpx.Client(verify=ssl_context(), timeout=MEDIA_FETCH_TIMEOUT, follow_redirects=True)
+
+
+def media_path(url: str) -> Optional[str]:
+    """Turns a pbs.twimg.com URL into the path the /media proxy serves it under, or None if it cannot."""
+    prefix = 'https://pbs.twimg.com/'
+    if not url.startswith(prefix):
+        return None
+    path = url[len(prefix):]
+    return path if is_media_path(path) else None
+
+
+def is_media_path(path: str) -> bool:
+    return bool(_MEDIA_PATH.match(path))
+
+
+class DiskCache:
+    """
+    Files in one directory, the least recently used ones deleted once they add up to more than `max_bytes`.
+    Files are written under a temporary name and renamed, so readers never see half a file.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._files = None  # type: OrderedDict[str, int]
+        self._size = 0
+        self._creating = {}  # type: dict[str, threading.Lock]
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._files is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        # hits bump mtime, so this is roughly the previous run's LRU order
+        self._files = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._size = sum(self._files.values())
+
+    def _lookup(self, name: str, path: str) -> bool:
+        if name not in self._files:
+            return False
+        if os.path.exists(path):
+            self._files.move_to_end(name)
+            os.utime(path)
+            return True
+        # deleted behind our back, e.g. by another worker process
+        self._size -= self._files.pop(name)
+        return False
+
+    def get_or_create(self, name: str, create) -> str:
+        """Returns the path of `name`, calling `create(path)` to write it first if it is not cached."""
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._load()
+            if self._lookup(name, path):
+                return path
+            creating = self._creating.setdefault(name, threading.Lock())
+        with creating:
+            try:
+                with self._lock:
+                    if self._lookup(name, path):
+                        return path
+                tmp_path = f'{path}.{threading.get_ident()}.tmp'
+                try:
+                    create(tmp_path)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                size = os.path.getsize(path)
+                with self._lock:
+                    self._files[name] = size
+                    self._size += size
+                    self._evict()
+            finally:
+                with self._lock:
+                    self._creating.pop(name, None)
+        return path
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+disk_cache = DiskCache(MEDIA_CACHE_DIR, MEDIA_CACHE_SIZE_MB * 1024 * 1024)
+
+
+def _cache_name(variant: str, path: str) -> str:
+    return f"{hashlib.sha1(f'{variant}:{path}'.encode()).hexdigest()}.{path.rsplit('.', 1)[-1]}"
+
+
+def ensure_original(path: str) -> str:
+    def fetch(tmp_path):
+        with _http().stream('GET', f'{MEDIA_UPSTREAM}/{path}', params={'name': 'orig'}) as resp:
+            resp.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in resp.iter_bytes():
+                    f.write(chunk)
+    return disk_cache.get_or_create(_cache_name('original', path), fetch)
+
+
+def ensure_small(path: str) -> str:
+    def shrink(tmp_path):
+        # like blurhash, only the media workers need it
+        from PIL import Image
+        with Image.open(ensure_original(path)) as image:
+            image.thumbnail((MEDIA_PREVIEW_SIZE, MEDIA_PREVIEW_SIZE))
+            image_format = _FORMATS[path.rsplit('.', 1)[-1]]
+            if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(tmp_path, format=image_format)
+    return disk_cache.get_or_create(_cache_name('small', path), shrink)
+
+
+def ensure(variant: str, path: str) -> str:
+    """Returns the cached file of a variant, fetching or generating it first. Blocks, run it on media_pool."""
+    return ensure_small(path) if variant == 'small' else ensure_original(path)
+
+
+def describe(path: str) -> dict:
+    """Works out the dimensions and blurhash of an image."""
+    import blurhash
+    from PIL import Image
+    with Image.open(ensure_original(path)) as original:
+        width, height = original.size
+    with Image.open(ensure_small(path)) as small:
+        small_width, small_height = small.size
+        # blurhash only keeps a few components, a tiny copy gives the same hash far quicker
+        tiny = small.copy()
+        tiny.thumbnail((64, 64))
+    return {
+        'width': width,
+        'height': height,
+        'small_width': small_width,
+        'small_height': small_height,
+        'blurhash': blurhash.encode(tiny, 4, 3),
+    }
+
+
+class MediaStore:
+    """
+    Dimensions and blurhash by media id. Media seen for the first time is handed to the media workers,
+    and the result is kept in memory and SQLite so it is worked out only once.
+    """
+
+    def __init__(self):
+        self._memory = LRUCache(MEDIA_STORE_SIZE, name='media')
+        self._failed = LRUCache(MEDIA_STORE_SIZE, ttl=MEDIA_FAILURE_TTL)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def get(self, media_id: str) -> Optional[dict]:
+        """Never blocks, returns None when the media was not worked out yet (see `schedule`)."""
+        return self._memory.get(media_id)
+
+    def schedule(self, media_id: str, path: str):
+        if self._failed.get(media_id):
+            return
+        with self._lock:
+            if media_id in self._pending:
+                return
+            self._pending.add(media_id)
+        media_pool.submit(self._process, media_id, path)
+
+    def _process(self, media_id: str, path: str):
+        try:
+            row = query_db('SELECT width, height, small_width, small_height, blurhash FROM media WHERE media_id = ?',
+                           (media_id,), one=True)
+            if row:
+                meta = dict(row)
+            else:
+                meta = describe(path)
+                db_writer.submit(_write_media, media_id, meta)
+            self._memory.put(media_id, meta)
+        except Exception:
+            logger.exception('Failed to process media %s', media_id)
+            self._failed.put(media_id, True)
+        finally:
+            with self._lock:
+                self._pending.discard(media_id)
+
+
+def _write_media(media_id: str, meta: dict):
+    with transaction() as db:
+        db.execute('INSERT OR REPLACE INTO media (media_id, width, height, small_width, small_height, blurhash, '
+                   'processed_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (media_id, meta['width'], meta['height'], meta['small_width'], meta['small_height'],
+                    meta['blurhash'], time.time()))
+
+
+media_store = MediaStore()
+
+
+def mp4_variants(video_info: dict) -> list:
+    """The MP4 variants of a video as [bitrate, width, height, url], cheapest first. Width and height are 0 when unknown."""
+    variants = []
+    for variant in video_info.get('variants', []):
+        if variant.get('content_type') != 'video/mp4':
+            continue
+        resolution = _VARIANT_RESOLUTION.search(variant['url'])
+        width, height = (int(resolution.group(1)), int(resolution.group(2))) if resolution else (0, 0)
+        variants.append([variant.get('bitrate', 0), width, height, variant['url']])
+    return sorted(variants)
+
+
+def select_variant(variants: list, target_size: int) -> list:
+    """The cheapest variant whose shorter side reaches `target_size`, or else the largest one."""
+    for variant in variants:
+        if min(variant[1], variant[2]) >= target_size:
+            return variant
+    return max(variants, key=lambda variant: (min(variant[1], variant[2]), variant[0]))
+
+
+class VideoStore:
+    """MP4 variants by media id, so that /media/video picks one per request, and the picks made so far."""
+
+    def __init__(self):
+        self._memory = LRUCache(MEDIA_STORE_SIZE, name='videos')
+        self._selected = LRUCache(MEDIA_STORE_SIZE)
+
+    def put(self, media_id: str, variants: list):
+        if self._memory.get(media_id) is None:
+            self._memory.put(media_id, variants)
+            db_writer.submit(_write_video, media_id, variants)
+
+    def get(self, media_id: str, memory_only: bool = False) -> Optional[list]:
+        variants = self._memory.get(media_id)
+        if variants is None and not memory_only:
+            row = query_db('SELECT variants FROM videos WHERE media_id = ?', (media_id,), one=True)
+            if row:
+                variants = json.loads(row['variants'])
+                self._memory.put(media_id, variants)
+        return variants
+
+    def select(self, media_id: str, variants: list, target_size: int) -> list:
+        key = (media_id, target_size)
+        variant = self._selected.get(key)
+        if variant is None:
+            variant = select_variant(variants, target_size)
+            self._selected.put(key, variant)
+        return variant
+
+
+def _write_video(media_id: str, variants: list):
+    with transaction() as db:
+        db.execute('INSERT OR REPLACE INTO videos (media_id, variants, stored_at) VALUES (?, ?, ?)',
+                   (media_id, json.dumps(variants), time.time()))
+
+
+video_store = VideoStore()
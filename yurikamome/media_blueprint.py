@@ -0,0 +1,42 @@
+import asyncio
+import httpx
+from flask import Blueprint, jsonify, send_file, request, redirect
+from .helpers import read
+from .media import VARIANTS, is_media_path, ensure, media_pool, video_store, VIDEO_TARGET_SIZE, VIDEO_SAVE_DATA_SIZE
+
+media_blueprint = Blueprint('media', __name__)
+
+# a media path always points at the same bytes
+MEDIA_MAX_AGE = 365 * 24 * 3600
+SLOW_CONNECTIONS = ('slow-2g', '2g', '3g')
+
+
+@media_blueprint.route('/media/<variant>/<path:path>')
+async def media(variant: str, path: str):
+    if variant not in VARIANTS or not is_media_path(path):
+        return jsonify({'error': 'Record not found'}), 404
+    try:
+        file = await asyncio.get_running_loop().run_in_executor(media_pool, ensure, variant, path)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            return jsonify({'error': 'Record not found'}), 404
+        return jsonify({'error': f'Upstream answered {e.response.status_code}'}), 502
+    except httpx.TransportError as e:
+        return jsonify({'error': f'Upstream is unavailable: {e!r}'}), 502
+    return send_file(file, max_age=MEDIA_MAX_AGE)
+
+
+@media_blueprint.route('/media/video/<media_id>.mp4')
+async def video(media_id: str):
+    """Redirects to the MP4 variant that suits the client: `?size=` pixels, or smaller when it wants to save data."""
+    variants = video_store.get(media_id, memory_only=True) or await read(video_store.get, media_id)
+    if not variants:
+        return jsonify({'error': 'Record not found'}), 404
+    target_size = request.args.get('size', VIDEO_TARGET_SIZE, type=int)
+    if request.headers.get('Save-Data', '').lower() == 'on' or request.headers.get('ECT') in SLOW_CONNECTIONS:
+        target_size = min(target_size, VIDEO_SAVE_DATA_SIZE)
+    resp = redirect(video_store.select(media_id, variants, target_size)[3])
+    resp.headers['Cache-Control'] = 'private, max-age=3600'
+    resp.headers['Vary'] = 'Save-Data, ECT'
+    resp.headers['Accept-CH'] = 'Save-Data, ECT'
+    return resp
@@ -0,0 +1,110 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
+
+# adds a Server-Timing header with the time each request spent per phase
+SERVER_TIMING = os.getenv('SERVER_TIMING', '0') == '1'
+# when set, /metrics wants "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Kept per process, even when the workers share a cache backend: with WEB_CONCURRENCY > 1, /metrics shows
+# whichever worker answered the scrape rather than the instance as a whole.
+REQUEST_SECONDS = Histogram('yurikamome_request_seconds', 'Time to answer a request, without streaming its body',
+                            ['route', 'method'])
+REQUESTS = Counter('yurikamome_requests_total', 'Requests answered', ['route', 'method', 'status'])
+UPSTREAM_SECONDS = Histogram('yurikamome_upstream_seconds', 'Time callers waited on a twikit call',
+                             ['method', 'outcome'], buckets=(.05, .1, .25, .5, 1, 2, 3, 5, 10, 30))
+SQLITE_SECONDS = Histogram('yurikamome_sqlite_seconds', 'Time spent running reads, writes and batch commits',
+                           ['operation', 'function'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1))
+SQLITE_WRITE_BATCH = Histogram('yurikamome_sqlite_write_batch_size', 'Writes committed together',
+                               buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+CACHE_LOOKUPS = Counter('yurikamome_cache_lookups_total', 'In-memory cache lookups', ['cache', 'result'])
+ACTIVE_SESSIONS = Gauge('yurikamome_active_sessions', 'Sessions whose apps were used in the last 30 minutes')
+STARTUP_SECONDS = Gauge('yurikamome_startup_seconds', 'Time from process start to the app being ready, by phase',
+                        ['phase'])
+
+# phase -> seconds, and the upstream calls, of the request being handled. None in background work
+_timings = contextvars.ContextVar('timings', default=None)
+_upstream_calls = contextvars.ContextVar('upstream_calls', default=None)
+
+
+def start_request():
+    _timings.set({})
+    _upstream_calls.set([])
+
+
+def request_timings() -> dict:
+    return _timings.get() or {}
+
+
+def request_upstream_calls() -> list:
+    """(twikit method, outcome, seconds) of every upstream call the current request waited on."""
+    return _upstream_calls.get() or []
+
+
+def record_upstream_call(method: str, outcome: str, seconds: float):
+    UPSTREAM_SECONDS.labels(method, outcome).observe(seconds)
+    calls = _upstream_calls.get()
+    if calls is not None:
+        calls.append((method, outcome, seconds))
+
+
+@contextmanager
+def phase(name: str):
+    """Adds the time spent inside to the current request's `name` phase in Server-Timing."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - started_at
+
+
+def server_timing(total: float) -> str:
+    """The Server-Timing header value of the current request. Phases can overlap, e.g. db is also counted in auth."""
+    timings = {**request_timings(), 'total': total}
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items())
+
+
+class CacheStats:
+    """
+    Hit and miss counts of one named cache. Lookups are on the hot path of conversion, so they are counted in plain
+    ints and only added to CACHE_LOOKUPS by publish_cache_stats, before metrics are collected.
+    """
+
+    def __init__(self, cache: str):
+        self.hits = 0
+        self.misses = 0
+        self._published = (0, 0)
+        self._lock = threading.Lock()
+        self._counters = (CACHE_LOOKUPS.labels(cache, 'hit'), CACHE_LOOKUPS.labels(cache, 'miss'))
+        _cache_stats.append(self)
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def publish(self):
+        with self._lock:
+            counts = (self.hits, self.misses)
+            for counter, count, published in zip(self._counters, counts, self._published):
+                if count > published:
+                    counter.inc(count - published)
+            self._published = counts
+
+
+_cache_stats = []  # type: list[CacheStats]
+
+
+def publish_cache_stats():
+    for stats in _cache_stats:
+        stats.publish()
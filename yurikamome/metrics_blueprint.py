@@ -0,0 +1,23 @@
+import hmac
+from flask import Blueprint, Response, request, jsonify
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from .helpers import query_db
+from .metrics import ACTIVE_SESSIONS, METRICS_TOKEN, publish_cache_stats
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+ACTIVE_SESSIONS_SQL = """
+SELECT COUNT(DISTINCT session_id) FROM apps
+WHERE session_id IS NOT NULL AND last_used_at >= datetime('now', '-30 minutes')
+"""
+
+
+@metrics_blueprint.route('/metrics')
+def metrics():
+    """Prometheus metrics of this process."""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                                 f'Bearer {METRICS_TOKEN}'.encode()):
+        return jsonify({'error': 'The access token is invalid'}), 401
+    publish_cache_stats()
+    ACTIVE_SESSIONS.set(query_db(ACTIVE_SESSIONS_SQL, one=True)[0])
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,72 @@
+import os
+import re
+import fcntl
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+_MIGRATION_FILE = re.compile(r'^(\d+)_.+\.sql$')
+
+
+def list_migrations():
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        m = _MIGRATION_FILE.match(filename)
+        if m:
+            migrations.append((int(m.group(1)), os.path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations)
+
+
+def latest_version() -> int:
+    migrations = list_migrations()
+    return migrations[-1][0] if migrations else 0
+
+
+def current_version(db: sqlite3.Connection) -> int:
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(db: sqlite3.Connection, target: int = None) -> list:
+    """
+    Applies every migration newer than the database's `PRAGMA user_version`, each in its own
+    transaction together with the version bump. Returns the versions that were applied.
+
+    Databases created from the old schema.sql are at version 0 with the tables already present,
+    which is why 0001_initial.sql uses CREATE TABLE IF NOT EXISTS.
+    """
+    version = current_version(db)
+    applied = []
+    for migration_version, path in list_migrations():
+        if migration_version <= version or (target is not None and migration_version > target):
+            continue
+        with open(path, 'r') as f:
+            sql = f.read()
+        try:
+            db.executescript(f'BEGIN;\n{sql}\nPRAGMA user_version = {migration_version};\nCOMMIT;')
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        applied.append(migration_version)
+    return applied
+
+
+def migrate_if_needed(db: sqlite3.Connection, lock_path: str) -> list:
+    """
+    What startup runs instead of `flask sqlite init`: usually just a comparison of `PRAGMA user_version` with the
+    newest migration. A database that is behind is migrated under an exclusive lock on `lock_path`, so that workers
+    starting together apply each migration once. Returns the versions that were applied.
+    """
+    version = current_version(db)
+    latest = latest_version()
+    if version > latest:
+        logger.warning('Database schema version %d is newer than this code knows (%d)', version, latest)
+    if version >= latest:
+        return []
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # another worker may have migrated while this one waited, migrate reads the version again
+        return migrate(db)
@@ -2,8 +2,9 @@ import json
 import secrets
 from urllib.parse import unquote, quote
 from flask import request, Blueprint, render_template, redirect, make_response, g
-from twikit import Client
-from .helpers import create_session, catches_exceptions, session_authenticated, delete_session, random_secret
+from .helpers import create_session, catches_exceptions, session_authenticated, delete_session, random_secret, \
+    db_writer
+from .client_pool import login_client
 
 pages_blueprint = Blueprint("pages", __name__)
 
@@ -47,7 +48,7 @@ async def twitter_auth():
     mfa = request.form.get('mfa', None)
     from_path = unquote(request.args.get('from', '/'))
 
-    client = Client('en-US')
+    client = login_client()
     await client.login(
         auth_info_1=username,
         auth_info_2=email,
@@ -57,7 +58,7 @@ async def twitter_auth():
     cookies = client.get_cookies()
     
     session_id = random_secret()
-    create_session(session_id, json.dumps(cookies), username)
+    await db_writer.write(create_session, session_id, json.dumps(cookies), username)
 
     resp = make_response(redirect(from_path))
     resp.set_cookie('session_id', session_id)
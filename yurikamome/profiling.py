@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import heapq
+import itertools
+import threading
+from collections import Counter, deque
+
+# stack samples taken per second all the time, 0 to only sample on demand through /admin/profile
+PROFILE_HZ = float(os.getenv('PROFILE_HZ', '0'))
+# samples kept for /admin/profile to look back on
+PROFILE_MAX_SAMPLES = int(os.getenv('PROFILE_MAX_SAMPLES', '100000'))
+# requests slower than this many seconds are kept for /admin/slow_requests, the SLOW_REQUEST_BUFFER slowest of them
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD', '1'))
+SLOW_REQUEST_BUFFER = int(os.getenv('SLOW_REQUEST_BUFFER', '50'))
+MAX_DISTINCT_STACKS = 10000
+# threads stopped in one of these files are waiting for work rather than doing it
+_IDLE_FILES = ('selectors.py', 'threading.py', 'queue.py', 'thread.py', 'socket.py', 'socketserver.py')
+
+
+class Sampler:
+    """
+    A sampling profiler: a daemon thread that records the Python stack of every other thread PROFILE_HZ
+    times a second, or faster while someone profiles a window through `profile`. Idle threads are left out.
+    Requests run as tasks on the background loop, so their hot frames show up under its thread.
+    """
+
+    def __init__(self):
+        self._samples = deque(maxlen=PROFILE_MAX_SAMPLES)  # type: deque[tuple[float, str]]
+        self._labels = {}  # type: dict[object, str]
+        self._stacks = {}  # type: dict[str, str]
+        self._boost_hz = 0.0
+        self._boost_until = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+
+    def boost(self, hz: float, seconds: float):
+        """Samples at `hz` for the next `seconds`."""
+        self._boost_hz = hz
+        self._boost_until = time.monotonic() + seconds
+        self.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            hz = self._boost_hz if time.monotonic() < self._boost_until else PROFILE_HZ
+            if not hz:
+                time.sleep(1)
+                continue
+            now = time.time()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stack = self._collapse(frame)
+                    if stack:
+                        self._samples.append((now, stack))
+            time.sleep(1 / hz)
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+        return label
+
+    def _collapse(self, frame) -> str:
+        if os.path.basename(frame.f_code.co_filename) in _IDLE_FILES:
+            return ''
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        stack = ';'.join(reversed(labels))
+        if len(self._stacks) >= MAX_DISTINCT_STACKS:
+            self._stacks.clear()
+        # the same few stacks come up over and over, one copy of each is enough
+        return self._stacks.setdefault(stack, stack)
+
+    def collapsed(self, since: float = 0) -> str:
+        """The samples taken since `since` (a time.time()) in the collapsed stack format of flamegraph.pl and speedscope."""
+        counts = Counter(stack for at, stack in list(self._samples) if at >= since)
+        return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
+
+
+sampler = Sampler()
+
+
+class SlowRequests:
+    """
+    The SLOW_REQUEST_BUFFER slowest requests since the process started, of those that took longer than
+    SLOW_REQUEST_THRESHOLD, with their phase timings. A min-heap by duration, so the fastest one is replaced.
+    """
+
+    def __init__(self):
+        self._heap = []  # type: list[tuple[float, int, dict]]
+        self._recorded = itertools.count()
+        self._lock = threading.Lock()
+
+    def record(self, method: str, path: str, route: str, status: int, seconds: float, timings: dict,
+               upstream_calls: list):
+        if seconds < SLOW_REQUEST_THRESHOLD:
+            return
+        entry = (seconds, next(self._recorded), {
+            'at': time.time(),
+            'method': method,
+            'path': path,
+            'route': route,
+            'status': status,
+            'seconds': round(seconds, 4),
+            'phases': {name: round(phase_seconds, 4) for name, phase_seconds in timings.items()},
+            'upstream_calls': [{'method': upstream_method, 'outcome': outcome, 'seconds': round(call_seconds, 4)}
+                               for upstream_method, outcome, call_seconds in upstream_calls],
+        })
+        with self._lock:
+            if len(self._heap) < SLOW_REQUEST_BUFFER:
+                heapq.heappush(self._heap, entry)
+            elif seconds > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+
+    def slowest(self) -> list:
+        with self._lock:
+            return [request for _, _, request in sorted(self._heap, reverse=True)]
+
+
+slow_requests = SlowRequests()
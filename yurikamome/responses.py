@@ -0,0 +1,185 @@
+import os
+import json
+import gzip
+import zlib
+import hashlib
+from datetime import datetime, timezone
+from typing import Iterable, Iterator
+import brotli
+from flask import request, Response
+from werkzeug.http import is_resource_modified
+from .helpers import LRUCache
+from .metrics import phase
+
+# bodies smaller than this are not worth compressing
+COMPRESSION_MIN_SIZE = 1024
+# compressed copies of recent payloads, so that repeated polls do not compress again
+COMPRESSED_CACHE_SIZE = int(os.getenv('COMPRESSED_CACHE_SIZE', '256'))
+ENCODINGS = ('br', 'gzip')
+# JSON arrays larger than this are encoded and compressed element by element while they are sent
+STREAMING_MIN_SIZE = int(os.getenv('STREAMING_MIN_SIZE', str(32 * 1024)))
+# "orjson" (the default when it is installed) or "json"
+JSON_ENCODER = os.getenv('JSON_ENCODER', '')
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODERS = {'json': lambda obj: json.dumps(obj, separators=(',', ':'))}
+if orjson is not None:
+    ENCODERS['orjson'] = lambda obj: orjson.dumps(obj).decode()
+# encodes a value to a JSON string
+dumps = ENCODERS[JSON_ENCODER or ('orjson' if orjson is not None else 'json')]
+
+_compressed = LRUCache(COMPRESSED_CACHE_SIZE, name='compressed')
+# payloads that never change, compressed once at startup
+_pinned = {}  # type: dict[tuple[str, str], bytes]
+
+
+def _digest(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        # quality 11 is far too slow for responses made on the fly, 5 compresses about as well as gzip -9
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def _encoded(body: bytes, digest: str, encoding: str) -> bytes:
+    key = (digest, encoding)
+    data = _pinned.get(key) or _compressed.get(key)
+    if data is None:
+        data = _compress(body, encoding)
+        _compressed.put(key, data)
+    return data
+
+
+def _compressor(encoding: str):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: with a gzip header
+    return compressor.compress, compressor.flush
+
+
+def precompress(body: str) -> str:
+    """Compresses a payload that never changes once and for all. Returns the body for use with json_response."""
+    data = body.encode()
+    digest = _digest(data)
+    for encoding in ENCODINGS:
+        _pinned[(digest, encoding)] = _compress(data, encoding)
+    return body
+
+
+def snowflake_time(status_id: int) -> datetime:
+    """When a tweet was created, read from its id."""
+    return datetime.fromtimestamp(((status_id >> 22) + 1288834974657) / 1000, timezone.utc)
+
+
+def json_response(body: str, etag_prefix: str = '', last_modified: datetime = None,
+                  cache_control: str = 'private, no-cache') -> Response:
+    """
+    Sends a serialized JSON body with an ETag from its hash (after `etag_prefix`, e.g. the newest status id)
+    and an optional Last-Modified. Answers 304 when the client already has it, and otherwise compresses it
+    with brotli or gzip as the client accepts.
+    """
+    with phase('render'):
+        return _json_response(body, etag_prefix, last_modified, cache_control)
+
+
+def _json_response(body: str, etag_prefix: str, last_modified: datetime, cache_control: str) -> Response:
+    data = body.encode()
+    digest = _digest(data)
+    encoding = _encoding(len(data))
+    etag = _etag(etag_prefix, digest, encoding)
+    last_modified = last_modified.replace(microsecond=0) if last_modified is not None else None
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        resp = Response(status=304)
+    else:
+        resp = Response(_encoded(data, digest, encoding) if encoding else data, mimetype='application/json')
+    return _finish(resp, encoding, etag, last_modified, cache_control)
+
+
+def json_array_response(elements: list, etag_prefix: str = '', last_modified: datetime = None,
+                        cache_control: str = 'private, no-cache') -> Response:
+    """
+    Like json_response for an array of already encoded elements, e.g. statuses from the timeline store,
+    which are spliced in as they are. Arrays over STREAMING_MIN_SIZE are never joined in memory: they are
+    encoded and compressed one element at a time while the response is sent, and only the compressed body is
+    kept, so that the next request for the same array is sent from the cache.
+    """
+    with phase('render'):
+        return _json_array_response(elements, etag_prefix, last_modified, cache_control)
+
+
+def _json_array_response(elements: list, etag_prefix: str, last_modified: datetime, cache_control: str) -> Response:
+    size = sum(map(len, elements)) + len(elements) + 1
+    if size < STREAMING_MIN_SIZE:
+        return _json_response(f'[{",".join(elements)}]', etag_prefix, last_modified, cache_control)
+
+    digest = hashlib.blake2b(digest_size=12)
+    for chunk in _array_chunks(elements):
+        digest.update(chunk)
+    digest = digest.hexdigest()
+    encoding = _encoding(size)
+    etag = _etag(etag_prefix, digest, encoding)
+    last_modified = last_modified.replace(microsecond=0) if last_modified is not None else None
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        resp = Response(status=304)
+    elif not encoding:
+        resp = Response(_array_chunks(elements), mimetype='application/json')
+    else:
+        key = (digest, encoding)
+        data = _pinned.get(key) or _compressed.get(key)
+        # compressed once while it is streamed, then sent from the cache like smaller bodies
+        resp = Response(data if data is not None else _compressed_chunks(_array_chunks(elements), encoding, key),
+                        mimetype='application/json')
+    return _finish(resp, encoding, etag, last_modified, cache_control)
+
+
+def _array_chunks(elements: Iterable[str]) -> Iterator[bytes]:
+    yield b'['
+    for i, element in enumerate(elements):
+        yield (',' + element).encode() if i else element.encode()
+    yield b']'
+
+
+def _compressed_chunks(chunks: Iterator[bytes], encoding: str, key: tuple) -> Iterator[bytes]:
+    """Compresses chunks as they are sent, and caches the whole compressed body under `key` once it was."""
+    compress, finish = _compressor(encoding)
+    sent = []
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            sent.append(data)
+            yield data
+    data = finish()
+    sent.append(data)
+    yield data
+    _compressed.put(key, b''.join(sent))
+
+
+def _encoding(size: int):
+    return request.accept_encodings.best_match(ENCODINGS) if size >= COMPRESSION_MIN_SIZE else None
+
+
+def _etag(prefix: str, digest: str, encoding: str) -> str:
+    # every encoding is a different representation, so it needs its own ETag
+    return '-'.join(part for part in (prefix, digest, encoding) if part)
+
+
+def _finish(resp: Response, encoding: str, etag: str, last_modified: datetime, cache_control: str) -> Response:
+    if encoding and resp.status_code == 200:
+        resp.headers['Content-Encoding'] = encoding
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    resp.headers['Cache-Control'] = cache_control
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
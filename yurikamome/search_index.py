@@ -0,0 +1,80 @@
+import os
+import time
+from typing import TYPE_CHECKING
+from .helpers import query_db, transaction
+from .conversion import tweet_to_status_json
+
+if TYPE_CHECKING:
+    from twikit import Tweet
+
+# statuses are dropped from the search index once they are older than this many days,
+SEARCH_RETENTION_DAYS = int(os.getenv('SEARCH_RETENTION_DAYS', '30'))
+# or when there are more than this many newer ones
+SEARCH_MAX_STATUSES = int(os.getenv('SEARCH_MAX_STATUSES', '100000'))
+# the index is trimmed after every this many writes rather than on each one
+SEARCH_TRIM_INTERVAL = 1000
+# the trigram tokenizer cannot match anything shorter
+MIN_TERM_LENGTH = 3
+TWITTER_EPOCH_MS = 1288834974657
+
+_written_since_trim = 0
+
+
+def search_rows(tweets, host_url: str) -> list:
+    """(status id, text, screen name, encoded status) rows to index. Retweets are indexed as the tweet they retweet."""
+    rows = []
+    for tweet in tweets:  # type: Tweet
+        tweet = tweet.retweeted_tweet or tweet
+        rows.append((int(tweet.id), tweet.full_text, tweet.user.screen_name, tweet_to_status_json(tweet, host_url)))
+    return rows
+
+
+def index_statuses(session_id: str, rows: list):
+    """
+    Adds search_rows that a session saw to the index, replacing what was indexed before for the same ids.
+    Only that session finds them, unless others saw them too. Runs on the database writer.
+    """
+    global _written_since_trim
+    if not rows:
+        return
+    with transaction() as db:
+        db.executemany('INSERT OR REPLACE INTO search_index (rowid, text, screen_name, status) VALUES (?, ?, ?, ?)',
+                       rows)
+        db.executemany('INSERT OR IGNORE INTO search_sessions (session_id, status_id) VALUES (?, ?)',
+                       [(session_id, row[0]) for row in rows])
+        _written_since_trim += len(rows)
+        if _written_since_trim >= SEARCH_TRIM_INTERVAL:
+            _written_since_trim = 0
+            _trim(db)
+
+
+def _trim(db):
+    # status ids are snowflakes, so the age cutoff is an id cutoff too
+    cutoff_ms = (time.time() - SEARCH_RETENTION_DAYS * 86400) * 1000 - TWITTER_EPOCH_MS
+    cutoff = int(cutoff_ms) << 22
+    row = query_db('SELECT rowid FROM search_index ORDER BY rowid DESC LIMIT 1 OFFSET ?', (SEARCH_MAX_STATUSES,),
+                   one=True)
+    if row:
+        cutoff = max(cutoff, row['rowid'] + 1)
+    db.execute('DELETE FROM search_index WHERE rowid < ?', (cutoff,))
+    db.execute('DELETE FROM search_sessions WHERE status_id < ?', (cutoff,))
+
+
+def match_expression(query: str) -> str:
+    """Turns what a user typed into an FTS5 query that matches statuses containing every term, or '' if it cannot."""
+    terms = [term for term in query.split() if len(term) >= MIN_TERM_LENGTH]
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+
+def search_statuses(session_id: str, query: str, limit: int, offset: int = 0, max_id: int = None,
+                    min_id: int = None) -> list:
+    """Returns up to `limit` (status id, encoded status) pairs that the session saw matching `query`, newest first."""
+    match = match_expression(query)
+    if not match:
+        return []
+    rows = query_db('SELECT rowid, status FROM search_index WHERE search_index MATCH ? AND rowid < ? AND rowid > ? '
+                    'AND rowid IN (SELECT status_id FROM search_sessions WHERE session_id = ?) '
+                    'ORDER BY rowid DESC LIMIT ? OFFSET ?',
+                    (match, max_id if max_id is not None else 2 ** 63 - 1, min_id if min_id is not None else -1,
+                     session_id, limit, offset))
+    return [(row['rowid'], row['status']) for row in rows]
@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# prints where startup time went once the app is ready: the phases, and the slowest imports like `-X importtime`
+STARTUP_REPORT = os.getenv('STARTUP_REPORT', '0') == '1'
+# warns when the app takes longer than this many seconds from process start to ready, 0 to never warn
+STARTUP_TARGET = float(os.getenv('STARTUP_TARGET', '2'))
+STARTUP_REPORT_IMPORTS = 20
+# imported on a thread once the server is up rather than by the first request that needs them
+DEFERRED_IMPORTS = ('twikit', 'PIL.Image', 'blurhash')
+
+
+def _process_age() -> Optional[float]:
+    """Seconds since this process started, None where there is no /proc."""
+    try:
+        with open('/proc/self/stat') as f:
+            # the fields after the command name, which may hold spaces; starttime is the 22nd field
+            started_at = int(f.read().rsplit(')', 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0]) - started_at
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _TimedLoader:
+    """Wraps a module's loader while it executes, to time the module and everything it imports in turn."""
+
+    def __init__(self, loader, timer: '_ImportTimer'):
+        self.loader = loader
+        self.timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.timer.stack.append(0.0)
+        started_at = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            nested = self.timer.stack.pop()
+            if self.timer.stack:
+                self.timer.stack[-1] += elapsed
+            self.timer.modules.append((module.__name__, elapsed - nested, elapsed))
+            # the module keeps its real loader, for importlib.resources and the like
+            module.__loader__ = self.loader
+            if module.__spec__ is not None:
+                module.__spec__.loader = self.loader
+
+
+class _ImportTimer:
+    """A meta path finder in front of the others that times every module imported after it was installed."""
+
+    def __init__(self):
+        self.stack = []  # type: list[float]
+        # (module, self seconds, cumulative seconds) in the order they finished
+        self.modules = []  # type: list[tuple[str, float, float]]
+
+    def find_spec(self, name, path=None, target=None):
+        if threading.current_thread() is not threading.main_thread():
+            return None
+        finders = sys.meta_path[sys.meta_path.index(self) + 1:]
+        for finder in finders:
+            find_spec = getattr(finder, 'find_spec', None)
+            spec = find_spec(name, path, target) if find_spec else None
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+
+class Startup:
+    """Time from process start to the app being ready, by phase."""
+
+    def __init__(self):
+        self.loaded_at = time.perf_counter()
+        # seconds this process ran before this module was imported, i.e. the interpreter and earlier imports
+        self.before = _process_age()
+        self.phases = {}  # type: dict[str, float]
+        self.total = None  # type: Optional[float]
+        # set by an entry point that migrates the database itself once the server starts
+        self.migrates = False
+        self._timer = None
+        if STARTUP_REPORT:
+            self._timer = _ImportTimer()
+            sys.meta_path.insert(0, self._timer)
+
+    @contextmanager
+    def phase(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started_at
+
+    def ready(self):
+        """Records how long startup took and reports it. Only the first call counts."""
+        if self.total is not None:
+            return
+        since_loaded = time.perf_counter() - self.loaded_at
+        phases = {'interpreter': self.before or 0.0,
+                  'imports': since_loaded - sum(self.phases.values()),
+                  **self.phases}
+        self.total = phases['interpreter'] + since_loaded
+        if self._timer is not None:
+            sys.meta_path.remove(self._timer)
+
+        from .metrics import STARTUP_SECONDS
+        for name, seconds in phases.items():
+            STARTUP_SECONDS.labels(name).set(seconds)
+        STARTUP_SECONDS.labels('total').set(self.total)
+
+        if STARTUP_TARGET and self.total > STARTUP_TARGET:
+            logger.warning('Started in %.2fs, over the %.2fs target (STARTUP_REPORT=1 shows where the time went)',
+                           self.total, STARTUP_TARGET)
+        if STARTUP_REPORT:
+            print(self.report(phases), file=sys.stderr, flush=True)
+
+    def report(self, phases: dict) -> str:
+        lines = [f'Started in {self.total * 1e3:.0f} ms' + ('' if self.before is not None else
+                                                             ' (without the interpreter, there is no /proc)')]
+        lines += [f'  {name:<12} {seconds * 1e3:>8.1f} ms' for name, seconds in phases.items()]
+        modules = sorted(self._timer.modules, key=lambda module: module[1], reverse=True)
+        lines.append(f'Slowest of {len(modules)} imports:')
+        lines.append(f"  {'self ms':>8} {'cumul. ms':>9}  module")
+        lines += [f'  {own * 1e3:>8.1f} {cumulative * 1e3:>9.1f}  {name}'
+                  for name, own, cumulative in modules[:STARTUP_REPORT_IMPORTS]]
+        return '\n'.join(lines)
+
+
+startup = Startup()
+
+
+def warm_up():
+    """Imports DEFERRED_IMPORTS on a daemon thread, so that they are usually loaded before a request needs them."""
+    def run():
+        for module in DEFERRED_IMPORTS:
+            try:
+                __import__(module)
+            except ImportError as e:
+                logger.warning('Could not import %s ahead of time: %s', module, e)
+    threading.Thread(target=run, name='warm-up', daemon=True).start()
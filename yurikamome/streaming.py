@@ -0,0 +1,283 @@
+import os
+import json
+import asyncio
+import logging
+from urllib.parse import parse_qs
+from .helpers import query_session_by_access_token, cached_session_by_access_token, get_host_url_or_bust, read
+from .client_pool import client_pool
+from .cache_backend import cache
+from .timeline_store import sync_head, is_stale, newest_status_id, statuses_after
+from .mastodon_timelines_blueprint import timeline_fetcher
+
+logger = logging.getLogger(__name__)
+
+STREAMING_PATH = '/api/v1/streaming'
+# how often a session's home timeline is checked while anyone is streaming it
+STREAMING_POLL_INTERVAL = int(os.getenv('STREAMING_POLL_INTERVAL', '60'))
+STREAMING_HEARTBEAT_INTERVAL = int(os.getenv('STREAMING_HEARTBEAT_INTERVAL', '30'))
+# events buffered per connection before the oldest ones are dropped
+STREAMING_QUEUE_SIZE = int(os.getenv('STREAMING_QUEUE_SIZE', '64'))
+# pollers linger this long after their last subscriber leaves, so reconnects do not refetch
+POLLER_LINGER_SECONDS = 60
+
+USER_STREAMS = ('user', 'user:notification')
+
+
+class Subscriber:
+    """One streaming connection. Publishing never waits on it: when it falls behind, old events are dropped."""
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=STREAMING_QUEUE_SIZE)
+        self.dropped = 0
+
+    def push(self, event: str, payload: str):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait((event, payload))
+
+    @property
+    def lagging(self) -> bool:
+        # a consumer that lost more than a whole buffer is better off reconnecting and refetching
+        return self.dropped > STREAMING_QUEUE_SIZE
+
+
+class SessionPoller:
+    """Polls one session's home timeline and fans new statuses out to every connection of that session."""
+
+    def __init__(self, hub: 'StreamingHub', session_id: str, cookies: str):
+        self.hub = hub
+        self.session_id = session_id
+        self.cookies = cookies
+        self.subscribers = set()  # type: set[Subscriber]
+        self.task = None  # type: asyncio.Task
+        self.linger_handle = None  # type: asyncio.TimerHandle
+
+    async def run(self):
+        last_published = await read(newest_status_id, self.session_id, 'home') or 0
+        while True:
+            try:
+                # requests and the background sync refresh the store too, only go upstream when nobody did lately
+                if await read(is_stale, self.session_id, 'home', STREAMING_POLL_INTERVAL):
+                    client = client_pool.get(self.session_id, self.cookies)
+                    await sync_head(self.session_id, 'home', timeline_fetcher(
+                        client, self.session_id, get_host_url_or_bust(), background=True))
+                for status_id, status in await read(statuses_after, self.session_id, 'home', last_published):
+                    self.publish('update', status)
+                    last_published = status_id
+            except Exception:
+                logger.exception('Failed to poll home timeline for streaming')
+            await asyncio.sleep(STREAMING_POLL_INTERVAL)
+
+    def publish(self, event: str, payload: str):
+        for subscriber in self.subscribers:
+            subscriber.push(event, payload)
+
+
+class StreamingHub:
+    def __init__(self):
+        self.pollers = {}  # type: dict[str, SessionPoller]
+
+    def subscribe(self, session_id: str, cookies: str) -> Subscriber:
+        poller = self.pollers.get(session_id)
+        if poller is None:
+            poller = self.pollers[session_id] = SessionPoller(self, session_id, cookies)
+            poller.task = asyncio.create_task(poller.run())
+        if poller.linger_handle:
+            poller.linger_handle.cancel()
+            poller.linger_handle = None
+        subscriber = Subscriber()
+        poller.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, session_id: str, subscriber: Subscriber):
+        poller = self.pollers.get(session_id)
+        if poller is None:
+            return
+        poller.subscribers.discard(subscriber)
+        if not poller.subscribers and poller.linger_handle is None:
+            poller.linger_handle = asyncio.get_running_loop().call_later(
+                POLLER_LINGER_SECONDS, self._stop_poller, session_id)
+
+    def _stop_poller(self, session_id: str):
+        poller = self.pollers.get(session_id)
+        if poller and not poller.subscribers:
+            del self.pollers[session_id]
+            poller.task.cancel()
+
+    def close(self):
+        for session_id in list(self.pollers):
+            poller = self.pollers.pop(session_id)
+            poller.task.cancel()
+
+
+hub = StreamingHub()
+
+
+def _access_token(scope) -> str:
+    headers = dict(scope.get('headers', []))
+    auth_header = headers.get(b'authorization', b'').decode('latin-1')
+    if auth_header.startswith('Bearer '):
+        return auth_header[len('Bearer '):]
+    # browsers cannot set headers on EventSource or WebSocket, so Mastodon also takes these
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    if 'access_token' in query:
+        return query['access_token'][0]
+    return headers.get(b'sec-websocket-protocol', b'').decode('latin-1')
+
+
+def _requested_stream(scope) -> str:
+    path = scope['path'].rstrip('/')
+    if path.startswith(f'{STREAMING_PATH}/'):
+        return path[len(f'{STREAMING_PATH}/'):].replace('/', ':')
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    return query.get('stream', [None])[0]
+
+
+async def _session_row(scope):
+    access_token = _access_token(scope)
+    # like async_token_authenticated, a shared cache is only looked at from the read pool
+    return (None if cache.shared else cached_session_by_access_token(access_token)) \
+        or await read(query_session_by_access_token, access_token)
+
+
+async def _send_json(send, status: int, body: dict):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')],
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps(body).encode()})
+
+
+async def _next_event(subscriber: Subscriber):
+    try:
+        return await asyncio.wait_for(subscriber.queue.get(), STREAMING_HEARTBEAT_INTERVAL)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def _server_sent_events(scope, receive, send):
+    stream = _requested_stream(scope)
+    if stream not in USER_STREAMS:
+        return await _send_json(send, 404, {'error': 'Unknown stream type'})
+    session_row = await _session_row(scope)
+    if not session_row:
+        return await _send_json(send, 401, {'error': 'The access token is invalid'})
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-store'),
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+    session_id = session_row['session_id']
+    subscriber = hub.subscribe(session_id, session_row['cookies'])
+    gone = asyncio.Event()
+    disconnected = asyncio.create_task(_wait_for_disconnect(receive, gone))
+    try:
+        await send({'type': 'http.response.body', 'body': b':)\n\n', 'more_body': True})
+        while not gone.is_set() and not subscriber.lagging:
+            next_event = asyncio.create_task(_next_event(subscriber))
+            await asyncio.wait((next_event, disconnected), return_when=asyncio.FIRST_COMPLETED)
+            if not next_event.done():
+                next_event.cancel()
+                break
+            event = next_event.result()
+            if event is None:
+                chunk = b':thump\n\n'
+            elif stream == 'user':
+                chunk = f'event: {event[0]}\ndata: {event[1]}\n\n'.encode()
+            else:
+                continue
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        disconnected.cancel()
+        hub.unsubscribe(session_id, subscriber)
+    # the watcher is cancelled either way, only its flag tells whether the client is still there
+    if not gone.is_set():
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _wait_for_disconnect(receive, gone: asyncio.Event):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+    gone.set()
+
+
+async def _websocket(scope, receive, send):
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    session_row = await _session_row(scope)
+    if not session_row:
+        return await send({'type': 'websocket.close', 'code': 4001})
+    headers = dict(scope.get('headers', []))
+    accept = {'type': 'websocket.accept'}
+    if b'sec-websocket-protocol' in headers:
+        accept['subprotocol'] = headers[b'sec-websocket-protocol'].decode('latin-1')
+    await send(accept)
+
+    session_id = session_row['session_id']
+    streams = set()
+    initial_stream = _requested_stream(scope)
+    if initial_stream in USER_STREAMS:
+        streams.add(initial_stream)
+    subscriber = hub.subscribe(session_id, session_row['cookies'])
+    incoming = asyncio.create_task(receive())
+    try:
+        while not subscriber.lagging:
+            next_event = asyncio.create_task(subscriber.queue.get())
+            await asyncio.wait((next_event, incoming), return_when=asyncio.FIRST_COMPLETED)
+            if next_event.done():
+                event, payload = next_event.result()
+                if 'user' in streams:
+                    await send({'type': 'websocket.send', 'text': json.dumps({
+                        'stream': ['user'],
+                        'event': event,
+                        'payload': payload,
+                    })})
+            else:
+                next_event.cancel()
+            if incoming.done():
+                message = incoming.result()
+                if message['type'] == 'websocket.disconnect':
+                    return
+                error = _handle_websocket_command(message.get('text'), streams)
+                if error:
+                    await send({'type': 'websocket.send', 'text': json.dumps({'error': error})})
+                incoming = asyncio.create_task(receive())
+        await send({'type': 'websocket.close', 'code': 1013})
+    finally:
+        incoming.cancel()
+        hub.unsubscribe(session_id, subscriber)
+
+
+def _handle_websocket_command(text: str, streams: set):
+    try:
+        command = json.loads(text or '')
+    except ValueError:
+        return 'Invalid JSON'
+    stream = command.get('stream') if isinstance(command, dict) else None
+    if stream not in USER_STREAMS:
+        return 'Unknown stream type'
+    if command.get('type') == 'subscribe':
+        streams.add(stream)
+    elif command.get('type') == 'unsubscribe':
+        streams.discard(stream)
+    return None
+
+
+async def streaming_app(scope, receive, send):
+    """
+    ASGI app for Mastodon's streaming API: Server-Sent Events under /api/v1/streaming/<stream>
+    and the multiplexed WebSocket at /api/v1/streaming. Only the user stream carries events.
+    """
+    if scope['type'] == 'websocket':
+        return await _websocket(scope, receive, send)
+    if scope['path'].rstrip('/') == f'{STREAMING_PATH}/health':
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/plain')]})
+        return await send({'type': 'http.response.body', 'body': b'OK'})
+    return await _server_sent_events(scope, receive, send)
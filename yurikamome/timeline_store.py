@@ -0,0 +1,330 @@
+import os
+import time
+import asyncio
+import weakref
+from typing import Awaitable, Callable, Optional
+from .helpers import query_db, transaction, read, db_writer
+from .upstream import UpstreamUnavailable
+from .cache_backend import cache, off_loop
+
+# how long the newest page of a timeline is served from the store before asking upstream again
+TIMELINE_REFRESH_INTERVAL = int(os.getenv('TIMELINE_REFRESH_INTERVAL', '60'))
+# statuses kept per session and timeline, older ones are dropped
+TIMELINE_RETENTION = int(os.getenv('TIMELINE_RETENTION', '1000'))
+# upstream pages fetched at most to fill one window
+MAX_GAP_FETCHES = 2
+# how long a feed that is not in chronological order (For You) can be scrolled through before it starts over
+FEED_TTL = int(os.getenv('FEED_TTL', '1800'))
+# statuses kept per feed, scrolling a feed ends there. The whole feed is encoded on every change with a shared backend
+FEED_SIZE = int(os.getenv('FEED_SIZE', '400'))
+
+# fetches one upstream page: cursor (None for the newest page) -> ((status id, encoded status) pairs, next cursor)
+FetchPage = Callable[[Optional[str]], Awaitable[tuple]]
+
+
+def is_stale(session_id: str, timeline: str, max_age: int = TIMELINE_REFRESH_INTERVAL) -> bool:
+    row = query_db('SELECT refreshed_at FROM timelines WHERE session_id = ? AND timeline = ?',
+                   (session_id, timeline), one=True)
+    return not row or time.time() - row['refreshed_at'] >= max_age
+
+
+def newest_status_id(session_id: str, timeline: str) -> Optional[int]:
+    return query_db('SELECT MAX(status_id) AS status_id FROM timeline_statuses WHERE session_id = ? AND timeline = ?',
+                    (session_id, timeline), one=True)['status_id']
+
+
+def statuses_after(session_id: str, timeline: str, status_id: int, limit: int = 40) -> list:
+    """Returns up to `limit` (status id, encoded status) pairs newer than `status_id`, oldest first."""
+    rows = query_db('SELECT status_id, status FROM timeline_statuses WHERE session_id = ? AND timeline = ? '
+                    'AND status_id > ? ORDER BY status_id ASC LIMIT ?', (session_id, timeline, status_id, limit))
+    return [(row['status_id'], row['status']) for row in rows]
+
+
+def _store_page(session_id: str, timeline: str, statuses: list, next_cursor: Optional[str], below: int = None) -> list:
+    """
+    Stores a page fetched from upstream. `below` is the gap the page was fetched for, None for the newest page.
+    Returns the statuses newer than anything stored before. Runs on the database writer.
+    """
+    with transaction() as db:
+        key = (session_id, timeline)
+        if below is None:
+            connects_to = newest_status_id(session_id, timeline)
+        else:
+            db.execute('DELETE FROM timeline_gaps WHERE session_id = ? AND timeline = ? AND status_id = ?', key + (below,))
+            connects_to = query_db('SELECT MAX(status_id) AS status_id FROM timeline_statuses '
+                                   'WHERE session_id = ? AND timeline = ? AND status_id < ?', key + (below,),
+                                   one=True)['status_id']
+        newest_stored = connects_to if below is None else None
+        if statuses:
+            db.executemany('INSERT OR REPLACE INTO timeline_statuses (session_id, timeline, status_id, status) '
+                           'VALUES (?, ?, ?, ?)', [key + status for status in statuses])
+            oldest = min(status_id for status_id, _ in statuses)
+            # the page reached statuses we already had, so there is no hole below it
+            if next_cursor and (connects_to is None or connects_to < oldest):
+                db.execute('INSERT OR REPLACE INTO timeline_gaps (session_id, timeline, status_id, cursor) '
+                           'VALUES (?, ?, ?, ?)', key + (oldest, next_cursor))
+        if below is None:
+            db.execute('INSERT OR REPLACE INTO timelines (session_id, timeline, refreshed_at) VALUES (?, ?, ?)',
+                       key + (time.time(),))
+            _trim(db, session_id, timeline)
+        return [status for status in statuses if newest_stored is None or status[0] > newest_stored]
+
+
+def _trim(db, session_id: str, timeline: str):
+    key = (session_id, timeline)
+    cutoff_row = query_db('SELECT status_id FROM timeline_statuses WHERE session_id = ? AND timeline = ? '
+                          'ORDER BY status_id DESC LIMIT 1 OFFSET ?', key + (TIMELINE_RETENTION,), one=True)
+    if not cutoff_row:
+        return
+    db.execute('DELETE FROM timeline_statuses WHERE session_id = ? AND timeline = ? AND status_id <= ?',
+               key + (cutoff_row['status_id'],))
+    db.execute('DELETE FROM timeline_gaps WHERE session_id = ? AND timeline = ? AND status_id <= ?',
+               key + (cutoff_row['status_id'],))
+
+
+async def refresh_head(session_id: str, timeline: str, fetch_page: FetchPage) -> list:
+    """Fetches the newest upstream page into the store and returns the statuses that were not seen before."""
+    statuses, next_cursor = await fetch_page(None)
+    return await db_writer.write(_store_page, session_id, timeline, statuses, next_cursor)
+
+
+async def sync_head(session_id: str, timeline: str, fetch_page: FetchPage, max_pages: int = 1) -> list:
+    """
+    Like refresh_head, but when more than a page arrived since the last sync, keeps following the cursor
+    (up to `max_pages` in total) until the new statuses connect to the stored ones.
+    """
+    previous_newest = await read(newest_status_id, session_id, timeline)
+    new_statuses = await refresh_head(session_id, timeline, fetch_page)
+    if previous_newest is None:
+        return new_statuses
+    for _ in range(max_pages - 1):
+        gap = await read(_gap_row, session_id, timeline, previous_newest, 2 ** 63 - 1, False)
+        if not gap:
+            break
+        statuses, next_cursor = await fetch_page(gap['cursor'])
+        await db_writer.write(_store_page, session_id, timeline, statuses, next_cursor, gap['status_id'])
+        new_statuses += [status for status in statuses if status[0] > previous_newest]
+    return new_statuses
+
+
+def _count(session_id: str, timeline: str, lower: int, upper: int) -> int:
+    return query_db('SELECT COUNT(*) AS n FROM timeline_statuses WHERE session_id = ? AND timeline = ? '
+                    'AND status_id > ? AND status_id < ?', (session_id, timeline, lower, upper), one=True)['n']
+
+
+def _gap_row(session_id: str, timeline: str, lower: int, upper: int, newest_first: bool):
+    return query_db('SELECT status_id, cursor FROM timeline_gaps WHERE session_id = ? AND timeline = ? '
+                    f'AND status_id > ? AND status_id <= ? ORDER BY status_id {"DESC" if newest_first else "ASC"} '
+                    'LIMIT 1', (session_id, timeline, lower, upper), one=True)
+
+
+async def get_window(session_id: str, timeline: str, fetch_page: FetchPage,
+                     max_id: int = None, since_id: int = None, min_id: int = None, limit: int = 20) -> tuple:
+    """
+    Returns up to `limit` (status id, encoded status JSON) pairs, newest first, following Mastodon's pagination semantics:
+    `max_id` and `since_id` bound a window that is filled from the newest end, `min_id` fills it from the oldest end.
+
+    The newest page is refreshed from upstream when it is older than TIMELINE_REFRESH_INTERVAL. Holes in the
+    requested window are filled through their upstream cursors, everything else is answered from the store.
+    When upstream is unavailable, the window is answered from the store alone and the returned `stale` flag is set.
+    Returns (statuses, stale).
+    """
+    stale = False
+    if max_id is None and await read(is_stale, session_id, timeline):
+        try:
+            await refresh_head(session_id, timeline, fetch_page)
+        except UpstreamUnavailable:
+            if await read(newest_status_id, session_id, timeline) is None:
+                raise
+            stale = True
+
+    newest_first = min_id is None
+    lower = min_id if min_id is not None else since_id if since_id is not None else -1
+    upper = max_id if max_id is not None else 2 ** 63 - 1
+    for attempt in range(MAX_GAP_FETCHES + 1):
+        gap = await read(_gap_row, session_id, timeline, lower, upper, newest_first)
+        if not gap:
+            break
+        # statuses between the window edge and the hole are contiguous and can be served as they are
+        if newest_first:
+            available = await read(_count, session_id, timeline, gap['status_id'] - 1, upper)
+        else:
+            available = await read(_count, session_id, timeline, lower, gap['status_id'])
+        give_up = attempt == MAX_GAP_FETCHES or stale
+        if newest_first and (available >= limit or give_up):
+            lower = gap['status_id'] - 1
+            break
+        if not newest_first and available >= limit:
+            upper = gap['status_id']
+            break
+        if give_up:
+            # the hole is still there, continue with the oldest statuses just above it
+            lower = gap['status_id'] - 1
+            break
+        try:
+            await fill_gap(session_id, timeline, fetch_page, gap)
+        except UpstreamUnavailable:
+            stale = True
+
+    statuses = await read(_window, session_id, timeline, lower, upper, limit, newest_first)
+    return (statuses if newest_first else statuses[::-1]), stale
+
+
+def next_gap(session_id: str, timeline: str, below: int, limit: int):
+    """
+    The hole that the page of `limit` statuses below `below` (i.e. the next page when scrolling down) would run into,
+    or None if that page can be served from the store.
+    """
+    gap = _gap_row(session_id, timeline, -1, below, True)
+    if gap and _count(session_id, timeline, gap['status_id'] - 1, below) < limit:
+        return gap
+    return None
+
+
+async def fill_gap(session_id: str, timeline: str, fetch_page: FetchPage, gap):
+    """Fetches the upstream page of a hole (a row from _gap_row or next_gap) into the store."""
+    statuses, next_cursor = await fetch_page(gap['cursor'])
+    await db_writer.write(_store_page, session_id, timeline, statuses, next_cursor, gap['status_id'])
+
+
+def _window(session_id: str, timeline: str, lower: int, upper: int, limit: int, newest_first: bool) -> list:
+    rows = query_db('SELECT status_id, status FROM timeline_statuses WHERE session_id = ? AND timeline = ? '
+                    f'AND status_id > ? AND status_id < ? ORDER BY status_id {"DESC" if newest_first else "ASC"} '
+                    'LIMIT ?', (session_id, timeline, lower, upper, limit))
+    return [(row['status_id'], row['status']) for row in rows]
+
+
+
+def _feed_lock(key: str) -> asyncio.Lock:
+    """
+    Held by this process while it reads, extends and writes back a feed, so that concurrent scrolls and prefetches
+    do not append the same upstream page twice.
+    """
+    lock = _feed_locks.get(key)
+    if lock is None:
+        lock = _feed_locks[key] = asyncio.Lock()
+    return lock
+
+
+_feed_locks = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary[str, asyncio.Lock]
+
+
+def _capped(feed: dict) -> dict:
+    # a feed that reached FEED_SIZE ends there, a cursor would skip what was cut off below it
+    if len(feed['statuses']) > FEED_SIZE:
+        return {**feed, 'statuses': feed['statuses'][:FEED_SIZE], 'cursor': None}
+    return feed
+
+
+def _prepend_page(feed: Optional[dict], statuses: list, next_cursor: Optional[str]) -> dict:
+    """
+    Puts a newest page on top of a feed. Statuses already in the feed stay where they are.
+    Returns a new feed, the one from the cache backend is not ours to change.
+    """
+    if feed is None:
+        return _capped({'statuses': statuses, 'cursor': next_cursor, 'refreshed_at': time.time()})
+    known = {status_id for status_id, _ in feed['statuses']}
+    return _capped({**feed, 'statuses': [status for status in statuses if status[0] not in known] + feed['statuses'],
+                    'refreshed_at': time.time()})
+
+
+def _append_page(feed: dict, statuses: list, next_cursor: Optional[str]) -> dict:
+    """Puts the page at the feed's cursor below it. Returns a new feed, like _prepend_page."""
+    known = {status_id for status_id, _ in feed['statuses']}
+    new_statuses = [status for status in statuses if status[0] not in known]
+    # a page of statuses that were all seen already is as far as the feed goes
+    return _capped({**feed, 'statuses': feed['statuses'] + new_statuses,
+                    'cursor': next_cursor if new_statuses else None})
+
+
+def _position(feed: dict, status_id: int) -> Optional[int]:
+    """Where the statuses after `status_id` start in the feed, None if it is not in the feed."""
+    for position, (feed_status_id, _) in enumerate(feed['statuses']):
+        if feed_status_id == status_id:
+            return position + 1
+    return None
+
+
+def _needs_page(feed: Optional[dict], below: int, limit: int) -> bool:
+    if feed is None or not feed['cursor']:
+        return False
+    position = _position(feed, below)
+    return position is not None and len(feed['statuses']) - position < limit
+
+
+async def get_feed_window(session_id: str, timeline: str, fetch_page: FetchPage,
+                          max_id: int = None, since_id: int = None, min_id: int = None, limit: int = 20) -> tuple:
+    """
+    get_window for a timeline that upstream does not sort by time, like For You, where the id ordered store would
+    merge pages out of order and lose their cursors. The feed is kept in upstream order in the cache backend for
+    FEED_TTL, and the ids in the pagination parameters are positions in it: `max_id` asks for the statuses after
+    that one, `since_id` and `min_id` for those above it, which the newest pages were put on top of.
+
+    A client still scrolling once the feed expired gets an empty page. Returns (statuses, stale).
+    """
+    key = f'feed:{session_id}:{timeline}'
+    stale = False
+    async with _feed_lock(key):
+        feed = await off_loop(cache.get, key)
+        changed = False
+        if max_id is None and (feed is None or time.time() - feed['refreshed_at'] >= TIMELINE_REFRESH_INTERVAL):
+            try:
+                feed = _prepend_page(feed, *(await fetch_page(None)))
+                changed = True
+            except UpstreamUnavailable:
+                if feed is None:
+                    raise
+                stale = True
+        if feed is None:
+            return [], stale
+
+        if max_id is not None:
+            position = _position(feed, max_id)
+            if position is None:
+                return [], stale
+            for _ in range(MAX_GAP_FETCHES + 1):
+                if not _needs_page(feed, max_id, limit):
+                    break
+                try:
+                    feed = _append_page(feed, *(await fetch_page(feed['cursor'])))
+                except UpstreamUnavailable:
+                    stale = True
+                    break
+                changed = True
+            window = feed['statuses'][position:position + limit]
+        else:
+            anchor = min_id if min_id is not None else since_id
+            position = _position(feed, anchor) if anchor is not None else None
+            top = position - 1 if position is not None else len(feed['statuses'])
+            if min_id is not None:
+                window = feed['statuses'][max(top - limit, 0):top]
+            else:
+                window = feed['statuses'][:min(top, limit)]
+
+        if changed:
+            await off_loop(cache.set, key, feed, FEED_TTL)
+    return [tuple(status) for status in window], stale
+
+
+async def refresh_feed(session_id: str, timeline: str, fetch_page: FetchPage):
+    """refresh_head for a feed: puts the newest upstream page on top of it."""
+    key = f'feed:{session_id}:{timeline}'
+    async with _feed_lock(key):
+        statuses, next_cursor = await fetch_page(None)
+        feed = _prepend_page(await off_loop(cache.get, key), statuses, next_cursor)
+        await off_loop(cache.set, key, feed, FEED_TTL)
+
+
+async def next_feed_page(session_id: str, timeline: str, below: int, limit: int) -> bool:
+    """Whether the page of `limit` statuses below `below` in a feed would have to be fetched from upstream."""
+    return _needs_page(await off_loop(cache.get, f'feed:{session_id}:{timeline}'), below, limit)
+
+
+async def fill_feed(session_id: str, timeline: str, fetch_page: FetchPage, below: int, limit: int):
+    """Fetches the upstream page at a feed's cursor, unless the page below `below` no longer needs it."""
+    key = f'feed:{session_id}:{timeline}'
+    async with _feed_lock(key):
+        feed = await off_loop(cache.get, key)
+        if _needs_page(feed, below, limit):
+            feed = _append_page(feed, *(await fetch_page(feed['cursor'])))
+            await off_loop(cache.set, key, feed, FEED_TTL)
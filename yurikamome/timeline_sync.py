@@ -0,0 +1,121 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from .helpers import query_db, get_host_url_or_bust, read
+from .client_pool import client_pool
+from .background import background
+from .cache_backend import cache, off_loop
+from .timeline_store import sync_head
+from .mastodon_timelines_blueprint import timeline_fetcher
+
+logger = logging.getLogger(__name__)
+
+TIMELINE_SYNC = os.getenv('TIMELINE_SYNC', '0') == '1'
+# sessions whose apps were used within this many seconds are kept in sync
+TIMELINE_SYNC_ACTIVE_WINDOW = int(os.getenv('TIMELINE_SYNC_ACTIVE_WINDOW', '1800'))
+TIMELINE_SYNC_MIN_INTERVAL = int(os.getenv('TIMELINE_SYNC_MIN_INTERVAL', '30'))
+TIMELINE_SYNC_MAX_INTERVAL = int(os.getenv('TIMELINE_SYNC_MAX_INTERVAL', '300'))
+TIMELINE_SYNC_CONCURRENCY = int(os.getenv('TIMELINE_SYNC_CONCURRENCY', '2'))
+# upstream pages pulled per sync when more than one page arrived since the last one
+TIMELINE_SYNC_MAX_PAGES = 3
+TICK_SECONDS = 5
+
+ACTIVE_SESSIONS_SQL = """
+SELECT DISTINCT sessions.session_id, sessions.cookies FROM sessions
+JOIN apps ON apps.session_id = sessions.session_id
+WHERE apps.last_used_at >= datetime('now', ?)
+"""
+
+
+class _SessionSchedule:
+    __slots__ = ('interval', 'due_at', 'running')
+
+    def __init__(self):
+        self.interval = TIMELINE_SYNC_MIN_INTERVAL
+        self.due_at = time.monotonic() + random.uniform(0, TIMELINE_SYNC_MIN_INTERVAL)
+        self.running = False
+
+    def reschedule(self, found_new: bool):
+        # busy timelines are polled more often, quiet ones back off
+        if found_new:
+            self.interval = max(TIMELINE_SYNC_MIN_INTERVAL, self.interval / 2)
+        else:
+            self.interval = min(TIMELINE_SYNC_MAX_INTERVAL, self.interval * 1.5)
+        self.due_at = time.monotonic() + self.interval * random.uniform(0.8, 1.2)
+
+
+class TimelineSync:
+    """
+    Keeps the home timelines of recently active sessions fresh in the timeline store, so that
+    /api/v1/timelines/home is answered from prefetched statuses. Runs as a task on the background
+    loop next to the requests it serves.
+    """
+
+    def __init__(self):
+        self._schedules = {}  # type: dict[str, _SessionSchedule]
+        self._semaphore = None
+        self._started = False
+        self._started_lock = threading.Lock()
+
+    def start(self):
+        with self._started_lock:
+            if self._started:
+                return
+            self._started = True
+        background.spawn(self._run())
+
+    async def _run(self):
+        self._semaphore = asyncio.Semaphore(TIMELINE_SYNC_CONCURRENCY)
+        tasks = set()
+        while True:
+            try:
+                for session_id, cookies in self._due_sessions(await read(self._active_sessions)):
+                    task = asyncio.create_task(self._sync(session_id, cookies))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            except Exception:
+                logger.exception('Failed to schedule timeline sync')
+            await asyncio.sleep(TICK_SECONDS)
+
+    @staticmethod
+    def _active_sessions() -> dict:
+        rows = query_db(ACTIVE_SESSIONS_SQL, (f'-{TIMELINE_SYNC_ACTIVE_WINDOW} seconds',))
+        return {row['session_id']: row['cookies'] for row in rows}
+
+    def _due_sessions(self, active: dict) -> list:
+        for session_id in list(self._schedules):
+            if session_id not in active:
+                del self._schedules[session_id]
+        now = time.monotonic()
+        due = []
+        for session_id, cookies in active.items():
+            schedule = self._schedules.setdefault(session_id, _SessionSchedule())
+            if not schedule.running and schedule.due_at <= now:
+                schedule.running = True
+                due.append((session_id, cookies))
+        return due
+
+    async def _sync(self, session_id: str, cookies: str):
+        schedule = self._schedules.get(session_id)
+        found_new = False
+        try:
+            async with self._semaphore:
+                # with several workers, whichever takes the lease syncs and the others skip this round
+                if not await off_loop(cache.add, f'timeline_sync:{session_id}', True, TIMELINE_SYNC_MIN_INTERVAL):
+                    return
+                client = client_pool.get(session_id, cookies)
+                fetch_page = timeline_fetcher(client, session_id, get_host_url_or_bust(), background=True)
+                new_statuses = await sync_head(session_id, 'home', fetch_page, TIMELINE_SYNC_MAX_PAGES)
+                found_new = bool(new_statuses)
+        except Exception:
+            logger.exception('Failed to sync home timeline')
+        finally:
+            if schedule:
+                schedule.reschedule(found_new)
+                schedule.running = False
+
+
+timeline_sync = TimelineSync()
@@ -0,0 +1,249 @@
+import os
+import time
+import asyncio
+import logging
+import httpx
+from .metrics import record_upstream_call, phase
+from .cache_backend import cache, off_loop
+
+logger = logging.getLogger(__name__)
+
+# calls are queued when an endpoint's budget runs out and it resets within this many seconds, shed otherwise
+UPSTREAM_MAX_QUEUE_SECONDS = int(os.getenv('UPSTREAM_MAX_QUEUE_SECONDS', '10'))
+# share of each endpoint's budget that background work (timeline sync, streaming) leaves to clients
+UPSTREAM_BACKGROUND_RESERVE = float(os.getenv('UPSTREAM_BACKGROUND_RESERVE', '0.25'))
+# how long a client request waits on an endpoint before it is answered from cache, e.g. "HomeLatestTimeline=4"
+UPSTREAM_DEADLINE = float(os.getenv('UPSTREAM_DEADLINE', '5'))
+UPSTREAM_DEADLINES = {
+    endpoint: float(seconds)
+    for endpoint, seconds in (
+        item.split('=') for item in os.getenv('UPSTREAM_DEADLINES', 'HomeLatestTimeline=4,UserByRestId=3').split(',') if item
+    )
+}
+# background work waits longer, and no call is let run past this
+UPSTREAM_BACKGROUND_DEADLINE = float(os.getenv('UPSTREAM_BACKGROUND_DEADLINE', '30'))
+# consecutive failures of an endpoint after which calls to it are refused for a while
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv('UPSTREAM_BREAKER_THRESHOLD', '5'))
+UPSTREAM_BREAKER_COOLDOWN = int(os.getenv('UPSTREAM_BREAKER_COOLDOWN', '30'))
+
+# marks responses answered from cache because upstream was not available in time
+STALE_WARNING = '110 - "Response is Stale"'
+
+
+class UpstreamUnavailable(Exception):
+    status = 503
+
+    def __init__(self, endpoint: str, message: str, retry_after: float = 0):
+        super().__init__(message)
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class UpstreamTimeout(UpstreamUnavailable):
+    status = 504
+
+    def __init__(self, endpoint: str, deadline: float):
+        super().__init__(endpoint, f'{endpoint} did not answer within {deadline:g}s')
+
+
+class RateLimited(UpstreamUnavailable):
+    status = 429
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(endpoint, f'Rate limit of {endpoint} is used up, retry in {int(retry_after)}s', retry_after)
+
+
+class RateLimitBucket:
+    """
+    Mirrors Twitter's rate limit window of one endpoint for one session: `remaining` calls are left
+    until `reset_at`, when the bucket is refilled to `limit`. Calls still in flight are not counted
+    by Twitter's headers yet, so they are subtracted here.
+
+    The window itself is kept in the cache backend, where every worker reads and updates it.
+    Only the calls in flight are counted per worker.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.limit = None  # type: int
+        self.remaining = None  # type: int
+        self.reset_at = 0.0
+        self.in_flight = 0
+
+    async def update(self, headers):
+        try:
+            self.limit = int(headers['x-rate-limit-limit'])
+            self.remaining = int(headers['x-rate-limit-remaining'])
+            self.reset_at = float(headers['x-rate-limit-reset'])
+        except (KeyError, ValueError):
+            return
+        await off_loop(cache.set, self.key, [self.limit, self.remaining, self.reset_at],
+                       max(self.reset_at - time.time(), 1))
+
+    async def load(self):
+        window = await off_loop(cache.get, self.key)
+        if window is not None:
+            self.limit, self.remaining, self.reset_at = window
+
+    async def wait_time(self, reserve: float) -> float:
+        """Seconds until a call fits in the budget, leaving `reserve` of the limit untouched."""
+        await self.load()
+        now = time.time()
+        if self.remaining is None or self.reset_at <= now:
+            return 0
+        if self.remaining - self.in_flight > self.limit * reserve:
+            return 0
+        return self.reset_at - now
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an endpoint after UPSTREAM_BREAKER_THRESHOLD consecutive failures. Once the cooldown
+    is over, a single trial call is let through: success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.failures < UPSTREAM_BREAKER_THRESHOLD:
+            return True
+        if self.probing or time.monotonic() < self.open_until:
+            return False
+        self.probing = True
+        return True
+
+    def retry_after(self) -> float:
+        return max(self.open_until - time.monotonic(), 0)
+
+    def succeeded(self):
+        self.failures = 0
+        self.probing = False
+
+    def failed(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= UPSTREAM_BREAKER_THRESHOLD:
+            self.open_until = time.monotonic() + UPSTREAM_BREAKER_COOLDOWN
+
+
+class Upstream:
+    """
+    The way blueprints call twikit. Identical calls of a session that are in flight at the same time
+    are merged into one (e.g. two clients of the same user refreshing together), and each endpoint's
+    rate limit is tracked from Twitter's headers, so calls wait or are shed before Twitter rejects them
+    and locks the account out.
+
+    Callers wait at most their endpoint's deadline and then get UpstreamTimeout, while the call itself
+    carries on for anyone else waiting on it. Endpoints that keep failing are cut off by a circuit breaker.
+    """
+
+    def __init__(self):
+        self._in_flight = {}  # type: dict[tuple, asyncio.Future]
+        self._buckets = {}  # type: dict[tuple[str, str], RateLimitBucket]
+        self._breakers = {}  # type: dict[str, CircuitBreaker]
+
+    def bucket(self, session_id: str, endpoint: str) -> RateLimitBucket:
+        bucket = self._buckets.get((session_id, endpoint))
+        if bucket is None:
+            bucket = self._buckets[(session_id, endpoint)] = RateLimitBucket(f'bucket:{session_id}:{endpoint}')
+        return bucket
+
+    def response_hook(self, session_id: str):
+        """An httpx response event hook that keeps the session's buckets up to date."""
+        async def record(response: httpx.Response):
+            if 'x-rate-limit-remaining' in response.headers:
+                endpoint = response.request.url.path.rsplit('/', 1)[-1]
+                await self.bucket(session_id, endpoint).update(response.headers)
+        return record
+
+    def forget(self, session_id: str):
+        for key in list(self._buckets):
+            if key[0] == session_id:
+                bucket = self._buckets.pop(key, None)
+                if bucket is not None:
+                    cache.delete(bucket.key)
+
+    async def call(self, session_id: str, endpoint: str, func, *args, background: bool = False, **kwargs):
+        """
+        Awaits `func(*args, **kwargs)`, a twikit Client method whose request goes to `endpoint`,
+        the last path segment of its URL (e.g. HomeLatestTimeline).
+        """
+        key = (session_id, func.__name__, args, tuple(sorted(kwargs.items())))
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._call(session_id, endpoint, func, args, kwargs, background))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        deadline = UPSTREAM_BACKGROUND_DEADLINE if background else UPSTREAM_DEADLINES.get(endpoint, UPSTREAM_DEADLINE)
+        started_at = time.perf_counter()
+        outcome = 'error'
+        try:
+            with phase('upstream'):
+                # one caller going away must not cancel the call for the others
+                result = await asyncio.wait_for(asyncio.shield(future), deadline)
+            outcome = 'ok'
+            return result
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise UpstreamTimeout(endpoint, deadline) from None
+        except RateLimited:
+            outcome = 'rate_limited'
+            raise
+        except UpstreamUnavailable:
+            outcome = 'unavailable'
+            raise
+        finally:
+            record_upstream_call(func.__name__, outcome, time.perf_counter() - started_at)
+
+    async def _call(self, session_id: str, endpoint: str, func, args: tuple, kwargs: dict, background: bool):
+        # already imported by whoever made the client behind `func`
+        from twikit.errors import TooManyRequests, ServerError
+        bucket = self.bucket(session_id, endpoint)
+        reserve = UPSTREAM_BACKGROUND_RESERVE if background else 0
+        wait = await bucket.wait_time(reserve)
+        if wait > UPSTREAM_MAX_QUEUE_SECONDS or (wait and background):
+            raise RateLimited(endpoint, wait)
+        if wait:
+            await asyncio.sleep(wait)
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = self._breakers[endpoint] = CircuitBreaker()
+        if not breaker.allow():
+            raise UpstreamUnavailable(endpoint, f'{endpoint} keeps failing, not calling it for now', breaker.retry_after())
+        bucket.in_flight += 1
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), UPSTREAM_BACKGROUND_DEADLINE)
+        except (asyncio.TimeoutError, httpx.TransportError, ServerError) as e:
+            breaker.failed()
+            raise UpstreamUnavailable(endpoint, f'{endpoint} failed: {e!r}') from e
+        except TooManyRequests as e:
+            breaker.succeeded()
+            if e.headers:
+                await bucket.update(e.headers)
+            logger.warning('Twitter rate limited %s for session %s', endpoint, session_id)
+            raise RateLimited(endpoint, max(bucket.reset_at - time.time(), 0)) from e
+        except asyncio.CancelledError:
+            breaker.probing = False
+            raise
+        except Exception:
+            # Twitter answered, e.g. with a 404, so it is up
+            breaker.succeeded()
+            raise
+        finally:
+            bucket.in_flight -= 1
+        breaker.succeeded()
+        return result
+
+
+upstream = Upstream()
+
+
+async def revalidate(func, *args):
+    """Runs a background refresh of a stale response. Upstream still being unavailable is expected there."""
+    try:
+        return await func(*args)
+    except UpstreamUnavailable as e:
+        logger.warning('Could not revalidate: %s', e)